@@ -12,11 +12,17 @@ import sys
 import argparse
 import time
 import datetime
+import errno
 import multiprocessing
 import socket
 import platform
 import json
 import pickle
+import Queue
+import select
+import threading
+import ctypes
+import ctypes.util
 
 import BuildGetter
 
@@ -37,6 +43,15 @@ def parse_nightly_time(string):
         raise Exception("Could not parse %s as a YYYY-MM-DD date")
     return datetime.date(int(string[0]), int(string[1]), int(string[2]))
 
+# argparse type for options that must be at least 1
+
+
+def positive_int(string):
+    value = int(string)
+    if value < 1:
+        raise argparse.ArgumentTypeError("must be at least 1, not %s" % (string,))
+    return value
+
 # Grab the first file (alphanumerically) from the batch folder,
 # delete it and return its contents
 
@@ -55,6 +70,90 @@ def get_queued_job(dirname):
         return bcmd
     return False
 
+# A queue of events for the run loop, put from other threads, that it sleeps on
+# until the next one arrives without polling: each event also writes a byte to
+# a pipe, which select() waits on along with any other watched file
+# descriptors. Where select() can't wait on pipes (Windows), falls back to
+# waiting on the queue a second at a time.
+
+
+class EventQueue():
+
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.fds = {}
+        self.pipe = None if is_win else os.pipe()
+
+    def put(self, *event):
+        self.queue.put(event)
+        if self.pipe:
+            os.write(self.pipe[1], 'x')
+
+    # Adds event whenever fd is readable, after reading from it
+    def watch_fd(self, fd, *event):
+        self.fds[fd] = event
+
+    # Waits up to timeout seconds (for ever if None) for events, returning the
+    # list of them
+    def wait(self, timeout=None):
+        events = []
+        if self.pipe:
+            try:
+                readable = select.select([self.pipe[0]] + self.fds.keys(), [], [], timeout)[0]
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                readable = []
+            for fd in readable:
+                os.read(fd, 4096)
+                if fd in self.fds:
+                    events.append(self.fds[fd])
+        elif self.queue.empty():
+            try:
+                events.append(self.queue.get(timeout=1 if timeout is None else min(1, timeout)))
+            except Queue.Empty:
+                pass
+        while True:
+            try:
+                events.append(self.queue.get_nowait())
+            except Queue.Empty:
+                return events
+
+
+# inotify events for a file being written to, or moved into, a directory
+gInotifyEvents = 0x8 | 0x80  # IN_CLOSE_WRITE | IN_MOVED_TO
+# Without inotify, how often to check for files in a directory
+gDirPollInterval = 2
+
+# Adds ('dir', dirname) events to an EventQueue when files are written to the
+# directory, using inotify on Linux, otherwise checking for any files every
+# gDirPollInterval seconds from a thread
+
+
+def watch_dir(events, dirname):
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init()
+    except (OSError, AttributeError):
+        fd = -1
+    if fd >= 0 and libc.inotify_add_watch(fd, dirname, gInotifyEvents) >= 0:
+        events.watch_fd(fd, 'dir', dirname)
+        return
+    if fd >= 0:
+        os.close(fd)
+
+    def poll():
+        while True:
+            time.sleep(gDirPollInterval)
+            try:
+                if os.listdir(dirname):
+                    events.put('dir', dirname)
+            except OSError:
+                pass
+    thread = threading.Thread(target=poll, name="BatchTester poll %s" % (dirname,))
+    thread.daemon = True
+    thread.start()
+
 # Given a 'hook', which is a path to a python file,
 # imports it as a module and returns the handle. A bit hacky.
 
@@ -109,6 +208,8 @@ class BatchBuild():
         # If true, retest the build even if its already queued. --hook scripts should
         # honor this in should_test as well
         self.force = None
+        # Bytes the build took up on disk once prepared, if known
+        self.size = None
 
     def build_type(self):
         if isinstance(self.build, BuildGetter.CompileBuild):
@@ -193,7 +294,11 @@ class BatchBuild():
 
 
 def _pool_batchtest_build(build, args):
-    return BatchTest.test_build(pickle.loads(build), args)
+    # Never raises, the run loop only hears back from tasks that return
+    try:
+        return BatchTest.test_build(pickle.loads(build), args)
+    except Exception, e:
+        return "%s :: %s" % (type(e), e)
 
 ##
 # BatchTest - a threaded test object. Given a list of builds, prepares them
@@ -215,9 +320,9 @@ class BatchTest(object):
         self.buildindex = 0
         self.pool = None
         self.processed = 0
-        self.tick = 0
+        self.events = EventQueue()
         self.builds = {
-            'building': None,
+            'building': [],
             'prepared': [],
             'running': [],
             'pending': [],
@@ -236,11 +341,14 @@ class BatchTest(object):
             self.hook = None
 
         self.builder = None
-        self.builder_mode = None
         self.builder_batch = None
         self.manager = multiprocessing.Manager()
         self.builder_result = self.manager.dict(
             {'result': 'not started', 'ret': None})
+        # Builds being prepared -> (process, result proxy)
+        self.preparers = {}
+        # The most a prepared build has taken up on disk so far
+        self.build_size = None
 
     def stat(self, msg=""):
         msg = "%s :: %s\n" % (time.ctime(), msg)
@@ -251,14 +359,14 @@ class BatchTest(object):
             self.logfile.flush()
 
     #
-    # Resets worker pool
+    # Resets worker pool. It's only started once there are tests to run, as its
+    # threads poll even while idle.
     def reset_pool(self):
         if self.pool:
             self.pool.close()
             self.pool.join()
         self.buildindex = 0
-        self.pool = multiprocessing.Pool(
-            processes=self.args['processes'], maxtasksperchild=1)
+        self.pool = None
 
     #
     # Writes/updates the status file
@@ -268,7 +376,6 @@ class BatchTest(object):
             return
         status = {
             'starttime': self.starttime,
-            'building': self.builds['building'].serialize() if self.builds['building'] else None,
             'batches': self.processedbatches,
             'pendingbatches': self.pendingbatches
         }
@@ -288,7 +395,7 @@ class BatchTest(object):
     # Builds that are in the pending/running list already
     def build_is_queued(self, build):
         for x in (self.builds['running'], self.builds['pending'],
-                  self.builds['prepared'], [self.builds['building']]):
+                  self.builds['prepared'], self.builds['building']):
             for y in x:
                 if y and y.revision == build.revision:
                     return True
@@ -301,70 +408,117 @@ class BatchTest(object):
             {'args': batchargs, 'note': None, 'requested': time.time(), 'uid': self.processed})
         self.processed += 1
 
-    # Checks on the builder subprocess, getting its result, starting it if needed,
-    # etc
+    # Starts a subprocess, and a thread that adds event when it exits
+    def start_process(self, target, args, *event):
+        process = multiprocessing.Process(target=target, args=args)
+        process.start()
+        watcher = threading.Thread(target=self._wait_process, args=(process, event),
+                                   name="BatchTester %s" % (event[0],))
+        watcher.daemon = True
+        watcher.start()
+        return process
+
+    def _wait_process(self, process, event):
+        process.join()
+        self.events.put(*event)
+
+    # Checks on the builder subprocess looking up batches, getting its result,
+    # starting it if needed, etc
     def check_builder(self):
         # Did it exit?
         if self.builder and not self.builder.is_alive():
             self.builder.join()
             self.builder = None
 
-            # Finished a batch queue job
-            if self.builder_mode == 'batch':
-                if self.builder_result['result'] == 'success':
-                    queued = self.queue_builds(
-                        self.builder_result['ret'][0],
-                        prepend=self.builder_batch['args'].get('prioritize'))
-                    already_queued = len(self.builder_result['ret'][0]) - len(queued)
-                    self.queue_builds(
-                        self.builder_result['ret'][1],
-                        target='skipped',
-                        prepend=self.builder_batch['args'].get('prioritize'))
-                    self.builder_batch['note'] = "Queued %u builds, skipped %u" % (
-                        len(queued), already_queued + len(self.builder_result['ret'][1]))
-                else:
-                    self.builder_batch['note'] = self.builder_result['ret']
-                self.stat("Batch completed: %s (%s)" % (
-                    self.builder_batch['args'], self.builder_batch['note']))
-                self.builder_batch = None
-
-            # Finished a build job
-            elif self.builder_mode == 'build':
-                build = self.builds['building']
-                self.stat("Test %u prepared" % (build.num,))
-                self.builds['building'] = None
-                if self.builder_result['result'] == 'success':
-                    self.builds['prepared'].append(self.builder_result['ret'])
-                else:
-                    build.note = "Build setup failed - see log"
-                    build.finished = time.time()
-                    self.builds['failed'].append(build)
+            if self.builder_result['result'] == 'success':
+                queued = self.queue_builds(
+                    self.builder_result['ret'][0],
+                    prepend=self.builder_batch['args'].get('prioritize'))
+                already_queued = len(self.builder_result['ret'][0]) - len(queued)
+                self.queue_builds(
+                    self.builder_result['ret'][1],
+                    target='skipped',
+                    prepend=self.builder_batch['args'].get('prioritize'))
+                self.builder_batch['note'] = "Queued %u builds, skipped %u" % (
+                    len(queued), already_queued + len(self.builder_result['ret'][1]))
+            else:
+                self.builder_batch['note'] = self.builder_result['ret']
+            self.stat("Batch completed: %s (%s)" % (
+                self.builder_batch['args'], self.builder_batch['note']))
+            self.builder_batch = None
             self.builder_result['result'] = 'uninitialied'
             self.builder_result['ret'] = None
-            self.builder_mode = None
 
         # Should it run?
         if not self.builder and len(self.pendingbatches):
-            self.builder_mode = 'batch'
             self.builder_batch = self.pendingbatches.pop()
             self.stat("Handling batch %s" % (self.builder_batch,))
             self.builder_batch['processed'] = time.time()
             self.processedbatches.append(self.builder_batch)
             self.builder_batch['note'] = "Processing - Looking up builds"
-            self.builder = multiprocessing.Process(target=self._process_batch, args=(
-                self.args, self.builder_batch['args'], self.builder_result, self.hook))
-            self.builder.start()
-        elif not self.builder and self.builds['building']:
-            self.builder_mode = 'build'
-            self.stat("Starting build for %s :: %s" % (
-                self.builds['building'].num, self.builds['building'].serialize()))
-            self.builder = multiprocessing.Process(target=self.prepare_build, args=(
-                self.builds['building'], self.builder_result))
-            self.builder.start()
+            self.builder = self.start_process(self._process_batch, (
+                self.args, self.builder_batch['args'], self.builder_result, self.hook),
+                'builder')
+
+    # Default for --prepare-jobs
+    gPrepareJobs = 2
+    # What a build is assumed to take up on disk until one has been prepared
+    gBuildSize = 512 * 1024 * 1024
+
+    # The bytes builds downloaded ahead of their tests may take up: --prepare-disk
+    # MiB, or --processes builds' worth
+    def disk_budget(self):
+        if self.args.get('prepare_disk') is not None:
+            return self.args['prepare_disk'] * 1024 * 1024
+        return self.args['processes'] * (self.build_size or self.gBuildSize)
+
+    # Whether another build can start being prepared without the builds being
+    # prepared, or waiting for a test slot, going over the disk budget. One is
+    # always let through, however big, so the queue can't stall.
+    def can_prepare(self):
+        if len(self.builds['building']) >= self.args['prepare_jobs']:
+            return False
+        estimate = self.build_size or self.gBuildSize
+        staged = len(self.builds['building']) * estimate
+        staged += sum(x.size if x.size is not None else estimate
+                      for x in self.builds['prepared'])
+        return not staged or staged + estimate <= self.disk_budget()
+
+    # Starts a subprocess downloading and extracting build, which adds a
+    # ('prepared', build) event when done
+    def start_prepare(self, build):
+        self.builds['building'].append(build)
+        self.stat("Starting build for %s :: %s" % (build.num, build.serialize()))
+        result = self.manager.dict({'result': 'not started', 'ret': None})
+        process = self.start_process(self.prepare_build, (build, result), 'prepared', build)
+        self.preparers[build] = (process, result)
+
+    # Moves a build whose preparation finished on to the run queue
+    def finish_prepare(self, build):
+        process, result = self.preparers.pop(build)
+        process.join()
+        self.builds['building'].remove(build)
+        if result['result'] == 'success':
+            self.stat("Test %u prepared" % (build.num,))
+            prepared = result['ret']
+            if prepared.size is not None:
+                self.build_size = max(self.build_size or 0, prepared.size)
+            self.builds['prepared'].append(prepared)
+        else:
+            self.stat("!! Test %u build setup failed" % (build.num,))
+            build.note = "Build setup failed - see log"
+            build.finished = time.time()
+            self.builds['failed'].append(build)
+            # Remove anything a failed download left behind
+            try:
+                build.build.cleanup()
+            except Exception, e:
+                self.stat("!! Cleaning up test %u failed :: %s" % (build.num, e))
 
     @staticmethod
     def prepare_build(build, result):
         if build.build.prepare():
+            build.size = build.build.get_size()
             result['result'] = 'success'
         else:
             result['result'] = 'failed'
@@ -393,9 +547,35 @@ class BatchTest(object):
             self.builds[target].extend(ready)
         return ready
 
+    # How long finished builds stay in the status file
+    gKeepBuilds = {
+        'completed': 60 * 60 * 24,
+        'failed': 60 * 60 * 24 * 3,
+        'skipped': 60 * 60 * 24
+    }
+    gKeepBatches = 60 * 60 * 24
+
+    # Removes old builds and batches from the status. Returns the seconds until
+    # the next one is due to go, or None if there are none.
+    def expire_status(self):
+        now = time.time()
+        expiries = []
+        for x, keep in self.gKeepBuilds.iteritems():
+            self.builds[x] = filter(lambda y: y.finished + keep > now, self.builds[x])
+            expiries.extend(y.finished + keep for y in self.builds[x])
+        self.processedbatches = filter(lambda x: x['processed'] + self.gKeepBatches > now,
+                                       self.processedbatches)
+        expiries.extend(x['processed'] + self.gKeepBatches for x in self.processedbatches)
+        return max(0, min(expiries) - now) if expiries else None
+
     #
     # Run loop
     #
+    # Sleeps between events (see EventQueue): a test finishing (from the
+    # pool's apply_async callback), a build being prepared, the builder
+    # subprocess exiting, a new file in the batch folder, or old status entries
+    # expiring. Each wakeup then
+    # moves everything along as far as it can go.
     def run(self):
         if not self.args.get('repo'):
             raise Exception(
@@ -421,8 +601,9 @@ class BatchTest(object):
                 # processed
                 recover_builds = ostat['running']
                 recover_builds.extend(ostat['prepared'])
-                if ostat['building']:
-                    recover_builds.append(ostat['building'])
+                # A single build, before builds were prepared side by side
+                building = ostat['building'] or []
+                recover_builds.extend(building if type(building) == list else [building])
                 recover_builds.extend(ostat['pending'])
 
                 if len(recover_builds):
@@ -442,13 +623,19 @@ class BatchTest(object):
         else:
             self.add_batch(self.args)
 
+        if batchmode:
+            watch_dir(self.events, batchmode)
+
+        events = []
         while True:
-            # Clean up finished builds
-            for build in self.builds['running']:
-                if not build.task.ready():
+            for event in events:
+                if event[0] == 'prepared':
+                    self.finish_prepare(event[1])
                     continue
-
-                taskresult = build.task.get() if build.task.successful() else False
+                if event[0] != 'test':
+                    continue
+                # Clean up finished builds
+                build, taskresult = event[1:]
                 if taskresult is True:
                     self.stat("Test %u finished" % (build.num,))
                     self.builds['completed'].append(build)
@@ -461,9 +648,6 @@ class BatchTest(object):
                 self.builds['running'].remove(build)
                 build.build.cleanup()
 
-            # Check on builder
-            self.check_builder()
-
             # Read any pending jobs if we're in batchmode
             while batchmode:
                 rcmd = None
@@ -473,23 +657,23 @@ class BatchTest(object):
                     note = "Invalid batch file"
                     self.stat(note)
                     self.processedbatches.append(
-                        {'args': "<parse error>", 'note': note})
+                        {'args': "<parse error>", 'note': note, 'processed': time.time()})
                 if rcmd:
                     self.add_batch(rcmd)
                 else:
                     break
 
-            # Prepare pending builds, but not more than processes, as prepared builds
-            # takeup space (hundreds of queued builds would fill /tmp with gigabytes
-            # of things)
-            if len(self.builds['pending']) \
-                    and not self.builds['building'] \
-                    and len(self.builds['prepared']) < self.args['processes']:
-                build = self.builds['pending'][0]
-                self.builds['building'] = build
-                self.builds['pending'].remove(build)
+            # Check on the batch lookup builder
+            self.check_builder()
+
+            # Prepare pending builds, several at once, as long as they fit in the
+            # disk budget, as prepared builds takeup space (hundreds of queued
+            # builds would fill /tmp with gigabytes of things)
+            while len(self.builds['pending']) and self.can_prepare():
+                build = self.builds['pending'].pop(0)
                 build.num = self.buildindex
                 self.buildindex += 1
+                self.start_prepare(build)
 
             # Start builds if pool is not filled
             while len(self.builds['prepared']) \
@@ -498,10 +682,15 @@ class BatchTest(object):
                 self.builds['prepared'].remove(build)
                 build.started = time.time()
                 self.stat("Moving test %u to running" % (build.num,))
+                if not self.pool:
+                    self.pool = multiprocessing.Pool(
+                        processes=self.args['processes'], maxtasksperchild=1)
                 build.task = self.pool.apply_async(
-                    _pool_batchtest_build, [pickle.dumps(build), self.args])
+                    _pool_batchtest_build, [pickle.dumps(build), self.args],
+                    callback=lambda result, build=build: self.events.put('test', build, result))
                 self.builds['running'].append(build)
 
+            timeout = self.expire_status()
             self.write_status()
 
             in_progress = sum(
@@ -520,25 +709,11 @@ class BatchTest(object):
                 elif not batchmode:
                     self.stat("All tasks complete, exiting")
                     break  # Done
-            # Wait a little and repeat loop
-            time.sleep(1)
-            self.tick += 1
-            if self.tick % 120 == 0:
-                # Remove items older than 1 day from these lists
-                self.builds['completed'] = filter(lambda x: (
-                    x.finished + 60 * 60 * 24) > time.time(), self.builds['completed'])
-                self.builds['failed'] = filter(lambda x: (
-                    x.finished + 60 * 60 * 24 * 3) > time.time(), self.builds['failed'])
-                self.builds['skipped'] = filter(lambda x: (
-                    x.finished + 60 * 60 * 24) > time.time(), self.builds['skipped'])
-                self.processedbatches = filter(lambda x: (
-                    x['processed'] + 60 * 60 * 24) > time.time(), self.processedbatches)
-            time.sleep(1)
+            # Sleep until something happens
+            events = self.events.wait(timeout)
 
         self.stat("No more tasks, exiting")
-        self.pool.close()
-        self.pool.join()
-        self.pool = None
+        self.reset_pool()
 
     # Threaded call the builder is started on. Calls _process_batch_inner and
     # handles return results
@@ -685,6 +860,13 @@ class BatchTestCLI(BatchTest):
         self.parser.add_argument('-p', '--processes',
                                  help='Number of tests to run in parallel.',
                                  default=multiprocessing.cpu_count(), type=int)
+        self.parser.add_argument('--prepare-jobs',
+                                 help='Number of builds to download and extract at once.',
+                                 default=BatchTest.gPrepareJobs, type=positive_int)
+        self.parser.add_argument('--prepare-disk',
+                                 help='Disk space, in MiB, that builds downloaded ahead of their '
+                                      'tests may take up. Defaults to --processes builds\' '
+                                      'worth.', type=positive_int)
         self.parser.add_argument('--hook',
                                  help='Name of a python file to import for each test. The test '
                                       'will call should_test(BatchBuild), run_tests(BatchBuild), '
@@ -0,0 +1,1074 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Helpers for reading the results databases BenchTester writes. Deliberately
+# free of BenchTester's dependencies so the export scripts can use it.
+#
+# Version 1 databases store one benchtester_data row per datapoint. Version 2
+# databases store one benchtester_packed_data row per (test, checkpoint,
+# process, iteration), with the datapoint ids, values, units and kinds packed
+# into zlib compressed arrays -- see pack_reports()
+#
+# Version 3 databases can additionally store rows holding only the values that
+# changed since an earlier row of the same test and process, named by the
+# row's base_checkpoint_id and base_iteration -- see diff_reports()
+
+import argparse
+import array
+import collections
+import contextlib
+import datetime
+import itertools
+import multiprocessing.pool
+import os
+import re
+import sqlite3
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+# Indexes for the tables in BenchTester.gTableSchemas. These live here so
+# ArchiveCache can restore them, as util/archive_db.sh drops them.
+#
+# The index set is versioned separately from the database format, in the
+# database's user_version -- bump gIndexVersion when changing an existing index
+# and create_indexes() will rebuild them in older databases.
+gIndexVersion = 2
+gIndexes = [
+    # A build's tests by name -- covers the per-build lookups of
+    # create_graph_json.py, should_test and ShardRouter
+    ('test_lookup',
+     'benchtester_tests ( build_id, name, successful, time )'),
+    # Builds in a time range, for ShardRouter.series()
+    ('build_time',
+     'benchtester_builds ( time, name )'),
+    # All of a test's data, covering so reading a test never touches the table
+    ('data_for_test',
+     'benchtester_data ( test_id, datapoint_id, checkpoint_id, proc_id, '
+     'iteration, value, units, kind )'),
+    # Not covering, the blobs are most of the table
+    ('packed_data_for_test',
+     'benchtester_packed_data ( test_id, checkpoint_id, proc_id, iteration )')
+]
+
+# Queries run per build or per test by the exporters and the tester hook. None
+# of them should need to scan a table, see check_query_plans().
+gQueries = {
+    # A build by name
+    'build': '''SELECT `id` FROM `benchtester_builds` WHERE `name` = ?''',
+    # A build and its repo, by name
+    'build_info': '''SELECT build.id AS id, build.name AS name,
+                            build.time AS time, repo.name AS repo_name
+                     FROM benchtester_builds build, benchtester_repos repo
+                     WHERE build.name = ? AND build.repo_id = repo.id''',
+    # The tests a build has complete data for
+    'build_tests': '''SELECT `name` FROM `benchtester_tests`
+                      WHERE `successful` = 1 AND `build_id` = ?''',
+    # The latest successful run of a test on a build
+    'latest_test': '''SELECT id, time FROM benchtester_tests
+                      WHERE name = ? AND build_id = ? AND successful = 1
+                      ORDER BY time DESC LIMIT 1''',
+    # The same, by build name
+    'latest_test_by_build_name': '''SELECT t.id, t.time
+                                    FROM benchtester_tests t
+                                    JOIN benchtester_builds b ON t.build_id = b.id
+                                    WHERE b.name = ? AND t.name = ? AND t.successful = 1
+                                    ORDER BY t.time DESC, t.id DESC LIMIT 1''',
+    # The builds in a time range, with their latest successful run of a test
+    'series_builds': '''SELECT b.time, b.name,
+                          (SELECT t.id FROM benchtester_tests t
+                           WHERE t.build_id = b.id AND t.name = ?
+                                 AND t.successful = 1
+                           ORDER BY t.time DESC, t.id DESC LIMIT 1) AS test_id
+                        FROM benchtester_builds b
+                        WHERE b.time BETWEEN ? AND ?
+                        ORDER BY b.time''',
+    # A build's mercurial revision number, if known
+    'revision': '''SELECT rev FROM benchtester_revisions WHERE name = ?''',
+    # The newest entry in the change log
+    'last_change': '''SELECT id, build_name FROM benchtester_changes
+                      WHERE id = (SELECT MAX(id) FROM benchtester_changes)''',
+    # A change log entry, to check it's the one we saw last time
+    'change': '''SELECT build_name FROM benchtester_changes WHERE id = ?''',
+    # The builds changed since a change log entry
+    'changed_builds': '''SELECT build_name FROM benchtester_changes WHERE id > ?''',
+    # All data for a block of tests in test_id order, version 1. The %s is
+    # replaced with a placeholder per test, see DataReader.read_tests()
+    'tests_data': '''SELECT test_id, datapoint_id, checkpoint_id, proc_id,
+                            iteration, value, units, kind
+                     FROM benchtester_data
+                     WHERE test_id IN (%s) ORDER BY test_id''',
+    # The same, version 2
+    'tests_packed_data': '''SELECT test_id, checkpoint_id, proc_id, iteration,
+                                   datapoint_ids, `values`, units, kinds
+                            FROM benchtester_packed_data
+                            WHERE test_id IN (%s) ORDER BY test_id''',
+    # The same, version 3
+    'tests_deduped_data': '''SELECT test_id, checkpoint_id, proc_id, iteration,
+                                    datapoint_ids, `values`, units, kinds,
+                                    base_checkpoint_id, base_iteration
+                             FROM benchtester_packed_data
+                             WHERE test_id IN (%s) ORDER BY test_id''',
+    # A single value, version 1
+    'value': '''SELECT value FROM benchtester_data
+                WHERE test_id = ? AND datapoint_id = ?
+                      AND checkpoint_id = ? AND proc_id = ?
+                      AND iteration = ?''',
+    # The packed row holding a single value, version 2
+    'packed_value': '''SELECT datapoint_ids, `values`, units, kinds
+                       FROM benchtester_packed_data
+                       WHERE test_id = ? AND checkpoint_id = ?
+                             AND proc_id = ? AND iteration = ?''',
+    # The same, version 3
+    'deduped_value': '''SELECT datapoint_ids, `values`, units, kinds,
+                               base_checkpoint_id, base_iteration
+                        FROM benchtester_packed_data
+                        WHERE test_id = ? AND checkpoint_id = ?
+                              AND proc_id = ? AND iteration = ?'''
+}
+
+# The latest successful run of every test on every build, read in one pass by
+# the exporters rather than looked up per build. These read the whole table,
+# so aren't in gQueries.
+gLatestTestsQuery = '''SELECT build_id, name, id, time FROM
+                         (SELECT build_id, name, id, time,
+                                 ROW_NUMBER() OVER (PARTITION BY build_id, name
+                                                    ORDER BY time DESC, id DESC) AS n
+                          FROM benchtester_tests WHERE successful = 1)
+                       WHERE n = 1'''
+# The same for SQLite before 3.25, which has no window functions. SQLite takes
+# the bare columns from the row MAX() picks.
+gLatestTestsGroupedQuery = '''SELECT build_id, name, id, MAX(time)
+                              FROM benchtester_tests WHERE successful = 1
+                              GROUP BY build_id, name'''
+
+# Tests per query in DataReader.read_tests(), well under SQLite's limit of 999
+# parameters
+gReadBlockSize = 200
+
+
+# Creates any missing indexes, first dropping the old set if the database's is
+# older than gIndexVersion. Returns True if the indexes were upgraded. Indexes
+# on tables the database doesn't have (older formats) are skipped.
+def create_indexes(cur):
+    version = cur.execute("PRAGMA user_version").fetchone()[0]
+    upgrade = version < gIndexVersion
+    for name, definition in gIndexes:
+        if upgrade:
+            cur.execute("DROP INDEX IF EXISTS `%s`" % (name,))
+        try:
+            cur.execute("CREATE INDEX IF NOT EXISTS `%s` ON %s" % (name, definition))
+        except sqlite3.OperationalError:
+            pass
+    if upgrade:
+        cur.execute("PRAGMA user_version = %u" % (gIndexVersion,))
+    return upgrade
+
+
+# Runs EXPLAIN QUERY PLAN for each of gQueries, returning (query name, plan
+# step) for every step that scans a whole table or index, or sorts the results
+# in a temporary b-tree. Queries for newer formats than the database's are
+# skipped.
+def check_query_plans(sql):
+    problems = []
+    for name, query in sorted(gQueries.items()):
+        query = query.replace('%s', '?, ?')
+        params = [None] * query.count('?')
+        try:
+            plan = sql.execute("EXPLAIN QUERY PLAN %s" % (query,), params).fetchall()
+        except sqlite3.OperationalError:
+            continue
+        for row in plan:
+            # The last column is the step's description, e.g. 'SCAN b' or,
+            # before SQLite 3.24, 'SCAN TABLE benchtester_builds AS b'
+            detail = row[-1]
+            if detail.startswith('SCAN') or 'TEMP B-TREE' in detail:
+                problems.append((name, detail))
+    return problems
+
+
+# A single datapoint, as returned by DataReader.read_test()
+DataRow = collections.namedtuple(
+    'DataRow',
+    ['datapoint', 'checkpoint', 'process', 'iteration', 'value', 'units', 'kind'])
+
+
+# Packs a list of (datapoint_id, value, units, kind) tuples into the blobs
+# stored in benchtester_packed_data. Entries are sorted by datapoint id and the
+# ids delta-encoded, so successive checkpoints compress to almost nothing.
+def pack_reports(entries):
+    entries = sorted(entries)
+    count = len(entries)
+    ids = []
+    last = 0
+    for entry in entries:
+        ids.append(entry[0] - last)
+        last = entry[0]
+    return (zlib.compress(struct.pack('<%ui' % count, *ids)),
+            zlib.compress(struct.pack('<%uq' % count, *(e[1] for e in entries))),
+            zlib.compress(struct.pack('<%ub' % count, *(e[2] for e in entries))),
+            zlib.compress(struct.pack('<%ub' % count, *(e[3] for e in entries))))
+
+
+# Reverses pack_reports, returning a list of (datapoint_id, value, units, kind)
+def unpack_reports(ids, values, units, kinds):
+    ids = unpack_datapoint_ids(ids)
+    count = len(ids)
+    values = struct.unpack('<%uq' % count, zlib.decompress(values))
+    units = struct.unpack('<%ub' % count, zlib.decompress(units))
+    kinds = struct.unpack('<%ub' % count, zlib.decompress(kinds))
+    return zip(ids, values, units, kinds)
+
+
+# Just the datapoint ids of a packed row, from its datapoint_ids blob
+def unpack_datapoint_ids(ids):
+    ids = zlib.decompress(ids)
+    ret = []
+    last = 0
+    for delta in struct.unpack('<%ui' % (len(ids) / 4), ids):
+        last += delta
+        ret.append(last)
+    return ret
+
+
+# The kind diff_reports() gives datapoints that were in the base row but not in
+# the new one
+gRemovedKind = -1
+
+
+# Returns the (datapoint_id, value, units, kind) entries needed to turn base into
+# reports, both being dicts of datapoint_id: (value, units, kind)
+def diff_reports(base, reports):
+    entries = [(k,) + v for k, v in reports.iteritems() if base.get(k) != v]
+    entries.extend((k, 0, 0, gRemovedKind) for k in base if k not in reports)
+    return entries
+
+
+# Reverses diff_reports, returning a new dict
+def apply_reports(base, entries):
+    reports = dict(base)
+    for entry in entries:
+        if entry[3] == gRemovedKind:
+            reports.pop(entry[0], None)
+        else:
+            reports[entry[0]] = entry[1:]
+    return reports
+
+
+# Returns the schema version of the database cur is connected to, or None
+def db_version(cur):
+    try:
+        cur.execute("SELECT MAX(`version`) FROM `benchtester_version`")
+    except Exception:
+        return None
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+# Deletes the benchtester_datapoints names no data refers to, in any format,
+# returning how many went. Packed rows (version 2 and up) name their datapoints
+# inside the blobs, so those are unpacked to find them.
+def remove_unreferenced_datapoints(sql):
+    tables = set(row[0] for row in
+                 sql.execute("SELECT `name` FROM `sqlite_master` WHERE `type` = 'table'"))
+    referenced = set()
+    if 'benchtester_data' in tables:
+        referenced.update(row[0] for row in
+                          sql.execute("SELECT DISTINCT `datapoint_id` FROM `benchtester_data`"))
+    if 'benchtester_packed_data' in tables:
+        for row in sql.execute("SELECT `datapoint_ids` FROM `benchtester_packed_data`"):
+            referenced.update(unpack_datapoint_ids(row[0]))
+    unreferenced = [row[0] for row in sql.execute("SELECT `id` FROM `benchtester_datapoints`")
+                    if row[0] not in referenced]
+    sql.executemany("DELETE FROM `benchtester_datapoints` WHERE `id` = ?",
+                    [(x,) for x in unreferenced])
+    return len(unreferenced)
+
+
+# Reads test data out of a version 1, 2 or 3 database, regardless of format.
+#   reader = DataReader(sql)
+#   for row in reader.read_test(test_id):
+#       print row.datapoint, row.value
+# or, for many tests at once:
+#   for test_id, rows in reader.read_tests(test_ids):
+#       ...
+class DataReader():
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.version = db_version(sql.cursor())
+        self.names = {}
+
+    # Loads the id -> name map for one of the name tables, reloading if ids
+    # are missing (e.g. a tester added names since we last looked)
+    def _names(self, table, want=()):
+        names = self.names.get(table)
+        if names is None or any(x not in names for x in want):
+            names = dict((row[0], row[1]) for row in
+                         self.sql.execute("SELECT `id`, `name` FROM `%s`" % (table,)))
+            self.names[table] = names
+        return names
+
+    # The latest successful run of every test on every build, as a dict of
+    # (build id, test name) -> (test id, time)
+    def latest_tests(self):
+        try:
+            rows = self.sql.execute(gLatestTestsQuery).fetchall()
+        except sqlite3.OperationalError:
+            rows = self.sql.execute(gLatestTestsGroupedQuery).fetchall()
+        return dict(((row[0], row[1]), (row[2], row[3])) for row in rows)
+
+    # Yields a DataRow for every datapoint of the given test
+    def read_test(self, test_id):
+        for _, rows in self.read_tests([test_id]):
+            for row in rows:
+                yield row
+
+    # Yields (test id, DataRows) for each of test_ids with any data, in test id
+    # order. The tests are read gReadBlockSize at a time, and only ids are
+    # read from the data tables -- the names come from the name tables, loaded
+    # once.
+    def read_tests(self, test_ids):
+        test_ids = sorted(set(x for x in test_ids if x is not None))
+        if self.version >= 3:
+            query, convert = gQueries['tests_deduped_data'], self._deduped_rows
+        elif self.version >= 2:
+            query, convert = gQueries['tests_packed_data'], self._packed_rows
+        else:
+            query, convert = gQueries['tests_data'], self._data_rows
+        for start in range(0, len(test_ids), gReadBlockSize):
+            block = test_ids[start:start + gReadBlockSize]
+            cur = self.sql.execute(query % (', '.join('?' * len(block)),), block)
+            # Plain tuples, as sqlite3.Row can't be sliced
+            rows = itertools.imap(tuple, cur)
+            for test_id, group in itertools.groupby(rows, lambda row: row[0]):
+                yield (test_id, convert([row[1:] for row in group]))
+
+    def _data_rows(self, rows):
+        datapoints = self._names('benchtester_datapoints', set(row[0] for row in rows))
+        checkpoints = self._names('benchtester_checkpoints', set(row[1] for row in rows))
+        procs = self._names('benchtester_procs', set(row[2] for row in rows))
+        for row in rows:
+            yield DataRow(datapoints[row[0]], checkpoints[row[1]], procs[row[2]], *row[3:])
+
+    def _packed_rows(self, rows):
+        for row in rows:
+            checkpoint = self._names('benchtester_checkpoints', [row[0]])[row[0]]
+            process = self._names('benchtester_procs', [row[1]])[row[1]]
+            entries = unpack_reports(*row[3:])
+            datapoints = self._names('benchtester_datapoints', [e[0] for e in entries])
+            for entry in entries:
+                yield DataRow(datapoints[entry[0]], checkpoint, process, row[2],
+                              entry[1], entry[2], entry[3])
+
+    def _deduped_rows(self, rows):
+        by_key = dict((row[:3], row) for row in rows)
+        resolved = {}
+
+        # The full reports of a row, as a dict of datapoint_id: (value, units,
+        # kind), applying it on top of its base row if it has one
+        def resolve(key):
+            if key not in resolved:
+                row = by_key[key]
+                base = resolve((row[7], row[1], row[8])) if row[7] is not None else {}
+                resolved[key] = apply_reports(base, unpack_reports(*row[3:7]))
+            return resolved[key]
+
+        for row in rows:
+            checkpoint = self._names('benchtester_checkpoints', [row[0]])[row[0]]
+            process = self._names('benchtester_procs', [row[1]])[row[1]]
+            reports = resolve(row[:3])
+            datapoints = self._names('benchtester_datapoints', reports.keys())
+            for datapoint_id in sorted(reports):
+                value, units, kind = reports[datapoint_id]
+                yield DataRow(datapoints[datapoint_id], checkpoint, process, row[2],
+                              value, units, kind)
+
+
+# Splits a full datapoint path as used by create_graph_json.py, e.g.
+# "Iteration 5/TabsOpen/Main/explicit/images", into
+# (iteration, checkpoint, process, reporter)
+def parse_datapoint(datapoint):
+    iteration, checkpoint, process, reporter = datapoint.split('/', 3)
+    return (int(iteration.replace('Iteration ', '')), checkpoint, process, reporter)
+
+
+# Builds the tree create_graph_json.py exports for a 'nodeize'd test, e.g.
+#   tree = NodeTree('/')
+#   tree.add("Iteration 5/TabsOpen/Main/explicit/images", 1024, 'bytes')
+#   tree.as_dict() -> {"Iteration 5": {"TabsOpen": {"Main": {...}}}}
+# where every node has a _val, its own value or else the sum of the values
+# below it, and _units, its own units or else those of everything below it
+# ('mixed' if they differ, left out for bytes). Nodes with just a _val are
+# replaced by the value.
+#
+# Nodes are kept in flat arrays indexed by node id, with paths interned to
+# ids. A child's id is always higher than its parent's, so
+# as_dict() totals the tree in one pass from the highest id down.
+class NodeTree():
+
+    def __init__(self, separator):
+        self.separator = separator
+        # Path -> node id. Datapoints share most of their path with others, so
+        # finding a node is usually a lookup or two.
+        self.ids = {}
+        # The root is node 0
+        self.parents = array.array('l', [-1])
+        self.segments = [None]
+        # The node's own value and units, from the last datapoint added for it
+        self.has_value = bytearray(1)
+        self.values = [None]
+        self.units = [None]
+        # The sum and units of all datapoints added for the node, before
+        # totalling
+        self.sums = [None]
+        self.sum_units = [None]
+
+    # The id of the node at path, created along with its parents if missing
+    def node(self, path):
+        node = self.ids.get(path)
+        if node is None:
+            parent_path, separator, segment = path.rpartition(self.separator)
+            parent = self.node(parent_path) if separator else 0
+            node = len(self.segments)
+            self.ids[path] = node
+            self.parents.append(parent)
+            self.segments.append(segment)
+            self.has_value.append(0)
+            self.values.append(None)
+            self.units.append(None)
+            self.sums.append(None)
+            self.sum_units.append(None)
+        return node
+
+    # Adds a datapoint. A None value is kept as the node's value, to tell
+    # missing data from 0, but doesn't count towards sums.
+    def add(self, path, value, units):
+        node = self.node(path)
+        self.has_value[node] = 1
+        self.values[node] = value
+        self.units[node] = units
+        if value is not None:
+            self.sums[node] = value if self.sums[node] is None else self.sums[node] + value
+        self.sum_units[node] = _merge_units(self.sum_units[node], units)
+
+    # The tree as nested dicts, ready for json.dumps()
+    def as_dict(self):
+        count = len(self.segments)
+        sums = list(self.sums)
+        sum_units = list(self.sum_units)
+        for node in xrange(count - 1, 0, -1):
+            parent = self.parents[node]
+            if sums[node] is not None:
+                sums[parent] = sums[node] if sums[parent] is None else sums[parent] + sums[node]
+            sum_units[parent] = _merge_units(sum_units[parent], sum_units[node])
+
+        # The root never has a value or units of its own
+        sums[0] = sum_units[0] = None
+        dicts = []
+        for node in xrange(count):
+            if self.has_value[node]:
+                out = {'_val': self.values[node], '_units': self.units[node]}
+            else:
+                out = {'_val': sums[node], '_units': sum_units[node]}
+            # Bytes is the default unit
+            if out['_units'] == 'bytes':
+                del out['_units']
+            dicts.append(out)
+        for node in xrange(count - 1, 0, -1):
+            out = dicts[node]
+            dicts[self.parents[node]][self.segments[node]] = out['_val'] if len(out) == 1 else out
+        return dicts[0]
+
+
+def _merge_units(a, b):
+    if a is None or a == b:
+        return b
+    return a if b is None else 'mixed'
+
+
+# Works out the series values create_graph_json.py would find in a test's
+# NodeTree (or flat datapoints, for a separator of None) straight from its
+# datapoints, without building the tree:
+#   resolver = SeriesResolver({'Max': ["Iteration 5/TabsOpen/Main/explicit",
+#                                      "Iteration 5/TabsOpen/explicit"]}, '/')
+#   resolver.add(5, 'TabsOpen', 'Main', 'explicit/images', 1024, 'bytes')
+#   resolver.values() -> {'Max': 1024}
+#   resolver.reset()
+# A series may list alternate datapoints, the first present (and non-zero,
+# if just a value) is used.
+class SeriesResolver():
+
+    def __init__(self, series, separator):
+        self.separator = separator
+        # Series name -> [target ids], target id -> datapoint
+        self.series = {}
+        self.targets = []
+        # Datapoint -> [target ids]
+        self.lookup = {}
+        for name, datapoints in series.items():
+            if not isinstance(datapoints, list):
+                datapoints = [datapoints]
+            self.series[name] = []
+            for datapoint in datapoints:
+                self.series[name].append(len(self.targets))
+                self.lookup.setdefault(datapoint, []).append(len(self.targets))
+                self.targets.append(datapoint)
+
+        # The (iteration, checkpoint, process) of every target, so rows of
+        # other checkpoints are skipped without formatting their path. Only
+        # possible when every target is at least that deep in the tree.
+        self.prefixes = None
+        if separator == '/':
+            parts = [x.split('/', 3) for x in self.targets]
+            if all(len(x) >= 3 and x[0].startswith('Iteration ') for x in parts):
+                self.prefixes = set((int(x[0][len('Iteration '):]), x[1], x[2]) for x in parts)
+        self.reset()
+
+    # Forgets all datapoints, for the next test
+    def reset(self):
+        count = len(self.targets)
+        # A datapoint at or below the target was added
+        self.exists = [False] * count
+        # The last datapoint exactly at the target
+        self.has_value = [False] * count
+        self.target_values = [None] * count
+        self.units = [None] * count
+        # Totals of the datapoints at or below it
+        self.has_children = [False] * count
+        self.sums = [None] * count
+
+    def add(self, iteration, checkpoint, process, reporter, value, units):
+        if not self.separator:
+            # Flat datapoints are just the reporter
+            path = reporter
+        elif self.prefixes is not None and (iteration, checkpoint, process) not in self.prefixes:
+            return
+        else:
+            path = "Iteration %u/%s/%s/%s" % (iteration, checkpoint, process, reporter)
+
+        exact = True
+        while True:
+            for target in self.lookup.get(path, ()):
+                self.exists[target] = True
+                if exact:
+                    self.has_value[target] = True
+                    self.target_values[target] = value
+                    self.units[target] = units
+                else:
+                    self.has_children[target] = True
+                if value is not None:
+                    total = self.sums[target]
+                    self.sums[target] = value if total is None else total + value
+            if not self.separator:
+                break
+            path, separator, segment = path.rpartition(self.separator)
+            if not separator:
+                break
+            exact = False
+
+    # Series name -> value, for the datapoints added since reset()
+    def values(self):
+        out = {}
+        for name, targets in self.series.items():
+            value = None
+            for target in targets:
+                if not self.exists[target]:
+                    value = None
+                    continue
+                if not self.separator:
+                    # Flat data is exported as [ 'unit', val ] pairs
+                    value = [self.units[target], self.target_values[target]]
+                    break
+                if self.has_value[target] and not self.has_children[target] and \
+                   self.units[target] == 'bytes':
+                    # NodeTree exports this node as just its value, which
+                    # doesn't count as present if it's 0 or None
+                    value = self.target_values[target]
+                    if value:
+                        break
+                    continue
+                value = self.target_values[target] if self.has_value[target] else self.sums[target]
+                break
+            out[name] = value
+        return out
+
+
+# The default way ConnectionPool opens a database
+def connect(path):
+    return sqlite3.connect(path, timeout=900, check_same_thread=False)
+
+
+# Opens a connection that refuses to write, for ArchiveCache copies
+def connect_read_only(path):
+    sql = connect(path)
+    sql.execute("PRAGMA query_only = ON")
+    return sql
+
+
+# Process-wide pool of database connections, so the tester hook, BenchTester
+# and the export scripts don't reopen (and re-verify) a database for every
+# build:
+#   with gPool.connection(path) as sql:
+#       ...
+# or sql = gPool.checkout(path) ... gPool.checkin(sql). A connection is only
+# used by one thread at a time, but may move between threads.
+#
+# Idle connections are closed once they've been idle for idle_timeout
+# seconds, checked whenever the pool is next used -- there's no timer, so
+# occasional users that mustn't hold up util/archive_db.sh should check in
+# with keep=False. They're also closed when the file they were opened on is
+# replaced or removed. After a fork the child starts with an empty pool, as SQLite
+# connections can't be shared between processes.
+class ConnectionPool():
+
+    def __init__(self, max_idle=2, idle_timeout=60):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        # (path, connect) -> [(sql, identity, idle since)]
+        self.idle = {}
+        # sql -> (path, connect, identity) of checked out connections
+        self.busy = {}
+        # path -> (identity, dict), see cache()
+        self.caches = {}
+
+    # Identifies the file at path, so we notice when it's replaced
+    @staticmethod
+    def _identity(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_dev, st.st_ino)
+
+    def _check_pid(self):
+        # Whatever we have belongs to our parent, leave it alone
+        if os.getpid() != self.pid:
+            self._reset()
+
+    def _prune(self):
+        cutoff = time.time() - self.idle_timeout
+        for key, idle in self.idle.items():
+            for entry in [x for x in idle if x[2] < cutoff]:
+                entry[0].close()
+                idle.remove(entry)
+            if not idle:
+                del self.idle[key]
+
+    # Returns a connection to path, from the pool if there's an idle one,
+    # otherwise opened by connect(path). Connections opened by different
+    # connect functions (e.g. with different pragmas) aren't mixed up.
+    def checkout(self, path, connect=connect):
+        path = os.path.abspath(path)
+        with self.lock:
+            self._check_pid()
+            self._prune()
+            identity = self._identity(path)
+            idle = self.idle.get((path, connect), [])
+            while idle:
+                sql, sql_identity, since = idle.pop()
+                if identity is not None and sql_identity == identity:
+                    self.busy[sql] = (path, connect, identity)
+                    return sql
+                sql.close()
+
+        sql = connect(path)
+        with self.lock:
+            self.busy[sql] = (path, connect, self._identity(path))
+        return sql
+
+    # Returns a connection to the pool, rolling back anything uncommitted, or
+    # closes it if keep is False
+    def checkin(self, sql, keep=True):
+        with self.lock:
+            self._check_pid()
+            entry = self.busy.pop(sql, None)
+        if entry is None:
+            # Not ours, or inherited from our parent
+            return
+        path, connect, identity = entry
+
+        try:
+            sql.rollback()
+        except sqlite3.Error:
+            sql.close()
+            return
+        sql.row_factory = None
+
+        with self.lock:
+            idle = self.idle.setdefault((path, connect), [])
+            if not keep or len(idle) >= self.max_idle or identity is None or \
+               identity != self._identity(path):
+                sql.close()
+            else:
+                idle.append((sql, identity, time.time()))
+            self._prune()
+
+    @contextlib.contextmanager
+    def connection(self, path, connect=connect):
+        sql = self.checkout(path, connect)
+        try:
+            yield sql
+        finally:
+            self.checkin(sql)
+
+    # Closes all idle connections
+    def close_idle(self):
+        with self.lock:
+            self._check_pid()
+            for idle in self.idle.values():
+                for entry in idle:
+                    entry[0].close()
+            self.idle = {}
+
+    # Drops our idle connections to and anything cached about path, for when
+    # it's been changed behind our back
+    def forget(self, path):
+        path = os.path.abspath(path)
+        with self.lock:
+            self._check_pid()
+            for key in [x for x in self.idle if x[0] == path]:
+                for entry in self.idle.pop(key):
+                    entry[0].close()
+            self.caches.pop(path, None)
+
+    # A dict for caching what we know about the database at path, e.g. its
+    # verified schema version. Starts out empty, and again whenever the file
+    # is replaced.
+    def cache(self, path):
+        path = os.path.abspath(path)
+        with self.lock:
+            self._check_pid()
+            identity = self._identity(path)
+            entry = self.caches.get(path)
+            if not entry or entry[0] != identity:
+                entry = (identity, {})
+                self.caches[path] = entry
+            return entry[1]
+
+
+gPool = ConnectionPool()
+
+
+# Serves read-only copies of databases archived by util/archive_db.sh. Archives
+# are decompressed on first use into cachedir, which is kept under max_bytes
+# by evicting the least recently used copies.
+class ArchiveCache():
+
+    def __init__(self, cachedir, max_bytes=4 * 1024 ** 3):
+        self.cachedir = cachedir
+        self.max_bytes = max_bytes
+
+    # Returns the path of a decompressed copy of archive (a .sqlite.xz file)
+    def get(self, archive):
+        name = os.path.basename(archive)
+        if name.endswith('.xz'):
+            name = name[:-3]
+        path = os.path.join(self.cachedir, name)
+        archive_mtime = os.path.getmtime(archive)
+
+        # The mtime of our copy is set to that of the archive it came from, so
+        # we notice if it's replaced
+        if not os.path.exists(path) or int(os.path.getmtime(path)) != int(archive_mtime):
+            if os.path.getsize(archive) == 0:
+                # archive_db.sh and unarchive_db.sh leave empty placeholders
+                raise Exception("Archive %s is empty, is it being (un)archived?" % (archive,))
+            if not os.path.isdir(self.cachedir):
+                os.makedirs(self.cachedir)
+
+            # Decompress to a temporary name, so concurrent readers never see a
+            # partial copy
+            fd, temp = tempfile.mkstemp(prefix='.%s.' % (name,), dir=self.cachedir)
+            try:
+                with os.fdopen(fd, 'wb') as out:
+                    subprocess.check_call(['xz', '-dc', archive], stdout=out)
+                sql = sqlite3.connect(temp)
+                create_indexes(sql.cursor())
+                sql.commit()
+                # Copies are read-only, so don't leave -wal/-shm files behind
+                sql.execute("PRAGMA journal_mode = DELETE")
+                sql.close()
+                os.rename(temp, path)
+            except Exception:
+                if os.path.exists(temp):
+                    os.remove(temp)
+                raise
+            self._evict(path)
+
+        # The access time orders our copies for eviction
+        os.utime(path, (time.time(), archive_mtime))
+        return path
+
+    # Removes the least recently used copies until we're within max_bytes,
+    # other than keep
+    def _evict(self, keep):
+        copies = []
+        for name in os.listdir(self.cachedir):
+            path = os.path.join(self.cachedir, name)
+            if name.startswith('.') or not os.path.isfile(path):
+                continue
+            copies.append((os.path.getatime(path), os.path.getsize(path), path))
+        total = sum(x[1] for x in copies)
+        for atime, size, path in sorted(copies):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            os.remove(path)
+            total -= size
+
+
+# Owns the mapping of builds to the per-month databases, e.g.
+# db/areweslimyet-2015-01.sqlite, and queries that span them. Each query runs
+# against every relevant shard in parallel, with a connection per shard.
+class ShardRouter():
+
+    def __init__(self, dbdir="db", prefix="areweslimyet", threads=4, archive_cache=None,
+                 pool=gPool):
+        self.dbdir = dbdir
+        self.prefix = prefix
+        self.threads = threads
+        # If given, an ArchiveCache used to read archived shards
+        self.archive_cache = archive_cache
+        self.pool = pool
+
+    # The shard a build with the given timestamp belongs in. Note that months
+    # are in local time, matching what the tester has always done.
+    def shard_for_time(self, timestamp):
+        date = datetime.date.fromtimestamp(int(timestamp))
+        return os.path.join(self.dbdir, "%s-%04u-%02u.sqlite" % (self.prefix, date.year,
+                                                                 date.month))
+
+    # Builds tested as part of a custom series get their own database
+    def custom_shard(self, series):
+        return os.path.join(self.dbdir, "custom-%s-x.sqlite" % (series,))
+
+    @staticmethod
+    def is_archived(shard):
+        return os.path.exists("%s.xz" % (shard,))
+
+    # The month covered by a shard, as a (year, month) tuple
+    def _shard_month(self, shard):
+        m = re.match(r'^%s-(\d{4})-(\d{2})\.sqlite$' % (re.escape(self.prefix),),
+                     os.path.basename(shard))
+        return (int(m.group(1)), int(m.group(2))) if m else None
+
+    # All existing monthly shards overlapping the given time range, oldest
+    # first. Archived shards are included if we have an archive cache to read
+    # them through, unless include_archived says otherwise.
+    def shards(self, starttime=None, endtime=None, include_archived=None):
+        if include_archived is None:
+            include_archived = self.archive_cache is not None
+        first = self._shard_month(self.shard_for_time(starttime)) if starttime else None
+        last = self._shard_month(self.shard_for_time(endtime)) if endtime else None
+        ret = set()
+        for name in os.listdir(self.dbdir):
+            if name.endswith('.xz'):
+                name = name[:-3]
+            shard = os.path.join(self.dbdir, name)
+            month = self._shard_month(shard)
+            if not month or (not include_archived and self.is_archived(shard)):
+                continue
+            if (first and month < first) or (last and month > last):
+                continue
+            ret.add((month, shard))
+        return [x[1] for x in sorted(ret)]
+
+    # Whether the shard can be read, directly or through the archive cache
+    def readable(self, shard):
+        return os.path.exists(shard) or \
+            (self.archive_cache is not None and self.is_archived(shard))
+
+    # Checks out a pooled connection for reading a shard, to be returned with
+    # checkin(). Archived shards are read from the archive cache, unless the
+    # database itself is still around (i.e. is being archived or unarchived),
+    # and are always read-only.
+    def checkout(self, shard, read_only=False):
+        if not os.path.exists(shard) and self.is_archived(shard):
+            if not self.archive_cache:
+                raise Exception("%s is archived and we have no archive cache" % (shard,))
+            return self.pool.checkout(self.archive_cache.get("%s.xz" % (shard,)),
+                                      connect_read_only)
+        return self.pool.checkout(shard, connect_read_only if read_only else connect)
+
+    def checkin(self, sql, keep=True):
+        self.pool.checkin(sql, keep)
+
+    @contextlib.contextmanager
+    def connection(self, shard):
+        sql = self.checkout(shard)
+        try:
+            yield sql
+        finally:
+            self.checkin(sql)
+
+    # Runs fn(sql) against each shard in parallel, yielding the results in
+    # shard order as they become available
+    def _fan_out(self, shards, fn):
+        def run(shard):
+            with self.connection(shard) as sql:
+                return fn(sql)
+
+        if len(shards) < 2:
+            for shard in shards:
+                yield run(shard)
+            return
+
+        pool = multiprocessing.pool.ThreadPool(min(self.threads, len(shards)))
+        try:
+            for result in pool.imap(run, shards):
+                yield result
+        finally:
+            pool.terminate()
+
+    # The latest successful run of testname against the given build, as a dict
+    # of shard, test_id, time. If buildtime is given only that build's shard is
+    # searched. Returns None if the build has no such test.
+    def latest_test(self, buildname, testname, buildtime=None):
+        if buildtime is not None:
+            shards = [x for x in [self.shard_for_time(buildtime)] if self.readable(x)]
+        else:
+            shards = self.shards()
+
+        def query(sql):
+            return sql.execute(gQueries['latest_test_by_build_name'],
+                               [buildname, testname]).fetchone()
+
+        best = None
+        for shard, row in zip(shards, self._fan_out(shards, query)):
+            if row and (not best or row[1] > best['time']):
+                best = {'shard': shard, 'test_id': row[0], 'time': row[1]}
+        return best
+
+    # Yields (buildtime, buildname, value) for the given datapoint of the latest
+    # successful run of testname on each build between starttime and endtime,
+    # sorted by build time. datapoint is a full path as accepted by
+    # parse_datapoint().
+    def series(self, testname, datapoint, starttime=None, endtime=None):
+        iteration, checkpoint, process, reporter = parse_datapoint(datapoint)
+        lo = starttime if starttime is not None else 0
+        hi = endtime if endtime is not None else sys.maxint
+
+        def query(sql):
+            version = db_version(sql.cursor())
+            ids = []
+            for table, name in [('benchtester_checkpoints', checkpoint),
+                                ('benchtester_procs', process),
+                                ('benchtester_datapoints', reporter)]:
+                row = sql.execute("SELECT `id` FROM `%s` WHERE `name` = ?" % (table,),
+                                  [name]).fetchone()
+                if not row:
+                    return []
+                ids.append(row[0])
+            checkpoint_id, proc_id, datapoint_id = ids
+
+            builds = sql.execute(gQueries['series_builds'], [testname, lo, hi]).fetchall()
+            ret = []
+            for buildtime, buildname, test_id in builds:
+                if test_id is None:
+                    continue
+                if version >= 3:
+                    value = None
+                    key = (checkpoint_id, iteration)
+                    # Walk back through the base rows until one has the value
+                    while key[0] is not None:
+                        row = sql.execute(gQueries['deduped_value'],
+                                          [test_id, key[0], proc_id, key[1]]).fetchone()
+                        if not row:
+                            break
+                        entry = next((e for e in unpack_reports(*row[:4])
+                                      if e[0] == datapoint_id), None)
+                        if entry:
+                            value = entry[1] if entry[3] != gRemovedKind else None
+                            break
+                        key = row[4:6]
+                elif version >= 2:
+                    row = sql.execute(gQueries['packed_value'],
+                                      [test_id, checkpoint_id, proc_id, iteration]).fetchone()
+                    entries = unpack_reports(*row) if row else []
+                    value = next((e[1] for e in entries if e[0] == datapoint_id), None)
+                else:
+                    row = sql.execute(gQueries['value'],
+                                      [test_id, datapoint_id, checkpoint_id, proc_id,
+                                       iteration]).fetchone()
+                    value = row[0] if row else None
+                ret.append((buildtime, buildname, value))
+            return ret
+
+        # Shards cover disjoint months, so their results are already in order
+        for rows in self._fan_out(self.shards(starttime, endtime), query):
+            for row in rows:
+                yield row
+
+#
+# Main
+#
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query the per-month results databases')
+    parser.add_argument('--dbdir', default='db',
+                        help='Directory holding the databases')
+    commands = parser.add_subparsers(dest='command')
+    shards = commands.add_parser('shards', help='List the monthly databases, oldest first')
+    shards.add_argument('--archived', action='store_true',
+                        help='Include archived databases')
+    indexes = commands.add_parser('indexes',
+                                  help='Create or upgrade the indexes of the given databases')
+    indexes.add_argument('databases', nargs='+')
+    explain = commands.add_parser('explain',
+                                  help='Check the query plans of the per-build queries, '
+                                       'listing any that scan a table or sort')
+    explain.add_argument('databases', nargs='*',
+                         help='Databases to check, defaults to every monthly database')
+    trim = commands.add_parser('trim-datapoints',
+                               help='Remove the datapoint names no data in the given '
+                                    'databases refers to')
+    trim.add_argument('databases', nargs='+')
+    args = parser.parse_args()
+
+    if args.command == 'shards':
+        for shard in ShardRouter(args.dbdir).shards(include_archived=args.archived):
+            print(shard)
+    elif args.command == 'indexes':
+        for database in args.databases:
+            sql = sqlite3.connect(database, timeout=900)
+            upgraded = create_indexes(sql.cursor())
+            sql.commit()
+            sql.close()
+            print("%s: %s index version %u" % (
+                database, "upgraded to" if upgraded else "already at", gIndexVersion))
+    elif args.command == 'explain':
+        failed = False
+        for database in args.databases or ShardRouter(args.dbdir).shards():
+            sql = sqlite3.connect(database, timeout=900)
+            version = sql.execute("PRAGMA user_version").fetchone()[0]
+            problems = check_query_plans(sql)
+            sql.close()
+            print("%s: index version %u%s, %s" % (
+                database, version, " (outdated)" if version < gIndexVersion else "",
+                "%u problem(s)" % (len(problems),) if problems else "ok"))
+            for name, detail in problems:
+                print("  %s: %s" % (name, detail))
+            failed = failed or bool(problems)
+        sys.exit(1 if failed else 0)
+    elif args.command == 'trim-datapoints':
+        for database in args.databases:
+            sql = sqlite3.connect(database, timeout=900)
+            removed = remove_unreferenced_datapoints(sql)
+            sql.commit()
+            sql.close()
+            print("%s: removed %u unreferenced datapoints" % (database, removed))
@@ -20,8 +20,28 @@ import time
 
 from mozlog.structured import commandline
 
-# Database version, bump this when incompatible DB changes are made
-gVersion = 1
+import BenchDB
+
+# Database version, bump this when incompatible DB changes are made. Version 1
+# stores a benchtester_data row per datapoint, version 2 packs each process's
+# reports into a single benchtester_packed_data row, and version 3 lets those
+# rows only hold the values that changed since an earlier one (--dedup-values).
+# New databases are created with gVersion, but we can still add tests to any of
+# gSupportedVersions.
+gVersion = 3
+gSupportedVersions = [1, 2, 3]
+
+# Pragmas applied to every connection made by connect_db()
+gPragmas = [
+    # Lets create_graph_json.py and friends read while a tester is writing
+    "PRAGMA journal_mode = WAL",
+    # With WAL this only risks the last transaction on power loss, never
+    # corruption
+    "PRAGMA synchronous = NORMAL",
+    # 64MiB page cache
+    "PRAGMA cache_size = -65536",
+    "PRAGMA temp_store = MEMORY"
+]
 
 gTableSchemas = [
     # benchtester_version - the database version, can be used for upgrade
@@ -75,13 +95,120 @@ gTableSchemas = [
                           "units" INTEGER NOT NULL,
                           "kind" INTEGER NOT NULL)''',
 
-    # Some default indexes
-    '''CREATE INDEX IF NOT EXISTS
-       test_lookup ON benchtester_tests ( name, build_id DESC )''',
-    '''CREATE INDEX IF NOT EXISTS
-       data_for_test ON benchtester_data ( test_id DESC, datapoint_id )'''
+    # Packed data - one row per test/checkpoint/process/iteration, with the
+    # datapoint ids, values, units and kinds packed by BenchDB.pack_reports().
+    # Used instead of benchtester_data by version 2 databases. In version 3, a
+    # row with a base_checkpoint_id and base_iteration only holds the values
+    # that differ from that row of the same test and process, see
+    # BenchDB.diff_reports().
+    '''CREATE TABLE IF NOT EXISTS
+      "benchtester_packed_data" ("test_id" INTEGER NOT NULL,
+                                 "checkpoint_id" INTEGER NOT NULL,
+                                 "proc_id" INTEGER NOT NULL,
+                                 "iteration" INTEGER NOT NULL,
+                                 "datapoint_ids" BLOB NOT NULL,
+                                 "values" BLOB NOT NULL,
+                                 "units" BLOB NOT NULL,
+                                 "kinds" BLOB NOT NULL,
+                                 "base_checkpoint_id" INTEGER,
+                                 "base_iteration" INTEGER)''',
+
+    # Revisions - mercurial revision numbers of builds, filled in by
+    # create_graph_json.py to order builds with identical timestamps
+    '''CREATE TABLE IF NOT EXISTS
+      "benchtester_revisions" ("name" VARCHAR PRIMARY KEY NOT NULL,
+                               "rev" INTEGER NOT NULL)''',
+
+    # Changes - builds that were added, removed, or gained or lost tests, so
+    # create_graph_json.py only needs to re-export those. Kept up to date by the
+    # triggers below, so the util/ scripts editing databases by hand are covered
+    # too.
+    '''CREATE TABLE IF NOT EXISTS
+      "benchtester_changes" ("id" INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+                             "build_name" VARCHAR NOT NULL)'''
+] + [
+    '''CREATE TRIGGER IF NOT EXISTS "benchtester_changes_%s" AFTER %s
+       BEGIN
+         INSERT INTO "benchtester_changes" ("build_name") %s;
+       END''' % trigger for trigger in [
+        ('test_insert', 'INSERT ON "benchtester_tests"',
+         'SELECT "name" FROM "benchtester_builds" WHERE "id" = NEW."build_id"'),
+        ('test_update', 'UPDATE ON "benchtester_tests"',
+         'SELECT "name" FROM "benchtester_builds" WHERE "id" IN (OLD."build_id", NEW."build_id")'),
+        ('test_delete', 'DELETE ON "benchtester_tests"',
+         'SELECT "name" FROM "benchtester_builds" WHERE "id" = OLD."build_id"'),
+        ('build_insert', 'INSERT ON "benchtester_builds"', 'VALUES (NEW."name")'),
+        ('build_update', 'UPDATE ON "benchtester_builds"',
+         'SELECT OLD."name" UNION SELECT NEW."name"'),
+        ('build_delete', 'DELETE ON "benchtester_builds"', 'VALUES (OLD."name")')
+    ]
 ]
 
+# The names of the tables and triggers gTableSchemas creates
+gSchemaObjects = [re.search(r'IF NOT EXISTS\s+"(\w+)"', schema).group(1)
+                  for schema in gTableSchemas]
+
+
+# Opens a connection to a results database with our standard pragmas. Used
+# through BenchDB.gPool, so the connection may move between threads.
+def connect_db(path, timeout=900):
+    sql = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+    for pragma in gPragmas:
+        sql.execute(pragma)
+    return sql
+
+
+# Caches the name -> id mapping of one of the name tables (datapoints, procs,
+# checkpoints) for the lifetime of a database file, so inserting results doesn't
+# need an index lookup per row. Names missing from the table are given ids
+# locally, which is only safe while holding the database write lock with the
+# cache freshly refreshed -- see BenchTester._begin_write()
+class IdCache():
+
+    def __init__(self, table):
+        self.table = table
+        self.ids = {}
+        self.last_id = 0
+
+    def __getitem__(self, name):
+        return self.ids[name]
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    # Forget everything, e.g. after a rollback discarded ids we handed out
+    def reset(self):
+        self.ids = {}
+        self.last_id = 0
+
+    # Ids only ever grow, so just load whatever was added since we last looked
+    def refresh(self, cur):
+        cur.execute("SELECT `id`, `name` FROM `%s` WHERE `id` > ?" % (self.table,),
+                    (self.last_id, ))
+        for row in cur.fetchall():
+            self.ids[row[1]] = row[0]
+            self.last_id = max(self.last_id, row[0])
+        # AUTOINCREMENT never reuses ids of deleted rows, neither should we
+        cur.execute("SELECT `seq` FROM `sqlite_sequence` WHERE `name` = ?",
+                    (self.table, ))
+        row = cur.fetchone()
+        if row and row[0] > self.last_id:
+            self.last_id = row[0]
+
+    # Ensures all of names have an id, inserting any new ones. Returns the number
+    # of names added.
+    def intern(self, cur, names):
+        new = []
+        for name in names:
+            if name not in self.ids:
+                self.last_id += 1
+                self.ids[name] = self.last_id
+                new.append((self.last_id, name))
+        if new:
+            cur.executemany("INSERT INTO `%s` (`id`, `name`) VALUES (?, ?)" % (self.table,),
+                            new)
+        return len(new)
+
 # TODO:
 # - doxygen or at least some sort of documentation
 # - Add indexes to sqlitedb by default
@@ -198,73 +325,132 @@ class BenchTester():
 
         return proc_name_mapping
 
+    # Takes the write lock and brings the id caches up to date. Must be called
+    # before interning names, as new ids are handed out locally and would
+    # otherwise collide with those added by other testers sharing the database.
+    def _begin_write(self):
+        self._end_write()
+        cur = self.sqlite.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        self.write_began = time.time()
+        for cache in self.id_caches.values():
+            cache.refresh(cur)
+        return cur
+
+    # Commits (or rolls back) the current write, tallying how long we held the
+    # write lock in self.lock_time
+    def _end_write(self, commit=True):
+        if commit:
+            self.sqlite.commit()
+        else:
+            self.sqlite.rollback()
+        if self.write_began is not None:
+            self.lock_time += time.time() - self.write_began
+            self.write_began = None
+
     def insert_results(self, test_id, results):
         # - results is an array of iterations
         # - iterations is an array of checkpoints
         # - checkpoint is a dict with: label, reports
         # - reports is a dict of processes
-        cur = self.sqlite.cursor()
-
         for x, iteration in enumerate(results):
-            iternum = x + 1
             for checkpoint in iteration:
-                label = checkpoint['label']
+                self.insert_checkpoint(test_id, x + 1, checkpoint)
 
-                # insert checkpoint name, get checkpoint_id
-                cur.execute(
-                    "SELECT id FROM benchtester_checkpoints WHERE name = ?", (label, ))
-                row = cur.fetchone()
-                checkpoint_id = row[0] if row else None
-                if checkpoint_id is None:
-                    cur.execute(
-                        "INSERT INTO benchtester_checkpoints(name) VALUES (?)", (label, ))
-                    checkpoint_id = cur.lastrowid
-
-                proc_name_mapping = self.map_process_names(
-                    checkpoint['reports'])
-                for process_name, reports in checkpoint['reports'].iteritems():
-                    # reports is a dictionary of datapoint_name: { val, unit,
-                    # kind }
-                    process_name = proc_name_mapping[process_name]
+    # In the 'atomic' ingest mode the caller holds the write lock for the whole
+    # checkpoint, otherwise every process is written in its own transaction
+    def insert_checkpoint(self, test_id, iternum, checkpoint):
+        atomic = self.args.get('ingest_mode') == 'atomic'
+        cur = self.sqlite.cursor()
+        label = checkpoint['label']
+
+        proc_name_mapping = self.map_process_names(checkpoint['reports'])
+        for process_name, reports in checkpoint['reports'].iteritems():
+            # reports is a dictionary of datapoint_name: { val, unit, kind }
+            process_name = proc_name_mapping[process_name]
+
+            if not atomic:
+                cur = self._begin_write()
+            self.insert_reports(cur, test_id, iternum, label,
+                                process_name, reports)
+            if not atomic:
+                self._end_write()
+
+    # Inserts one process's reports for one checkpoint. The write lock must be
+    # held.
+    def insert_reports(self, cur, test_id, iternum, label, process_name, reports):
+        checkpoints = self.id_caches['checkpoints']
+        procs = self.id_caches['procs']
+        datapoints = self.id_caches['datapoints']
+
+        # insert checkpoint, process and datapoint names
+        insertbegin = time.time()
+        checkpoints.intern(cur, [label])
+        procs.intern(cur, [process_name])
+        added = datapoints.intern(cur, reports.iterkeys())
+        self.info("Filled %u new datapoint names in %.02fs" %
+                  (added, time.time() - insertbegin))
+
+        # insert datapoint values
+        insertbegin = time.time()
+        self.info("Inserting %u datapoints into DB" % len(reports))
+        checkpoint_id = checkpoints[label]
+        process_id = procs[process_name]
+        if self.db_version >= 3:
+            values = dict((datapoints[name], (dp['val'], dp['unit'], dp['kind']))
+                          for name, dp in reports.iteritems() if dp)
+            entries = [(k,) + v for k, v in values.iteritems()]
+            base = (None, None)
+            if self.args.get('dedup_values'):
+                # Store only what changed since this process's previous
+                # checkpoint, if that's any smaller
+                last = self.last_reports.get((test_id, process_id))
+                if last and last[:2] != (checkpoint_id, iternum):
+                    diff = BenchDB.diff_reports(last[2], values)
+                    if len(diff) < len(entries):
+                        entries = diff
+                        base = last[:2]
+                self.last_reports[(test_id, process_id)] = (checkpoint_id, iternum, values)
+            cur.execute("INSERT INTO `benchtester_packed_data` "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (test_id, checkpoint_id, process_id, iternum) +
+                        tuple(sqlite3.Binary(x) for x in BenchDB.pack_reports(entries)) +
+                        base)
+        else:
+            cur.executemany("INSERT INTO `benchtester_data` "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            ((test_id,
+                              datapoints[name],
+                              checkpoint_id,
+                              process_id,
+                              iternum,
+                              dp['val'],
+                              dp['unit'],
+                              dp['kind'])
+                             for name, dp in reports.iteritems() if dp))
+        self.info("Filled datapoint values in %.02fs" %
+                  (time.time() - insertbegin))
+
+    # Rolls back a failed write, logging the exception
+    def _write_failed(self, e):
+        self.error(
+            "Failed to insert data into sqlite, got '%s': %s" % (type(e), e))
+        import traceback
+        traceback.print_exc()
+        self._end_write(commit=False)
+        for cache in self.id_caches.values():
+            cache.reset()
+        # The rows these refer to may be gone
+        self.last_reports = {}
+        return False
 
-                    # insert process name, get process_id
-                    cur.execute(
-                        "SELECT id FROM benchtester_procs WHERE name = ?", (process_name, ))
-                    row = cur.fetchone()
-                    process_id = row[0] if row else None
-                    if process_id is None:
-                        cur.execute(
-                            "INSERT INTO benchtester_procs(name) VALUES (?)", (process_name, ))
-                        process_id = cur.lastrowid
-
-                    # insert datapoint names
-                    insertbegin = time.time()
-                    self.info("Inserting %u datapoints into DB" % len(reports))
-                    cur.executemany("INSERT OR IGNORE INTO `benchtester_datapoints`(name) "
-                                    "VALUES (?)",
-                                    ([k] for k in reports.iterkeys()))
-                    self.sqlite.commit()
-                    self.info("Filled datapoint names in %.02fs" %
-                              (time.time() - insertbegin))
-
-                    # insert datapoint values
-                    insertbegin = time.time()
-                    cur.executemany("INSERT INTO `benchtester_data` "
-                                    "SELECT ?, p.id, ?, ?, ?, ?, ?, ? "
-                                    "FROM `benchtester_datapoints` p "
-                                    "WHERE p.name = ?",
-                                    ([test_id,
-                                        checkpoint_id,
-                                        process_id,
-                                        iternum,
-                                        dp['val'],
-                                        dp['unit'],
-                                        dp['kind'],
-                                        name]
-                                     for name, dp in reports.iteritems() if dp))
-                    self.sqlite.commit()
-                    self.info("Filled datapoint values in %.02fs" %
-                              (time.time() - insertbegin))
+    def _insert_test(self, cur, testname, succeeded):
+        self.last_reports = {}
+        cur.execute("INSERT INTO "
+                    "  benchtester_tests(name, time, build_id, successful) "
+                    "VALUES (?, ?, ?, ?)",
+                    (testname, int(time.time()), self.build_id, succeeded))
+        return cur.lastrowid
 
     # datapoints a list of the format [ [ "key", value, "meta"], ... ].
     # Duplicate keys are allowed. Value is numeric and required, meta is an
@@ -280,24 +466,70 @@ class BenchTester():
         timestamp = time.time()
 
         if self.sqlite:
+            self.lock_time = 0
             try:
-                cur = self.sqlite.cursor()
-                cur.execute("INSERT INTO "
-                            "  benchtester_tests(name, time, build_id, successful) "
-                            "VALUES (?, ?, ?, ?)",
-                            (testname, int(timestamp), self.build_id, succeeded))
-                cur.execute("SELECT last_insert_rowid()")
+                cur = self._begin_write()
+                testid = self._insert_test(cur, testname, succeeded)
 
                 if datapoints:
-                    testid = cur.fetchone()[0]
                     self.insert_results(testid, datapoints)
+                self._end_write()
             except Exception, e:
-                self.error(
-                    "Failed to insert data into sqlite, got '%s': %s" % (type(e), e))
-                import traceback
-                traceback.print_exc()
-                self.sqlite.rollback()
-                return False
+                return self._write_failed(e)
+            self.info("Ingested test '%s' in %.02fs (%s mode), held the write lock for %.02fs" %
+                      (testname, time.time() - timestamp, self.args.get('ingest_mode'),
+                       self.lock_time))
+        return True
+
+    # Streaming alternative to add_test_results, for modules that can hand us
+    # checkpoints as they are taken:
+    #   test_id = tester.begin_test(name)
+    #   tester.add_checkpoint(test_id, iteration, checkpoint)  # for each
+    #   tester.end_test(test_id, succeeded)
+    # The test is recorded as unsuccessful until end_test() says otherwise, so
+    # a run that dies part way through keeps the checkpoints it got.
+    # Returns the test id, or None on failure or if we aren't logging to sqlite
+    def begin_test(self, testname):
+        if not self._open_db():
+            self.error("Failed to open sqlite database")
+            return None
+
+        if not self.sqlite:
+            return None
+
+        try:
+            cur = self._begin_write()
+            testid = self._insert_test(cur, testname, False)
+            self._end_write()
+        except Exception, e:
+            return self._write_failed(e) or None
+        self.info("Began streaming test '%s' (%u)" % (testname, testid))
+        return testid
+
+    # Writes a single checkpoint of a test created by begin_test(). iternum is
+    # 1-based.
+    def add_checkpoint(self, test_id, iternum, checkpoint):
+        timestamp = time.time()
+        self.lock_time = 0
+        try:
+            self._begin_write()
+            self.insert_checkpoint(test_id, iternum, checkpoint)
+            self._end_write()
+        except Exception, e:
+            return self._write_failed(e)
+        self.info("Ingested checkpoint '%s' of iteration %u in %.02fs, held the write "
+                  "lock for %.02fs" % (checkpoint['label'], iternum,
+                                       time.time() - timestamp, self.lock_time))
+        return True
+
+    def end_test(self, test_id, succeeded=True):
+        try:
+            cur = self._begin_write()
+            cur.execute("UPDATE `benchtester_tests` SET `successful` = ? WHERE `id` = ?",
+                        (succeeded, test_id))
+            self._end_write()
+        except Exception, e:
+            return self._write_failed(e)
         return True
 
     def __init__(self, logfile=None, out=sys.stdout):
@@ -314,6 +546,13 @@ class BenchTester():
         self.buildtime = None
         self.buildname = None
         self.sqlite = False
+        self.db_version = None
+        self.id_caches = {}
+        self.write_began = None
+        self.lock_time = 0
+        # (test_id, proc_id) -> (checkpoint_id, iteration, values) of the last
+        # row written, for --dedup-values
+        self.last_reports = {}
         self.errors = []
         self.warnings = []
 
@@ -348,6 +587,17 @@ class BenchTester():
                           help='Log to given file')
         self.add_argument('-s', '--sqlitedb',
                           help='Merge datapoint into specified sqlite database')
+        self.add_argument('--ingest-mode',
+                          help="How to write test results to the sqlite database. 'atomic' \
+                                writes each test in a single transaction, 'process' commits \
+                                each process of each checkpoint separately",
+                          choices=['atomic', 'process'],
+                          default='atomic')
+        self.add_argument('--dedup-values',
+                          help="Only store the values that changed since the same process's \
+                                previous checkpoint, for version 3 databases",
+                          action='store_true',
+                          default=False)
 
         self.info("BenchTester instantiated")
 
@@ -381,7 +631,72 @@ class BenchTester():
     def __del__(self):
         # In case we exception out mid transaction or something
         if (hasattr(self, 'sqlite') and self.sqlite):
-            self.sqlite.rollback()
+            self.close_db()
+
+    # Hands our connection back to the pool, rolling back anything uncommitted.
+    # The next write reopens it.
+    def close_db(self):
+        if self.sqlite:
+            BenchDB.gPool.checkin(self.sqlite)
+            self.sqlite = False
+
+    # Whether the database already has everything in gTableSchemas and
+    # BenchDB.gIndexes, at the current index version
+    @staticmethod
+    def schema_current(cur):
+        if cur.execute("PRAGMA user_version").fetchone()[0] < BenchDB.gIndexVersion:
+            return False
+        names = set(row[0] for row in cur.execute("SELECT `name` FROM `sqlite_master`"))
+        return all(x in names for x in gSchemaObjects) and \
+            all(x[0] in names for x in BenchDB.gIndexes)
+
+    # Brings the database at self.args['sqlitedb'] up to date with our schema.
+    # _open_db only does this once per file per process, util/bulk_load.py
+    # once per load. Returns its version, or None if we can't write to it.
+    def verify_db(self, cur, db_exists):
+        if db_exists:
+            # make sure we know how to write to this version
+            db_version = BenchDB.db_version(cur)
+            if db_version not in gSupportedVersions:
+                self.error("Incompatible versions: %s is version %s, supported versions are %s" % (
+                    self.args['sqlitedb'], db_version, gSupportedVersions))
+                return None
+            # Nothing to create or upgrade, so just read the schema. BatchTester
+            # runs each test in a fresh process, whose pool has nothing cached,
+            # so this is the usual case.
+            if db_version != 2 and self.schema_current(cur):
+                return db_version
+        else:
+            db_version = gVersion
+
+        for schema in gTableSchemas:
+            cur.execute(schema)
+
+        # Version 3 just adds the base row columns, so upgrade version 2
+        # databases in place. Only version 1 databases are written in an
+        # older format.
+        if db_version == 2:
+            columns = [row[1] for row in
+                       cur.execute("PRAGMA table_info(`benchtester_packed_data`)")]
+            for column in ['base_checkpoint_id', 'base_iteration']:
+                if column not in columns:
+                    cur.execute("ALTER TABLE `benchtester_packed_data` "
+                                "ADD COLUMN `%s` INTEGER" % (column,))
+            cur.execute("INSERT OR IGNORE INTO `benchtester_version` (`version`) VALUES (?)", [3])
+            db_version = 3
+            self.info("Upgraded %s to version 3" % (self.args['sqlitedb'],))
+
+        # Existing databases may have an older index set, which this
+        # rebuilds. Slow on a full month, but only happens once.
+        index_start = time.time()
+        if BenchDB.create_indexes(cur) and db_exists:
+            self.info("Upgraded %s to index version %u in %.02fs" % (
+                self.args['sqlitedb'], BenchDB.gIndexVersion, time.time() - index_start))
+
+        if not db_exists:
+            cur.execute(
+                "INSERT INTO `benchtester_version` (`version`) VALUES (?)", [gVersion])
+        return db_version
 
     def _open_db(self):
         if not self.args['sqlitedb'] or self.sqlite:
@@ -396,38 +711,43 @@ class BenchTester():
             db_exists = os.path.exists(self.args['sqlitedb'])
 
             sql_path = os.path.abspath(self.args['sqlitedb'])
-            self.sqlite = sqlite3.connect(sql_path, timeout=900)
+            self.sqlite = BenchDB.gPool.checkout(sql_path, connect_db)
             cur = self.sqlite.cursor()
 
-            if db_exists:
-                # make sure the version matches
-                cur.execute(
-                    "SELECT `version` FROM `benchtester_version` WHERE `version` = ?", [gVersion])
-                row = cur.fetchone()
-                version = row[0] if row else None
-                if version != gVersion:
-                    self.error("Incompatible versions: %s is version %s, current version is %s" % (
-                        self.args['sqlitedb'], version, gVersion))
+            # Other testers in this process may have already checked the schema
+            # and looked up our repo
+            cache = BenchDB.gPool.cache(sql_path)
+            db_version = cache.get('db_version')
+            if db_version is None:
+                db_version = self.verify_db(cur, db_exists)
+                if db_version is None:
+                    self.close_db()
                     self.sqlitedb = self.args['sqlitedb'] = None
                     return False
+            self.db_version = db_version
+            if self.args.get('dedup_values') and self.db_version < 3:
+                self.warn("%s is version %u, ignoring --dedup-values" % (
+                    self.args['sqlitedb'], self.db_version))
 
-            for schema in gTableSchemas:
-                cur.execute(schema)
-
-            if not db_exists:
-                cur.execute(
-                    "INSERT INTO `benchtester_version` (`version`) VALUES (?)", [gVersion])
+            self.id_caches = cache.get('id_caches') or {
+                'checkpoints': IdCache('benchtester_checkpoints'),
+                'procs': IdCache('benchtester_procs'),
+                'datapoints': IdCache('benchtester_datapoints')
+            }
 
             # Create/update the repo
-            cur.execute(
-                "SELECT `id` FROM `benchtester_repos` WHERE `name` = ?", [self.repo])
-            row = cur.fetchone()
-            if row:
-                repo_id = int(row[0])
-            else:
+            repo_ids = cache.get('repo_ids', {})
+            repo_id = repo_ids.get(self.repo)
+            if repo_id is None:
                 cur.execute(
-                    "INSERT INTO benchtester_repos(name) VALUES (?)", (self.repo, ))
-                repo_id = cur.lastrowid
+                    "SELECT `id` FROM `benchtester_repos` WHERE `name` = ?", [self.repo])
+                row = cur.fetchone()
+                if row:
+                    repo_id = int(row[0])
+                else:
+                    cur.execute(
+                        "INSERT INTO benchtester_repos(name) VALUES (?)", (self.repo, ))
+                    repo_id = cur.lastrowid
 
             # Create/update build ID
             cur.execute("SELECT `time`, `id` FROM `benchtester_builds` WHERE `name` = ?", [
@@ -452,9 +772,16 @@ class BenchTester():
                 self.build_id = buildrow[1]
                 self.info("Found build record")
             self.sqlite.commit()
+
+            # Only cache what's committed
+            cache['db_version'] = self.db_version
+            cache['id_caches'] = self.id_caches
+            repo_ids[self.repo] = repo_id
+            cache['repo_ids'] = repo_ids
         except Exception, e:
             self.error(
                 "Failed to setup sqliteDB '%s': %s - %s\n" % (self.args['sqlitedb'], type(e), e))
+            self.close_db()
             self.sqlitedb = self.args['sqlitedb'] = None
             return False
 
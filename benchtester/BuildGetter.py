@@ -142,6 +142,10 @@ class Build():
         """Requires prepare()'d"""
         raise NotImplementedError()
 
+    def get_size(self):
+        """Bytes the prepare()'d build takes up on disk, or None if unknown"""
+        return None
+
 
 class DownloadedBuild(Build):
     """Base class with shared helpers for Tinderbox, Nightly, and Try builds"""
@@ -274,6 +278,15 @@ class DownloadedBuild(Build):
     def get_buildtime(self):
         return self._timestamp
 
+    def get_size(self):
+        if not self._prepared:
+            return 0
+        size = 0
+        for root, dirs, files in os.walk(self._extracted):
+            for name in files:
+                size += os.lstat(os.path.join(root, name)).st_size
+        return size
+
 
 class CompileBuild(Build):
     """
@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Condenses the series create_graph_json.py exports to one point per UTC day
+# (or week, or month), for merge_graph_json.py's overview file:
+#   condense_data({'builds': [...], 'series': {...}}, aggregates=['p10', 'p90'])
+# Each day's value of a series is its median, or [min, median, max] if the
+# minimum differs. The extra aggregates asked for are returned separately.
+#
+# With NumPy installed, all of a series' days are done in one go: the builds
+# are bucketed by day as a whole array, laid out a day per row, and each row
+# sorted with the missing values masked out as NaN. Without it, the same is
+# done a day at a time.
+#
+# The condensed sub-series are then joined up a file at a time with Chunker
+# and ColumnSpool, which only keep a chunk of the result in memory.
+
+import calendar
+import datetime
+import json
+import os
+import shutil
+import tempfile
+
+import GraphJSON
+
+# Optional, but much faster
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+gDay = 60 * 60 * 24
+gWeek = 7 * gDay
+# Weeks start on Mondays, the epoch was a Thursday
+gWeekStart = 4 * gDay
+
+# The levels series can be condensed to, coarsest first, with their (nominal,
+# for months) length in seconds
+gLevels = [('month', 30 * gDay), ('week', gWeek), ('day', gDay)]
+
+
+# The extra aggregates: percentiles, taking the nearest rank below, and the
+# mean
+gPercentiles = {'p10': 10, 'p90': 90}
+gAggregates = sorted(gPercentiles.keys() + ['mean'])
+
+
+# The timestamp of the build's day at midnight UTC
+def dayof(timestamp):
+    return int(timestamp // gDay * gDay)
+
+
+# The timestamp of the start of the build's day, week or month
+def periodof(timestamp, level='day'):
+    if level == 'week':
+        return int((timestamp - gWeekStart) // gWeek * gWeek + gWeekStart)
+    if level == 'month':
+        date = datetime.datetime.utcfromtimestamp(timestamp)
+        return calendar.timegm((date.year, date.month, 1, 0, 0, 0))
+    return dayof(timestamp)
+
+
+# The condensed builds entry for builds[start:end + 1], all from one period
+def _build_entry(builds, start, end, level):
+    build = {'firstrev': builds[start]['revision'], 'time': builds[start]['time']}
+    if start != end:
+        build['time'] = periodof(build['time'], level)
+        build['count'] = end - start + 1
+        build['lastrev'] = builds[end]['revision']
+        build['timerange'] = [builds[start]['time'], builds[end]['time']]
+    return build
+
+
+# The (start, end) indexes of each period's builds
+def _period_ranges(builds, level):
+    ranges = []
+    start = 0
+    for i in range(1, len(builds)):
+        if periodof(builds[i]['time'], level) != periodof(builds[start]['time'], level):
+            ranges.append((start, i - 1))
+            start = i
+    if builds:
+        ranges.append((start, len(builds) - 1))
+    return ranges
+
+
+def _condense_python(data, aggregates, level):
+    ranges = _period_ranges(data['builds'], level)
+    series = {}
+    extra = dict((name, {}) for name in aggregates)
+    for sname, values in data['series'].iteritems():
+        series[sname] = []
+        for name in aggregates:
+            extra[name][sname] = []
+        for start, end in ranges:
+            day = sorted(x for x in values[start:end + 1] if x is not None)
+            if not day:
+                series[sname].append(None)
+                for name in aggregates:
+                    extra[name][sname].append(None)
+                continue
+            median = day[len(day) // 2]
+            series[sname].append(median if day[0] == median else [day[0], median, day[-1]])
+            for name in aggregates:
+                if name == 'mean':
+                    extra[name][sname].append(sum(day) / float(len(day)))
+                else:
+                    extra[name][sname].append(day[(len(day) - 1) * gPercentiles[name] // 100])
+    return ranges, series, extra
+
+
+def _condense_numpy(data, aggregates, level):
+    builds = data['builds']
+    count = len(builds)
+    times = numpy.array([build['time'] for build in builds], dtype=numpy.float64)
+    if level == 'month':
+        periods = numpy.floor(times).astype(numpy.int64).astype('datetime64[s]')
+        periods = periods.astype('datetime64[M]').astype(numpy.int64)
+    elif level == 'week':
+        periods = numpy.floor_divide(times - gWeekStart, gWeek)
+    else:
+        periods = numpy.floor_divide(times, gDay)
+    starts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(periods)) + 1))
+    ends = numpy.append(starts[1:], count) - 1
+    ranges = zip(starts.tolist(), ends.tolist())
+    rows = numpy.arange(len(starts))
+
+    # The build indexes laid out a day per row, padded out with the index
+    # past the end, which holds NaN
+    grid = starts[:, None] + numpy.arange((ends - starts).max() + 1)[None, :]
+    grid = numpy.where(grid <= ends[:, None], grid, count)
+
+    series = {}
+    extra = dict((name, {}) for name in aggregates)
+    for sname, values in data['series'].iteritems():
+        # None becomes NaN, which marks missing values
+        values = numpy.append(numpy.array(values, dtype=numpy.float64), numpy.nan)
+        present = ~numpy.isnan(values)
+        integral = numpy.array_equal(values[present], numpy.floor(values[present]))
+        # Each day's values sorted, NaNs last
+        day_values = numpy.sort(values[grid], axis=1)
+        counts = (~numpy.isnan(day_values)).sum(axis=1)
+        last = numpy.maximum(counts - 1, 0)
+        empty = (counts == 0).tolist()
+
+        def pick(columns):
+            picked = day_values[rows, columns]
+            if integral:
+                picked = numpy.where(numpy.isnan(picked), 0, picked).astype(numpy.int64)
+            return picked.tolist()
+
+        mins = pick(0)
+        medians = pick(counts // 2)
+        maxes = pick(last)
+        series[sname] = [None if none else median if low == median else [low, median, high]
+                         for none, low, median, high in zip(empty, mins, medians, maxes)]
+
+        for name in aggregates:
+            if name == 'mean':
+                sums = numpy.where(numpy.isnan(day_values), 0, day_values).sum(axis=1)
+                result = (sums / numpy.maximum(counts, 1)).tolist()
+            else:
+                result = pick(last * gPercentiles[name] // 100)
+            extra[name][sname] = [None if none else value for none, value in zip(empty, result)]
+    return ranges, series, extra
+
+
+# Condenses series data ({'builds': [...], 'series': {...}}, as exported by
+# create_graph_json.py) by day, or by another of gLevels. Returns
+# {'builds': [...], 'series': {...}}, with an 'aggregates' dict of aggregate
+# name -> series name -> values when any of gAggregates are asked for.
+def condense_data(data, aggregates=(), level='day'):
+    for name in aggregates:
+        if name not in gAggregates:
+            raise ValueError("Unknown aggregate '%s'" % (name,))
+    if level not in dict(gLevels):
+        raise ValueError("Unknown level '%s'" % (level,))
+    condense = _condense_numpy if numpy and data['builds'] else _condense_python
+    ranges, series, extra = condense(data, aggregates, level)
+    cdata = {
+        'builds': [_build_entry(data['builds'], start, end, level) for start, end in ranges],
+        'series': series
+    }
+    if aggregates:
+        cdata['aggregates'] = extra
+    return cdata
+
+
+# Splits series data, condensed or not, into pieces of up to size builds each,
+# for the website to fetch only the parts it shows. Returns a list of
+# {'builds': [...], 'series': {...}} (and 'aggregates', if the data has them).
+def chunk_data(data, size):
+    return [_slice_data(data, start, start + size)
+            for start in range(0, len(data['builds']), size)]
+
+
+def _slice_data(data, start, end):
+    piece = {
+        'builds': data['builds'][start:end],
+        'series': dict((name, values[start:end]) for name, values in data['series'].iteritems())
+    }
+    if 'aggregates' in data:
+        piece['aggregates'] = dict(
+            (name, dict((sname, values[start:end]) for sname, values in series.iteritems()))
+            for name, series in data['aggregates'].iteritems())
+    return piece
+
+
+# Series data with no builds
+def empty_data(aggregates=()):
+    data = {'builds': [], 'series': {}}
+    if aggregates:
+        data['aggregates'] = dict((name, {}) for name in aggregates)
+    return data
+
+
+def _extend_series(total, series, before, count):
+    for name, values in series.iteritems():
+        # A series that just appeared is padded out with nulls for the
+        # builds before it, to keep the indexes lined up
+        total.setdefault(name, [None] * before).extend(values)
+    for name, values in total.iteritems():
+        if name not in series:
+            values.extend([None] * count)
+        if len(values) != before + count:
+            raise ValueError("Series '%s' does not match the build count" % (name,))
+
+
+# Appends series data (condensed or not) to total, in place, padding out with
+# nulls the series that either of them is missing.
+def extend_data(total, data):
+    before = len(total['builds'])
+    count = len(data['builds'])
+    _extend_series(total['series'], data['series'], before, count)
+    extra = data.get('aggregates', {})
+    for name in set(total.get('aggregates', {})) | set(extra):
+        _extend_series(total['aggregates'].setdefault(name, {}), extra.get(name, {}),
+                       before, count)
+    total['builds'].extend(data['builds'])
+
+
+# Joins up series data given a file at a time into chunks of size builds, as
+# chunk_data() would split the whole, calling flush(chunk) as each one fills:
+#   chunker = Chunker(250, write_chunk)
+#   chunker.extend(month_data) ...
+#   chunker.finish()
+# Only the chunk being filled is kept. A series that first appears in a later
+# chunk is missing from the earlier ones, rather than padded with nulls.
+class Chunker():
+
+    def __init__(self, size, flush, aggregates=()):
+        self.size = size
+        self.flush = flush
+        self.aggregates = aggregates
+        self.pending = empty_data(aggregates)
+
+    def extend(self, data):
+        extend_data(self.pending, data)
+        count = len(self.pending['builds'])
+        full = count - count % self.size
+        for start in range(0, full, self.size):
+            self.flush(_slice_data(self.pending, start, start + self.size))
+        # The rest, and the series so far, carry on
+        self.pending = _slice_data(self.pending, full, count)
+
+    def finish(self):
+        if self.pending['builds']:
+            self.flush(self.pending)
+        self.pending = empty_data(self.aggregates)
+
+
+# Joins up series data given a file at a time as extend_data() would, but
+# spooled to a temporary directory a file per column, so it's never all in
+# memory. data() gives it back for GraphJSON.write_json() to stream out:
+#   spool = ColumnSpool()
+#   spool.extend(month_data) ...
+#   GraphJSON.write_json(path, spool.data(), depth=3)
+#   spool.close()
+class ColumnSpool():
+
+    def __init__(self, aggregates=()):
+        self.dir = tempfile.mkdtemp(prefix='GraphCondense')
+        self.aggregates = aggregates
+        self.count = 0
+        # (key, ...) path of the column in the data -> spool file
+        self.paths = {}
+
+    def _columns(self, data):
+        columns = {('builds',): data['builds']}
+        for name, values in data['series'].iteritems():
+            columns[('series', name)] = values
+        for aggregate, series in data.get('aggregates', {}).iteritems():
+            for name, values in series.iteritems():
+                columns[('aggregates', aggregate, name)] = values
+        return columns
+
+    def _append(self, key, values):
+        if not values:
+            return
+        path = self.paths[key]
+        with open(path, 'ab') as f:
+            if f.tell():
+                f.write(',')
+            f.write(json.dumps(values, separators=(',', ':'), sort_keys=True)[1:-1])
+
+    def extend(self, data):
+        count = len(data['builds'])
+        columns = self._columns(data)
+        for key in sorted(set(columns) | set(self.paths)):
+            if key not in self.paths:
+                self.paths[key] = os.path.join(self.dir, str(len(self.paths)))
+                open(self.paths[key], 'wb').close()
+                self._append(key, [None] * self.count)
+            self._append(key, columns.get(key, [None] * count))
+        self.count += count
+
+    def _read(self, path):
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(GraphJSON.gBlockSize), ''):
+                yield block
+
+    # The data, with each column either read back as a list, or streamed as a
+    # GraphJSON.EncodedList
+    def data(self, encoded=True):
+        data = empty_data(self.aggregates)
+        data['builds'] = GraphJSON.EncodedList([]) if encoded else []
+        for key, path in self.paths.iteritems():
+            if encoded:
+                column = GraphJSON.EncodedList(self._read(path))
+            else:
+                with open(path, 'rb') as f:
+                    column = json.loads('[' + f.read() + ']')
+            if key[0] == 'builds':
+                data['builds'] = column
+            elif key[0] == 'series':
+                data['series'][key[1]] = column
+            else:
+                data['aggregates'].setdefault(key[1], {})[key[2]] = column
+        return data
+
+    def close(self):
+        shutil.rmtree(self.dir)
@@ -0,0 +1,442 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Writes the .json.gz files create_graph_json.py and merge_graph_json.py
+# export for the website. The JSON is compact and streamed into the gzip file
+# a piece at a time, rather than built as one big indented string first:
+#   write_json("html/data/areweslimyet.json.gz", data, level=6)
+# Optionally also writes a brotli (.json.br) or zstd (.json.zst) compressed
+# copy alongside, for web servers that can serve those directly.
+#
+# The series files can also be written in a columnar binary format the website
+# loads straight into typed arrays, see write_columns().
+
+import array
+import gzip
+import hashlib
+import json
+import os
+import struct
+import sys
+
+# Optional, only needed for precompressing
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+gCompressLevel = 9
+
+# Writes are batched into blocks of this size before compressing
+gBlockSize = 256 * 1024
+
+# Output that may turn out to be unchanged is held in memory up to this size
+# rather than written, past it it's written out and thrown away if unchanged
+gHoldSize = 16 * 1024 * 1024
+
+
+def _brotli():
+    if not brotli:
+        raise Exception("Precompressing with brotli needs the brotli module")
+    compressor = brotli.Compressor()
+    return (compressor.process, compressor.finish)
+
+
+def _zstd():
+    if not zstandard:
+        raise Exception("Precompressing with zstd needs the zstandard module")
+    compressor = zstandard.ZstdCompressor(level=19).compressobj()
+    return (compressor.compress, compressor.flush)
+
+
+# Name -> (file extension, function returning (compress, flush))
+gPrecompressors = {
+    'brotli': ('.br', _brotli),
+    'zstd': ('.zst', _zstd)
+}
+
+
+# Adds the --compress-level and --precompress options to an argparse parser
+def add_arguments(parser):
+    parser.add_argument('--compress-level', type=int, default=gCompressLevel,
+                        help='gzip compression level of the output files')
+    parser.add_argument('--precompress', choices=sorted(gPrecompressors.keys()),
+                        help='Also write a copy of each output file compressed '
+                             'with this, for the web server')
+    parser.add_argument('--binary', action='store_true',
+                        help='Also write the series in the binary columnar format '
+                             '(<series>.bin.gz) the website prefers')
+
+
+# Buffers writes to the output file(s). Files are written under a temporary
+# name and renamed into place by close(), so the web server never sees half a
+# file. If given the digest of what is already there, the output is held back
+# until close() and the files are left untouched if it hashes the same.
+class _Output():
+
+    def __init__(self, path, level, precompress, old_digest=None):
+        self.level = level
+        self.old_digest = old_digest
+        self.compress = None
+        self.renames = [(path + '.tmp', path)]
+        if precompress:
+            extension, compressor = gPrecompressors[precompress]
+            self.compress, self.flush = compressor()
+            sibling_path = path[:-len('.gz')] if path.endswith('.gz') else path
+            sibling_path += extension
+            self.renames.append((sibling_path + '.tmp', sibling_path))
+        self.hash = hashlib.sha1()
+        self.gzip = None
+        self.sibling = None
+        self.blocks = []
+        self.held = 0
+        self.pending = []
+        self.pending_size = 0
+
+    def _open(self):
+        self.gzip = gzip.open(self.renames[0][0], 'wb', self.level)
+        if self.compress:
+            self.sibling = open(self.renames[1][0], 'wb')
+
+    def _write_block(self, block):
+        if not self.gzip:
+            self._open()
+        self.gzip.write(block)
+        if self.sibling:
+            self.sibling.write(self.compress(block))
+
+    def write(self, data):
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.pending_size >= gBlockSize:
+            self._write_pending()
+
+    def _write_pending(self):
+        block = ''.join(self.pending)
+        self.pending = []
+        self.pending_size = 0
+        self.hash.update(block)
+        if self.old_digest and not self.gzip:
+            self.blocks.append(block)
+            self.held += len(block)
+            if self.held >= gHoldSize:
+                self._write_held()
+        else:
+            self._write_block(block)
+
+    def _write_held(self):
+        for block in self.blocks:
+            self._write_block(block)
+        self.blocks = []
+
+    # Returns the hex digest of the uncompressed output
+    def close(self):
+        self._write_pending()
+        digest = self.hash.hexdigest()
+        if digest == self.old_digest and \
+           all(os.path.exists(path) for tmp, path in self.renames):
+            self.abort()
+            return digest
+        self._write_held()
+        if not self.gzip:
+            self._open()
+        self.gzip.close()
+        if self.sibling:
+            self.sibling.write(self.flush())
+            self.sibling.close()
+        for tmp, path in self.renames:
+            os.rename(tmp, path)
+        return digest
+
+    def abort(self):
+        if not self.gzip:
+            return
+        self.gzip.close()
+        if self.sibling:
+            self.sibling.close()
+        for tmp, path in self.renames:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+
+# The digests of the files last written to a directory, saved alongside them
+# as JSON so unchanged files can be skipped without reading them back:
+#   hashes = HashIndex("html/data/areweslimyet.hashes.json")
+#   hashes[name] = write_json(path, data, old_digest=hashes.get(name))
+#   hashes.save()
+class HashIndex():
+
+    def __init__(self, path):
+        self.path = path
+        self.hashes = {}
+        try:
+            with open(path) as f:
+                self.hashes = json.load(f)
+        except (IOError, ValueError):
+            # Missing or damaged, everything gets rewritten once
+            pass
+
+    def get(self, name):
+        return self.hashes.get(name)
+
+    def __setitem__(self, name, digest):
+        self.hashes[name] = digest
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.hashes, f, separators=(',', ':'))
+        os.rename(self.path + '.tmp', self.path)
+
+
+# A list for write_json() to write from pieces of already encoded JSON (its
+# elements, comma separated), e.g. read back from a file a block at a time,
+# instead of encoding it
+class EncodedList():
+
+    def __init__(self, pieces):
+        self.pieces = pieces
+
+
+# Writes value as compact JSON, splitting dicts and lists up to depth levels
+# deep into separate pieces. Below that, values are encoded in one go by the
+# (much faster) C encoder. Keys are sorted, so the same data always gives the
+# same output.
+def _write_value(out, value, depth):
+    if isinstance(value, EncodedList):
+        out.write('[')
+        for piece in value.pieces:
+            out.write(piece)
+        out.write(']')
+    elif depth > 0 and isinstance(value, dict) and \
+            all(isinstance(key, basestring) for key in value):
+        out.write('{')
+        first = True
+        for key, item in sorted(value.iteritems()):
+            out.write(('' if first else ',') + json.dumps(key) + ':')
+            first = False
+            _write_value(out, item, depth - 1)
+        out.write('}')
+    elif depth > 0 and isinstance(value, list):
+        out.write('[')
+        for i, item in enumerate(value):
+            if i:
+                out.write(',')
+            _write_value(out, item, depth - 1)
+        out.write(']')
+    else:
+        out.write(json.dumps(value, separators=(',', ':'), sort_keys=True))
+
+
+# Writes data to path as gzipped JSON, and to a precompressed sibling if asked
+# to (one of gPrecompressors). Returns the digest of the JSON; if it matches
+# old_digest the existing files are kept as they are.
+def write_json(path, data, level=gCompressLevel, precompress=None, depth=2, old_digest=None):
+    out = _Output(path, level, precompress, old_digest)
+    try:
+        _write_value(out, data, depth)
+        out.write('\n')
+    except Exception:
+        out.abort()
+        raise
+    return out.close()
+
+
+# The columnar format, for the graph data (the series files, not the per-build
+# dumps). All little-endian:
+#   'AWSY', uint32 gColumnsVersion, uint32 header length,
+#   header JSON, padded with spaces so the columns start 8 byte aligned,
+#   columns, each count values long and padded to a multiple of 8 bytes
+# so the website can use typed array views on the columns as they are. The
+# header (ASCII, as non-ASCII characters are escaped) is
+#   {"count": <number of builds>,
+#    "builds": {<field>: <encoding>, ...},
+#    "series": {<series name>: <encoding>, ...},
+#    "meta": <the data's other keys>}
+# where each build field or series is encoded as one of
+#   {"column": {"type": "Float64" or "Int32", "offset": <from end of header>}}
+#   {"columns": [<column>, ...]} -- a list per build, or [min, median, max]
+#                                   triples for condensed series
+#   {"values": [...]} -- anything else, as JSON
+# Missing values are NaN in Float64 columns and gInt32Missing in Int32 ones.
+# Build fields with "optional" set are left out of builds where they're
+# missing, rather than being null.
+gColumnsVersion = 1
+gColumnsPreamble = '<4sII'
+gInt32Missing = -2 ** 31
+
+
+def _is_number(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+
+# Picks the column type for a list of values (None for missing), or None if
+# they aren't all numbers
+def _column_type(values):
+    present = [x for x in values if x is not None]
+    if not all(_is_number(x) for x in present):
+        return None
+    if all(isinstance(x, (int, long)) and gInt32Missing < x < 2 ** 31 for x in present):
+        return 'Int32'
+    return 'Float64'
+
+
+class _Columns():
+
+    def __init__(self):
+        self.data = []
+        self.size = 0
+
+    # Adds a column, returning its header entry
+    def add(self, values, column_type):
+        if column_type == 'Int32':
+            column = array.array('i', [gInt32Missing if x is None else x for x in values])
+        else:
+            column = array.array('d', [float('nan') if x is None else x for x in values])
+        if sys.byteorder == 'big':
+            column.byteswap()
+        data = column.tostring()
+        data += '\0' * (-len(data) % 8)
+        entry = {'type': column_type, 'offset': self.size}
+        self.data.append(data)
+        self.size += len(data)
+        return entry
+
+    # Encodes a list of values as a column, or one column per element for
+    # lists of a fixed length, falling back to JSON. If optional, None is a
+    # missing value rather than null.
+    def encode(self, values, optional=False):
+        column_type = _column_type(values)
+        if column_type:
+            return {'column': self.add(values, column_type)}
+        lengths = set(len(x) if isinstance(x, list) else None for x in values if x is not None)
+        if optional:
+            # A list of only missing elements would read back as a missing list
+            columnar = all(any(y is not None for y in x) for x in values if x is not None)
+        else:
+            columnar = None not in values
+        if columnar and len(lengths) == 1 and None not in lengths:
+            columns = []
+            for n in range(lengths.pop()):
+                elements = [None if x is None else x[n] for x in values]
+                column_type = _column_type(elements)
+                if not column_type:
+                    break
+                columns.append(self.add(elements, column_type))
+            else:
+                return {'columns': columns}
+        return {'values': values}
+
+
+# Encodes a condensed series, where each value is a number, None, or a [min,
+# median, max] triple written as just the median when it's also the min. The
+# triples become three columns, single values being repeated in each.
+def _encode_series(columns, values):
+    triples = [x for x in values if isinstance(x, list)]
+    if not triples:
+        return columns.encode(values)
+    if not all(len(x) == 3 and x[0] != x[1] for x in triples) or \
+       not all(x is None or _is_number(x) or isinstance(x, list) for x in values):
+        return {'values': values}
+    return {'columns': [columns.add([x[n] if isinstance(x, list) else x for x in values],
+                                    'Float64') for n in range(3)]}
+
+
+# Writes series data ({'builds': [...], 'series': {...}, ...}) to path in the
+# columnar format, gzipped. Returns the digest of the uncompressed output, as
+# write_json() does.
+def write_columns(path, data, level=gCompressLevel, precompress=None, old_digest=None):
+    builds = data['builds']
+    columns = _Columns()
+    header = {
+        'count': len(builds),
+        'builds': {},
+        'series': {},
+        'meta': dict((key, value) for key, value in data.iteritems()
+                     if key not in ('builds', 'series'))
+    }
+    fields = set(key for build in builds for key in build)
+    for field in sorted(fields):
+        optional = any(field not in build for build in builds)
+        values = [build.get(field) for build in builds]
+        if optional and any(field in build and build[field] is None for build in builds):
+            raise ValueError("Build field '%s' is both missing and null" % (field,))
+        header['builds'][field] = columns.encode(values, optional)
+        if optional:
+            header['builds'][field]['optional'] = True
+    for name, values in sorted(data['series'].iteritems()):
+        if len(values) != len(builds):
+            raise ValueError("Series '%s' does not match the build count" % (name,))
+        header['series'][name] = _encode_series(columns, values)
+
+    header = json.dumps(header, separators=(',', ':'), sort_keys=True)
+    header += ' ' * (-(struct.calcsize(gColumnsPreamble) + len(header)) % 8)
+    out = _Output(path, level, precompress, old_digest)
+    try:
+        out.write(struct.pack(gColumnsPreamble, 'AWSY', gColumnsVersion, len(header)))
+        out.write(header)
+        for column in columns.data:
+            out.write(column)
+    except Exception:
+        out.abort()
+        raise
+    return out.close()
+
+
+# Reads a file written by write_columns() back into the structure it was given,
+# as the website does
+def read_columns(path):
+    f = gzip.open(path, 'rb')
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    magic, version, header_length = struct.unpack_from(gColumnsPreamble, data)
+    if magic != 'AWSY' or version != gColumnsVersion:
+        raise Exception("%s is not a version %u columns file" % (path, gColumnsVersion))
+    start = struct.calcsize(gColumnsPreamble) + header_length
+    header = json.loads(data[struct.calcsize(gColumnsPreamble):start])
+    count = header['count']
+
+    def column(entry):
+        column = array.array('i' if entry['type'] == 'Int32' else 'd')
+        offset = start + entry['offset']
+        column.fromstring(data[offset:offset + count * column.itemsize])
+        if sys.byteorder == 'big':
+            column.byteswap()
+        missing = gInt32Missing if entry['type'] == 'Int32' else None
+        return [None if x == missing or x != x else x for x in column]
+
+    def decode(encoding):
+        if 'column' in encoding:
+            return column(encoding['column'])
+        if 'columns' in encoding:
+            return zip(*[column(x) for x in encoding['columns']])
+        return encoding['values']
+
+    builds = [{} for x in range(count)]
+    for field, encoding in header['builds'].iteritems():
+        for build, value in zip(builds, decode(encoding)):
+            if encoding.get('optional') and isinstance(value, tuple) and \
+               all(x is None for x in value):
+                value = None
+            if value is not None or not encoding.get('optional'):
+                build[field] = list(value) if isinstance(value, tuple) else value
+    series = {}
+    for name, encoding in header['series'].iteritems():
+        values = decode(encoding)
+        if 'columns' in encoding:
+            values = [None if x[1] is None else x[1] if x[0] == x[1] else list(x)
+                      for x in values]
+        series[name] = values
+    data = header['meta']
+    data['builds'] = builds
+    data['series'] = series
+    return data
@@ -110,6 +110,22 @@ class MarionetteTest(BenchTester.BenchTest):
         # Add our testvars
         runner.testvars.update(testvars)
 
+        # If we're logging to a database, have the test hand us each checkpoint
+        # as it is taken rather than collecting them all in testvars
+        test_id = None
+        # Checkpoints that didn't make it into the database, which makes the
+        # test incomplete
+        lost_checkpoints = []
+        if self.tester.sqlite:
+            test_id = self.tester.begin_test(testname)
+            if test_id is None:
+                return self.error("Failed to create test record")
+
+            def checkpoint_callback(iteration, checkpoint):
+                if not self.tester.add_checkpoint(test_id, iteration + 1, checkpoint):
+                    lost_checkpoints.append((iteration + 1, checkpoint.get('label')))
+            runner.testvars['checkpointCallback'] = checkpoint_callback
+
         # Run test
         self.info("Marionette - starting browser")
         try:
@@ -121,6 +137,9 @@ class MarionetteTest(BenchTester.BenchTest):
                 runner.cleanup()
             except:
                 pass
+            # Keep whatever checkpoints made it in, marked as unsuccessful
+            if test_id is not None:
+                self.tester.end_test(test_id, False)
             return self.error("Marionette test run failed -- %s: %s" % (type(e), e))
         finally:
             # cleanup the profile dir if not already cleaned up
@@ -142,7 +161,16 @@ class MarionetteTest(BenchTester.BenchTest):
 
         self.endurance_results = runner.testvars.get("results", [])
 
-        if not self.tester.add_test_results(testname, self.endurance_results, not failures):
+        if lost_checkpoints:
+            self.tester.end_test(test_id, False)
+            return self.error("Failed to save %u checkpoint(s) of the test: %s" % (
+                len(lost_checkpoints),
+                ", ".join("%s (iteration %u)" % (label, iteration)
+                          for iteration, label in lost_checkpoints)))
+        if test_id is not None:
+            if not self.tester.end_test(test_id, not failures):
+                return self.error("Failed to save test results")
+        elif not self.tester.add_test_results(testname, self.endurance_results, not failures):
             return self.error("Failed to save test results")
         if failures:
             return self.error("%u failures occured during test run" % failures)
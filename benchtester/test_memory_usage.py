@@ -338,14 +338,22 @@ class TestMemoryUsage(MarionetteTestCase):
         Upon succesful completion the results will be stored in
         |self.testvars["results"]| and accessible to the test runner via the
         |testvars| object it passed in.
+
+        If the runner provides |self.testvars["checkpointCallback"]| each
+        checkpoint is instead passed to it as soon as it is taken, as
+        |callback(iteration, checkpoint)|, and not kept in the results.
         """
         # setup the results array
         results = [[] for x in range(self._iterations)]
+        callback = self.testvars.get("checkpointCallback")
 
         def create_checkpoint(name, iteration):
             checkpoint = self.do_memory_report(name)
             self.assertIsNotNone(checkpoint, "Checkpoint was recorded")
-            results[iteration].append(checkpoint)
+            if callback:
+                callback(iteration, checkpoint)
+            else:
+                results[iteration].append(checkpoint)
 
         # The first iteration gets Start and StartSettled entries before
         # opening tabs
@@ -10,21 +10,31 @@
 # For all builds in given sqlite db, finds the newest test run of that test and:
 # - Generate series.json.gz with all the series in gTests, ready for graphing
 # - Generate a <buildname>.json.gz with all datapoints from the tests configured
-#   for dumping in gTests
+#   for dumping in gTests. Files whose content hasn't changed are left alone,
+#   see series.hashes.json
 
 import sys
 import os
+import argparse
+import itertools
+import multiprocessing
 import sqlite3
 import json
 import time
 import re
 import gzip
+import bisect
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(sys.argv[0]), "benchtester")))
+import BenchDB
+import GraphJSON
 
 # For looking up build rev numbers
 import mercurial
 import mercurial.ui
 import mercurial.hg
 import mercurial.commands
+import mercurial.scmutil
 gMercurialRepo = "./mozilla-inbound"
 
 # Config for which tests to export
@@ -218,25 +228,45 @@ for k, v in gTests['Slimtest-TalosTP5-Slow']['series'].iteritems():
         out = re.sub('^Iteration 5', 'Iteration 1', v['datapoint'])
     gTests['Android-ARMv6']['series']['Android' + k] = {"datapoint": out}
 
-
-# Python 2 compat
-if sys.hexversion < 0x03000000:
-    def bytes(string, **kwargs):
-        return string
+# The series of each test, compiled for looking up their values as datapoints
+# are read
+gResolvers = {}
+for testname, test in gTests.items():
+    gResolvers[testname] = BenchDB.SeriesResolver(
+        dict((sname, sinfo['datapoint']) for sname, sinfo in test['series'].items()),
+        test.get('nodeize'))
 
 
 def error(msg):
     sys.stderr.write(msg + '\n')
     sys.exit(1)
 
-if len(sys.argv) != 4:
-    error("Usage: %s <database> <seriesname> <outdir>" % sys.argv[0])
-
-gDatabase = os.path.normpath(sys.argv[1])
-gSeriesName = sys.argv[2]
-gOutDir = os.path.normpath(sys.argv[3])
-
-if not os.path.isfile(gDatabase):
+parser = argparse.ArgumentParser(description='Export a results database for graphing')
+parser.add_argument('database')
+parser.add_argument('seriesname')
+parser.add_argument('outdir')
+parser.add_argument('--jobs', '-j', type=int, default=1,
+                    help='Export builds in this many processes')
+GraphJSON.add_arguments(parser)
+args = parser.parse_args()
+
+gDatabase = os.path.normpath(args.database)
+gSeriesName = args.seriesname
+gOutDir = os.path.normpath(args.outdir)
+gJobs = args.jobs
+
+# Builds exported together, reading all their tests' data in one query
+gBuildBlockSize = 16
+
+# Archived databases (db.sqlite.xz) are read from a decompressed copy in
+# <dbdir>/archive-cache
+if gDatabase.endswith('.xz'):
+    gDatabase = gDatabase[:-3]
+gShards = BenchDB.ShardRouter(os.path.dirname(gDatabase),
+                              archive_cache=BenchDB.ArchiveCache(
+                                  os.path.join(os.path.dirname(gDatabase), "archive-cache")))
+
+if not gShards.readable(gDatabase):
     error("Database '%s' not found" % gDatabase)
 
 if not os.path.isdir(gOutDir):
@@ -252,59 +282,108 @@ if not os.path.isdir(gOutDir):
         error("'%s' is not a directory, cannot create folders in it" % parentdir)
     os.mkdir(gOutDir)
 
-sql = sqlite3.connect(gDatabase, timeout=900)
+sql = gShards.checkout(gDatabase)
 sql.row_factory = sqlite3.Row
 cur = sql.cursor()
-
-# Fetch and sort the builds by timestamp. For builds with identical push dates,
-# lookup the revision number from hg
-cur.execute('''SELECT build.id as `id`, build.name as `name`, build.time as `time`, repo.name as `repo_name`
-               FROM `benchtester_builds` as build, `benchtester_repos` as repo
-               WHERE build.repo_id = repo.id''')
-
-builds = cur.fetchall()
-hg_ui = None
-hg_repo = None
-
-
-def build_sort(build_a, build_b):
-    global hg_repo, hg_ui
-    if build_a['time'] != build_b['time']:
-        return 1 if build_a['time'] > build_b['time'] else -1
-    # Builds have equal timestamp, look up their revision number in repo if
-    # possible
-    if not hg_repo:
+reader = BenchDB.DataReader(sql)
+
+# The newest entry in the database's change log, read before anything else so
+# changes made while we run are picked up next time. None for databases from
+# before the change log.
+try:
+    last_change = cur.execute(BenchDB.gQueries['last_change']).fetchone()
+    last_change = [last_change['id'], last_change['build_name']] if last_change else [0, None]
+except sqlite3.OperationalError:
+    last_change = None
+
+# The latest successful run of each test on each build, as (build id, test
+# name) -> (test id, time), read in one go rather than per build
+gLatestTests = reader.latest_tests()
+
+# Mercurial revision numbers of builds, for ordering builds with identical
+# timestamps. Looked up once per build and stored in the database's
+# benchtester_revisions table, so sorting never needs the repository.
+gRevisions = {}
+
+# Digests of the <buildname>.json.gz (and series) files we last wrote, so
+# rewriting a build with identical data doesn't touch its file (and change its
+# ctime, which cron.sh uses to find new builds to submit, or make rsync upload
+# it again)
+gHashes = GraphJSON.HashIndex(os.path.join(gOutDir, gSeriesName + '.hashes.json'))
+
+
+# Fills in gRevisions for any of builds that share a timestamp with another
+def load_revisions(builds):
+    times = {}
+    for build in builds:
+        times.setdefault(build['time'], []).append(build['name'])
+    names = [name for tied in times.values() if len(tied) > 1
+             for name in tied if name not in gRevisions]
+    if not names:
+        return
+
+    # Known from a previous run
+    missing = []
+    for name in names:
+        try:
+            row = cur.execute(BenchDB.gQueries['revision'], [name]).fetchone()
+        except sqlite3.OperationalError:
+            # Database from before the revisions table
+            row = None
+        if row:
+            gRevisions[name] = row['rev']
+        else:
+            missing.append(name)
+    if not missing:
+        return
+
+    # Look up the rest in one pass over the repository
+    print("Looking up revision numbers of %u builds with identical timestamps" % (len(missing),))
+    try:
         hg_ui = mercurial.ui.ui()
         hg_repo = mercurial.hg.repository(hg_ui, gMercurialRepo)
         hg_ui.readconfig(os.path.join(gMercurialRepo, ".hg", "hgrc"))
+    except Exception as e:
+        print("WARNING: Couldn't open %s to order builds with identical timestamps (%s: %s)" %
+              (gMercurialRepo, type(e), e))
+        return
+    try:
         hg_ui.pushbuffer()
         # Pull repo, but don't update so we don't conflict with whatever the test
         # daemon is doing with it
         mercurial.commands.pull(hg_ui, hg_repo, check=False, update=False)
+    except Exception as e:
+        print("WARNING: Couldn't pull %s, using what we have (%s: %s)" %
+              (gMercurialRepo, type(e), e))
+    finally:
         hg_ui.popbuffer()
 
-    # Get revisions
+    found = []
+    for name in missing:
+        try:
+            rev = mercurial.scmutil.revsingle(hg_repo, str(name)).rev()
+        except Exception as e:
+            # mercurial throws all kinds of fun exceptions for bad input
+            print("WARNING: Couldn't lookup revision number of %s (%s: %s)" % (name, type(e), e))
+            continue
+        gRevisions[name] = rev
+        found.append((name, rev))
+
+    # Save them for next time. Archived databases are read-only, those just
+    # get looked up again.
     try:
-        hg_ui.pushbuffer()
-        mercurial.commands.log(
-            hg_ui, hg_repo, rev=["%s" % (build_a['name'],)], template="{rev}", date="", user=None, follow=None)
-        a_rev = int(hg_ui.popbuffer())
-        hg_ui.pushbuffer()
-        mercurial.commands.log(
-            hg_ui, hg_repo, rev=["%s" % (build_b['name'],)], template="{rev}", date="", user=None, follow=None)
-        b_rev = int(hg_ui.popbuffer())
-    except Exception as e:
-        # mercurial throws all kinds of fun exceptions for bad input
-        print("WARNING: Couldn't lookup ordering of commits with identical timestamp: %s / %s (%s: %s)" %
-              (build_a[1], build_b[1], type(e), e))
-        return 0
+        cur.executemany("INSERT OR REPLACE INTO `benchtester_revisions` (`name`, `rev`) "
+                        "VALUES (?, ?)", found)
+        sql.commit()
+    except sqlite3.Error as e:
+        sql.rollback()
+        print("WARNING: Couldn't store revision numbers (%s)" % (e,))
 
-    print("Builds %s and %s have identical timestamp, using rev numbers %u and %u" %
-          (build_a['name'], build_b['name'], a_rev, b_rev))
-    return 1 if a_rev > b_rev else -1 if b_rev > a_rev else 0
 
-print("Sorting builds...")
-builds = sorted(builds, cmp=build_sort)
+# Sort key for builds, by timestamp and then revision number. Call
+# load_revisions() first.
+def build_key(build):
+    return (build['time'], gRevisions.get(build['name'], -1))
 
 # series - a dict of series name (e.g. StartMemory) -> [[x,y], [x2, y2], ...]
 #          All series have the same length, such the same index in any series
@@ -336,224 +415,289 @@ if os.path.exists(old_series_file):
     for i in range(len(old_data["builds"])):
         old_builds_map[old_data["builds"][i]["revision"]] = i
 
-# Helper to find a node by datapoint
-
-
-def _findNode(nodes, datapoint, nodeize):
-    node = nodes
-    if nodeize:
-        for branch in datapoint.split(nodeize):
-            if node and branch in node:
-                node = node[branch]
-            else:
-                return None
-        return node
-    else:
-        return nodes.get(datapoint)
 
-i = 0
-for build in builds:
-    i += 1
-
-    # Lookup tests for this build
-    testdata = {}
-    for testname in gTests.keys():
-        testdata[testname] = {'time': None, 'id': None, 'nodes': {}}
-
-        # Get latest test for this build
-        cur.execute('''SELECT id, time FROM benchtester_tests
-                   WHERE name = ? AND build_id = ? AND successful = 1
-                   ORDER BY time DESC LIMIT 1''', [testname, build['id']])
-        testrow = cur.fetchone()
-        if not testrow:
+# The latest test ids for build, in gTests order
+def get_test_ids(build):
+    return [gLatestTests.get((build['id'], testname), (None,))[0] for testname in gTests.keys()]
+
+
+# Reuses the old file's data for a build, returning its builds entry and a
+# dict of series name -> value
+def reuse_build(build_name):
+    oldindex = old_builds_map[build_name]
+    values = {}
+    for sname in gSeriesNames:
+        if sname in old_data['series']:
+            values[sname] = old_data['series'][sname][oldindex]
+        else:
+            # Fill null in for newly-added series. We'll regenerate these by hand
+            # if desired, but forcing-regenerate means we have to de-archive all
+            # old DBs when the datapoint may only be in recent tests anyway
+            values[sname] = None
+    return (old_data['builds'][oldindex], values)
+
+
+# Reads the rows of a test into its testdata entry, returning a dict of series
+# name -> value
+def process_test(testname, testdata, rows):
+    nodeize = gTests[testname].get('nodeize')
+    dump = gTests[testname].get('dump')
+    resolver = gResolvers[testname]
+    resolver.reset()
+
+    # NB: For now kind is ignored
+
+    # Sort data, splitting it up into nodes if requested. Calculate the value
+    # of each node - either a sum of its childnodes, or its explicit value if
+    # given. The idea is to reduce the amount of data juggling the frontend
+    # needs to do. Tests that aren't dumped only need their series values.
+    if dump and nodeize:
+        tree = BenchDB.NodeTree(nodeize)
+    for row in rows:
+        datapoint = row.datapoint
+        units = unit_map.get(row.units)
+        if not units:
+            print("skipping unhandled unit %s for %s" % (row.units, datapoint))
             continue
 
-        testdata[testname]['time'] = testrow['time']
-        testdata[testname]['id'] = testrow['id']
+        resolver.add(row.iteration, row.checkpoint, row.process, datapoint, row.value, units)
+        if not dump:
+            continue
 
-    test_ids = [testdata[testname]['id'] for testname in gTests.keys()]
+        if nodeize:
+            # Prefix the reporter name, e.g. "Iteration 1/StartSettled/Main/<reporter>" so
+            # that it fits nicely into a tree.
+            datapoint = "Iteration %u/%s/%s/%s" % (row.iteration, row.checkpoint, row.process,
+                                                   datapoint)
+            tree.add(datapoint, row.value, units)
+        else:
+            # Flat data
+            # For types with units, we use [ 'unit', val ] pairs
+            val = [units, row.value] if units else row.value
+            testdata['nodes'][row.datapoint] = val
+    if dump and nodeize:
+        testdata['nodes'] = tree.as_dict()
+
+    return resolver.values()
+
+
+# Reads the tests for a block of builds, writes out each's <buildname>.json.gz,
+# and returns a list of their builds entries, dicts of series name -> value,
+# and the digests of the files. The block's data is read in test id order
+# with as few queries as possible, see DataReader.read_tests().
+def process_builds(builds):
+    # Lookup tests for these builds
+    testdata = {}
+    tests_by_id = {}
+    for build in builds:
+        testdata[build['name']] = {}
+        for testname in gTests.keys():
+            testdata[build['name']][testname] = {'time': None, 'id': None, 'nodes': {}}
+            testrow = gLatestTests.get((build['id'], testname))
+            if testrow:
+                testdata[build['name']][testname]['id'] = testrow[0]
+                testdata[build['name']][testname]['time'] = testrow[1]
+                tests_by_id[testrow[0]] = (build['name'], testname)
 
     #
-    # Determine if we should process this build or use the existing data
+    # For each test gTests references, pull all of its data into testdata, and
+    # look up its series values
     #
-    if old_data and build['name'] in old_builds_map and old_data['builds'][old_builds_map[build['name']]]['test_ids'] == test_ids:
-        print("[%u/%u] Using existing data for build %s" % (i, len(builds), build['name']))
-        oldindex = old_builds_map[build['name']]
-        data['builds'].append(old_data['builds'][oldindex])
-        for sname in gSeriesNames:
-            if sname in old_data['series']:
-                data['series'][sname].append(old_data['series'][sname][oldindex])
-            else:
-                # Fill null in for newly-added series. We'll regenerate these by hand
-                # if desired, but forcing-regenerate means we have to de-archive all
-                # old DBs when the datapoint may only be in recent tests anyway
-                data['series'][sname].append(None)
-    else:
-        print("[%u/%u] Processing build %s" % (i, len(builds), build['name']))
-        # Fill builds
-        data['builds'].append(
-            {'revision': build['name'], 'time': build['time'], 'test_ids': test_ids})
-
-        #
-        # For each test gTests references, pull all of its data into testdata
-        #
+    values = dict((build['name'], {}) for build in builds)
+    done = set()
+    for test_id, rows in reader.read_tests(tests_by_id.keys()):
+        build_name, testname = tests_by_id[test_id]
+        values[build_name].update(process_test(testname, testdata[build_name][testname], rows))
+        done.add((build_name, testname))
+    # Tests with no data (or no run at all) still get their empty nodes and values
+    for build in builds:
         for testname in gTests.keys():
-            if testname in gTests:
-                nodeize = gTests[testname].get('nodeize')
-            else:
-                nodeize = False
-
-            # Pull all data for latest run of this test on this build
-            allrows = cur.execute('''SELECT dp.name AS datapoint,
-                                      c.name AS checkpoint,
-                                      p.name AS process,
-                                      d.iteration, d.value, d.units, d.kind
-                               FROM benchtester_data d,
-                                    benchtester_datapoints dp,
-                                    benchtester_procs p,
-                                    benchtester_checkpoints c
-                               WHERE test_id = ? AND dp.id = d.datapoint_id
-                                                 AND c.id = d.checkpoint_id
-                                                 AND p.id = d.proc_id
-                            ''', [testdata[testname]['id']])
-
-            # NB: For now kind is ignored
-
-            # Sort data, splitting it up into nodes if requested. Calculate the value
-            # of each node - either a sum of its childnodes, or its explicit value if
-            # given. The idea is to reduce the amount of data juggling the frontend
-            # needs to do.
-            for row in allrows:
-                datapoint = row['datapoint']
-                units = unit_map.get(row['units'])
-                if not units:
-                    print("skipping unhandled unit %s for %s" % (row['units'], datapoint))
-                    continue
-
-                # Prefix the reporter name, e.g. "Iteration 1/StartSettled/Main/<reporter>" so
-                # that it fits nicely into a tree.
-                datapoint = "Iteration %u/%s/%s/%s" % (row['iteration'], row['checkpoint'], row['process'], datapoint)
-
-                if nodeize:
-                    # Note that we preserve null values as 'none', to differentiate missing
-                    # data from values of 0
-                    cursor = testdata[testname]['nodes']
-                    thisnode = datapoint.split(nodeize)
-                    for n in range(len(thisnode)):
-                        leaf = thisnode[n]
-                        cursor.setdefault(leaf, {})
-                        cursor = cursor[leaf]
-                        # Nodes can have a value *and* childnodes, so we set _val for specific
-                        # values, and _sum for derived childnodes
-                        if n == len(thisnode) - 1:
-                            cursor['_units'] = units
-                            cursor['_val'] = row['value']
-
-                        # discard() will make this the canonical units if no explicit value
-                        # for this node shows up.
-                        if '_childunits' in cursor and cursor['_childunits'] != units:
-                            cursor['_childunits'] = 'mixed'
-                        else:
-                            cursor['_childunits'] = units
-
-                        if not '_sum' in cursor or cursor['_sum'] == None:
-                            cursor['_sum'] = row['value']
-                        elif row['value'] != None:
-                            cursor['_sum'] += row['value']
-                else:
-                    # Flat data
-                    # For types with units, we use [ 'unit', val ] pairs
-                    val = [units, row['value']] if units else row['value']
-                    testdata[testname]['nodes'][row['datapoint']] = val
-
-        # Discard duplicate _sum/_val data after totalling, flatten node if there
-        # are no children
-        def discard(node):
-            # If no explicit value or units, use the sum/childunits
-            if '_val' not in node:
-                node['_val'] = node.get('_sum')
-            if '_units' not in node:
-                node['_units'] = node.get('_childunits')
-            if '_sum' in node:
-                del node['_sum']
-            if '_childunits' in node:
-                del node['_childunits']
-            # Bytes is the default unit
-            if node.get('_units') == 'bytes':
-                del node['_units']
-            for x in node:
-                if x not in ['_val', '_units']:
-                    discard(node[x])
-                    # Just _val, no _units or _sum, replace node with just raw value
-                    if len(node[x]) == 1:
-                        node[x] = node[x]['_val']
-        for x in testdata:
-            discard(testdata[x]['nodes'])
+            if (build['name'], testname) not in done:
+                values[build['name']].update(
+                    process_test(testname, testdata[build['name']][testname], []))
 
-        #
-        # Build all series [[x,y], ...] from testdata object
-        #
-        for test, testinfo in gTests.items():
-            for sname, sinfo in testinfo['series'].items():
-                nodes = testdata[test]['nodes']
-                # Is this nodeized data?
-                nodeize = gTests[test].get('nodeize')
-
-                node = None
-                if type(sinfo['datapoint']) == list:
-                    datapoint = None
-                    # If datapoint has alternate names, find the first one defined in the
-                    # nodes
-                    for dp in sinfo['datapoint']:
-                        node = _findNode(nodes, dp, nodeize)
-                        if node:
-                            break
-                else:
-                    node = _findNode(nodes, sinfo['datapoint'], nodeize)
-
-                if nodeize:
-                    if node == None:
-                        value = None
-                    elif type(node) in [int, long]:
-                        value = node
-                    else:
-                        value = node.get('_val')
-                else:
-                    # Flat data
-                    value = node
-
-                data['series'][sname].append(value)
+    results = []
+    for build in builds:
+        build_data = testdata[build['name']]
+        test_ids = [build_data[testname]['id'] for testname in gTests.keys()]
+        entry = {'revision': build['name'], 'time': build['time'], 'test_ids': test_ids}
 
         #
         # Discard data for tests not requested to be dumped
         #
-        for testname in testdata.keys():
+        for testname in build_data.keys():
             if not testname in gTests.keys() or \
                not gTests[testname].get('dump'):
-                del testdata[testname]
+                del build_data[testname]
             else:
               # Add test metadata.
-              testdata[testname]['repo'] = build['repo_name']
-              testdata[testname]['revision'] = build['name']
+              build_data[testname]['repo'] = build['repo_name']
+              build_data[testname]['revision'] = build['name']
 
         #
         # Write out the test data for this build into <buildname>.json.gz
         #
-        testfile = gzip.open(os.path.join(gOutDir, build['name'] + '.json.gz'), 'w', 9)
-        testfile.write(bytes(json.dumps(testdata, indent=2), encoding="utf-8"))
-        testfile.write(bytes('\n', encoding="utf-8"))
-        testfile.close()
+        filename = build['name'] + '.json.gz'
+        digest = GraphJSON.write_json(os.path.join(gOutDir, filename), build_data,
+                                      level=args.compress_level, precompress=args.precompress,
+                                      old_digest=gHashes.get(filename))
+
+        results.append((entry, values[build['name']], digest))
+    return results
+
+
+# Sets up a --jobs worker process with its own read-only connection
+def init_worker():
+    global sql, cur, reader
+    sql = gShards.checkout(gDatabase, read_only=True)
+    sql.row_factory = sqlite3.Row
+    cur = sql.cursor()
+    reader = BenchDB.DataReader(sql)
+
+
+# Runs process_builds() for blocks of builds, in --jobs processes if asked to,
+# yielding the (builds entry, series values) results in order and recording
+# the files' digests in gHashes
+def export_builds(builds):
+    if not builds:
+        return
+    # sqlite3.Row doesn't pickle
+    builds = [dict(zip(build.keys(), build)) for build in builds]
+    # Small enough blocks to give every process a few
+    block_size = max(1, min(gBuildBlockSize, len(builds) // (gJobs * 4)))
+    blocks = [builds[x:x + block_size] for x in range(0, len(builds), block_size)]
+    pool = None
+    if gJobs > 1 and len(blocks) > 1:
+        pool = multiprocessing.Pool(min(gJobs, len(blocks)), init_worker)
+        results = pool.imap(process_builds, blocks)
+    else:
+        results = itertools.imap(process_builds, blocks)
+    try:
+        i = 0
+        for build, result in itertools.izip(builds, itertools.chain.from_iterable(results)):
+            i += 1
+            print("[%u/%u] Processed build %s" % (i, len(builds), build['name']))
+            entry, values, digest = result
+            gHashes[build['name'] + '.json.gz'] = digest
+            yield (entry, values)
+    finally:
+        # We have all the results by now, or are bailing out
+        if pool:
+            pool.terminate()
+            pool.join()
+
+
+# The output rows, as (build, builds entry, series values) in build order
+rows = []
+
+#
+# If the old file says where in the change log it left off, only re-export the
+# builds changed since then, and patch them into the old data
+#
+changed = None
+if old_data and last_change and old_data.get('last_change') and \
+   old_data['last_change'][0] <= last_change[0]:
+    # Make sure this is the same database, not one rebuilt since
+    row = cur.execute(BenchDB.gQueries['change'], [old_data['last_change'][0]]).fetchone()
+    if row and row['build_name'] == old_data['last_change'][1]:
+        changed = set(x['build_name'] for x in
+                      cur.execute(BenchDB.gQueries['changed_builds'], [old_data['last_change'][0]]))
+
+if changed is not None:
+    print("%u builds changed since the last export" % (len(changed),))
+    for oldindex, entry in enumerate(old_data['builds']):
+        if entry['revision'] not in changed:
+            build = {'name': entry['revision'], 'time': entry['time']}
+            rows.append((build,) + reuse_build(entry['revision']))
+
+    changed_builds = []
+    for build_name in sorted(changed):
+        build = cur.execute(BenchDB.gQueries['build_info'], [build_name]).fetchone()
+        if build:
+            changed_builds.append(build)
+        else:
+            print("Removed build %s" % (build_name,))
+    load_revisions([x[0] for x in rows] + changed_builds)
+
+    # The rest are still in order, so binary search for where each goes
+    keys = [build_key(x[0]) for x in rows]
+    for build, result in itertools.izip(changed_builds, export_builds(changed_builds)):
+        key = build_key(build)
+        index = bisect.bisect_right(keys, key)
+        keys.insert(index, key)
+        rows.insert(index, (build,) + result)
+
+    # Something other than our triggers changed the database, e.g. it was
+    # restored from a backup. Start over.
+    if len(rows) != cur.execute("SELECT COUNT(*) FROM `benchtester_builds`").fetchone()[0]:
+        print("Builds don't match the database, re-exporting everything")
+        changed = None
+        rows = []
+
+if changed is None:
+    # Fetch and sort the builds by timestamp. For builds with identical push dates,
+    # order by revision number, see load_revisions()
+    cur.execute('''SELECT build.id as `id`, build.name as `name`, build.time as `time`,
+                          repo.name as `repo_name`
+                   FROM `benchtester_builds` as build, `benchtester_repos` as repo
+                   WHERE build.repo_id = repo.id''')
+
+    builds = cur.fetchall()
+
+    print("Sorting builds...")
+    load_revisions(builds)
+    builds = sorted(builds, key=build_key)
+
+    todo = []
+    i = 0
+    for build in builds:
+        i += 1
 
-data['generated'] = time.time()
+        #
+        # Determine if we should process this build or use the existing data
+        #
+        if old_data and build['name'] in old_builds_map and \
+           old_data['builds'][old_builds_map[build['name']]]['test_ids'] == get_test_ids(build):
+            print("[%u/%u] Using existing data for build %s" % (i, len(builds), build['name']))
+            rows.append((build,) + reuse_build(build['name']))
+        else:
+            todo.append((len(rows), build))
+            rows.append(None)
+
+    print("Processing %u builds" % (len(todo),))
+    for (index, build), result in itertools.izip(todo, export_builds([x[1] for x in todo])):
+        rows[index] = (build,) + result
+
+# Done with the database
+gShards.checkin(sql)
+
+for build, entry, values in rows:
+    data['builds'].append(entry)
+    for sname in gSeriesNames:
+        data['series'][sname].append(values[sname])
+
+data['last_change'] = last_change
 data['series_info'] = {}
 for test in gTests.keys():
     for series in gTests[test]['series'].keys():
         data['series_info'][series] = gTests[test]['series'][series]
         data['series_info'][series]['test'] = test
 
-print("[%u/%u] Finished, writing %s.json.gz" % (i, i, gSeriesName))
+# If nothing changed, keep the old timestamp too so the files are left alone,
+# and merge_graph_json.py can reuse what it condensed from them last time
+data['generated'] = time.time()
+if old_data and old_data.get('generated') and \
+   dict(data, generated=None) == dict(old_data, generated=None):
+    print("No changes since the last export")
+    data['generated'] = old_data['generated']
+
+print("[%u/%u] Finished, writing %s.json.gz" % (len(rows), len(rows), gSeriesName))
 # Write out all the generated series into series.json.gz
-datafile = gzip.open(os.path.join(gOutDir, gSeriesName + '.json.gz'), 'w', 9)
-datafile.write(bytes(json.dumps(data, indent=2), encoding="utf-8"))
-datafile.write(bytes('\n', encoding="utf-8"))
-datafile.close()
+outputs = [(gSeriesName + '.json.gz', GraphJSON.write_json)]
+if args.binary:
+    outputs.append((gSeriesName + '.bin.gz', GraphJSON.write_columns))
+for filename, write in outputs:
+    gHashes[filename] = write(os.path.join(gOutDir, filename), data,
+                              level=args.compress_level, precompress=args.precompress,
+                              old_digest=gHashes.get(filename))
+gHashes.save()
@@ -610,6 +610,12 @@ if (gQueryVars['mobile']) {
 // full-resolution data into gFullData. gGraphData['allseries'] contains info on
 // the sub-series that can be fetched for gFullData.
 //
+// If merge_graph_json.py was given --lod, gGraphData['lod'] instead lists
+// levels of detail, coarsest first: the series condensed by month, week and
+// day and finally per build, each split into chunks. gFullData then holds the
+// chunks of the level needed for the visible range, rather than whole
+// sub-series.
+//
 // The pre-condensed datapoints and ones we fetch ourselves all have
 // min/median/max data, and the revision-range and time-range. See the
 // /data/areweslimyet.json file.
@@ -1022,15 +1028,26 @@ function memoryTreeNode(target, data, select, path, depth) {
 function _getInvolvedSeries(range) {
   var ret = [];
   var groupdist = Math.round((range[1] - range[0]) / gMaxPoints);
+  var condense = !gQueryVars['nocondense'] && isFinite(groupdist);
 
   // Unless the requested grouping distance is < 80% of the overview data's
   // distance, don't pull in more
-  if (!gQueryVars['nocondense'] && isFinite(groupdist) &&
-      groupdist / gGraphData['condensed'] > 0.8)
+  if (condense && groupdist / gGraphData['condensed'] > 0.8)
     return null;
 
-  for (var x in gGraphData['allseries']) {
-    var s = gGraphData['allseries'][x];
+  // Use the coarsest level of detail that is fine enough by the same measure,
+  // or the per build one
+  var chunks = gGraphData['allseries'];
+  var lod = gGraphData['lod'];
+  if (lod) {
+    var level = lod.length - 1;
+    while (condense && level > 0 && groupdist / lod[level - 1]['condensed'] > 0.8)
+      level--;
+    chunks = lod[level]['chunks'];
+  }
+
+  for (var x in chunks) {
+    var s = chunks[x];
     if (range[1] >= s['fromtime'] && range[0] <= s['totime'])
       ret.push(s['dataname']);
   }
@@ -1530,6 +1547,157 @@ Tooltip.prototype.unzoom = function() {
 // Ajax for getting more graph data
 //
 
+// The exporters' --binary option also writes each series file in a columnar
+// binary format, /data/<name>.bin (see write_columns() in
+// benchtester/GraphJSON.py), whose columns we use as typed arrays rather than
+// parsing JSON. getSeriesData() fetches that, falling back to
+// /data/<name>.json if it is missing (or with ?json), and calls success() with
+// the same structure either way.
+var gColumnsVersion = 1;
+var gInt32Missing = -2147483648;
+
+// Decodes a columns file into the structure of the JSON series files
+function decodeColumns(buffer) {
+  var view = new DataView(buffer);
+  var magic = String.fromCharCode(view.getUint8(0), view.getUint8(1),
+                                  view.getUint8(2), view.getUint8(3));
+  if (magic != 'AWSY' || view.getUint32(4, true) != gColumnsVersion)
+    throw new Error("not a version " + gColumnsVersion + " columns file");
+
+  // The header is JSON, in ASCII as other characters are escaped
+  var headerLength = view.getUint32(8, true);
+  var headerBytes = new Uint8Array(buffer, 12, headerLength);
+  var headerText = '';
+  for (var i = 0; i < headerLength; i += 8192)
+    headerText += String.fromCharCode.apply(null, headerBytes.subarray(i, i + 8192));
+  var header = JSON.parse(headerText);
+  var start = 12 + headerLength;
+  var count = header['count'];
+
+  // The file is little-endian, typed arrays use the platform's byte order
+  var littleEndian = new Uint8Array(new Uint16Array([ 1 ]).buffer)[0] == 1;
+
+  // The values of a column, with null for missing values
+  function column(entry) {
+    var offset = start + entry['offset'];
+    var int32 = entry['type'] == 'Int32';
+    var values = new Array(count);
+    var raw = null;
+    if (littleEndian) {
+      raw = int32 ? new Int32Array(buffer, offset, count)
+                  : new Float64Array(buffer, offset, count);
+    }
+    for (var i = 0; i < count; i++) {
+      var val;
+      if (raw)
+        val = raw[i];
+      else
+        val = int32 ? view.getInt32(offset + i * 4, true)
+                    : view.getFloat64(offset + i * 8, true);
+      values[i] = (int32 ? val == gInt32Missing : val != val) ? null : val;
+    }
+    return values;
+  }
+
+  var builds = new Array(count);
+  for (var i = 0; i < count; i++)
+    builds[i] = {};
+  for (var field in header['builds']) {
+    var encoding = header['builds'][field];
+    var optional = encoding['optional'];
+    if ('column' in encoding) {
+      var values = column(encoding['column']);
+      for (var i = 0; i < count; i++) {
+        if (values[i] !== null || !optional)
+          builds[i][field] = values[i];
+      }
+    } else if ('columns' in encoding) {
+      var cols = encoding['columns'].map(column);
+      for (var i = 0; i < count; i++) {
+        var list = [];
+        var present = false;
+        for (var n = 0; n < cols.length; n++) {
+          list.push(cols[n][i]);
+          if (cols[n][i] !== null) present = true;
+        }
+        if (present || !optional)
+          builds[i][field] = list;
+      }
+    } else {
+      for (var i = 0; i < count; i++) {
+        if (encoding['values'][i] !== null || !optional)
+          builds[i][field] = encoding['values'][i];
+      }
+    }
+  }
+
+  // Condensed series are [min, median, max] columns, with the values where
+  // min == median being just the median
+  var series = {};
+  for (var name in header['series']) {
+    var encoding = header['series'][name];
+    var values = encoding['values'];
+    if ('column' in encoding) {
+      values = column(encoding['column']);
+    } else if ('columns' in encoding) {
+      var min = column(encoding['columns'][0]);
+      var median = column(encoding['columns'][1]);
+      var max = column(encoding['columns'][2]);
+      values = median;
+      for (var i = 0; i < count; i++) {
+        if (median[i] !== null && min[i] != median[i])
+          values[i] = [ min[i], median[i], max[i] ];
+      }
+    }
+    series[name] = values;
+  }
+
+  var data = header['meta'];
+  data['builds'] = builds;
+  data['series'] = series;
+  return data;
+}
+
+// Fetch the series file /data/<name>.bin or .json, see decodeColumns(). Takes
+// { name: <name>, success: <callback>, error: <callback> }, with callbacks as
+// for $.ajax
+function getSeriesData(options) {
+  var name = options['name'];
+  function getJSON() {
+    $.ajax({
+      xhr: dlProgress,
+      url: '/data/' + name + '.json',
+      success: options['success'],
+      error: options['error'],
+      dataType: 'json'
+    });
+  }
+
+  if (gQueryVars['json'] || !window.ArrayBuffer || !window.DataView) {
+    getJSON();
+    return;
+  }
+  var xhr = dlProgress();
+  xhr.open('GET', '/data/' + name + '.bin');
+  xhr.responseType = 'arraybuffer';
+  xhr.onload = function () {
+    var data = null;
+    if (xhr.status == 200) {
+      try {
+        data = decodeColumns(xhr.response);
+      } catch (e) {
+        logError("Failed to read /data/" + name + ".bin: " + e);
+      }
+    }
+    if (data)
+      options['success'](data);
+    else
+      getJSON();
+  };
+  xhr.onerror = getJSON;
+  xhr.send();
+}
+
 // Fetch the series given by name (see gGraphData['allseries']), call success
 // or fail callback. Can call these immediately if the data is already available
 var gPendingFullData = {}
@@ -1540,9 +1708,8 @@ function getFullSeries(dataname, success, fail) {
   } else {
     if (!(dataname in gPendingFullData)) {
       gPendingFullData[dataname] = { 'success': [], 'fail': [] };
-      $.ajax({
-        xhr: dlProgress,
-        url: '/data/' + dataname + '.json',
+      getSeriesData({
+        name: dataname,
         success: function (data) {
           gFullData[dataname] = data;
           for (var i in gPendingFullData[dataname]['success'])
@@ -1553,8 +1720,7 @@ function getFullSeries(dataname, success, fail) {
           for (var i in gPendingFullData[dataname]['fail'])
             gPendingFullData[dataname]['fail'][i].call(null, error);
           delete gPendingFullData[dataname];
-        },
-        dataType: 'json'
+        }
       });
     }
     if (success) gPendingFullData[dataname]['success'].push(success);
@@ -2205,9 +2371,8 @@ $(function () {
     series = gQueryVars['series'];
   var url = '/data/' + series + '.json';
 
-  $.ajax({
-    url: url,
-    xhr: dlProgress,
+  getSeriesData({
+    name: series,
     success: function (data) {
       //
       // Graph data arrived, do additional processing and create plots
@@ -2253,8 +2418,7 @@ $(function () {
     error: function(xhr, status, error) {
       $('#graphs h3').text("An error occured while loading the graph data (" + url + ")");
       $('#graphs').append($.new('p', null, { 'text-align': 'center', color: '#F55' }).text(status + ': ' + error));
-    },
-    dataType: 'json'
+    }
   });
 
   // Handler to close zoomed tooltips upon clicking outside of them
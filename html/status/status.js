@@ -16,7 +16,7 @@ var gPublic = [ "areweslimyet.com", "www.areweslimyet.com" ].indexOf(document.lo
 // Types in status.json
 var gStatusTypes = {
   "running" : { label: "Running tests", mode: "eta" },
-  "building" : { label: "Building", single: true },
+  "building" : { label: "Building" },
   "prepared" : { label: "In run queue" },
   "completed" : { label: "Recently completed", mode: "note" },
   "failed" : { label: "Recently failed", mode: "note" },
@@ -208,7 +208,8 @@ function updateStatus(data) {
 
   for (var x in gStatusTypes) {
     var dat = data[x];
-    if (dat && gStatusTypes[x].single) dat = [ dat ];
+    // 'building' was a single build in older status files
+    if (dat && !jQuery.isArray(dat)) dat = [ dat ];
     if (!dat) dat = [];
 
     statusTable(gStatusTypes[x].label, dat, gStatusTypes[x].mode);
@@ -9,26 +9,49 @@
 
 # Merges the given list of blah-condensed.json.gz files into the master
 # series.json.gz file
+#
+# What each file condensed to is cached in series.merge-cache.gz, keyed by the
+# file's content hash, so only files that changed since the last merge (usually
+# just the current month's) are read and condensed again.
+#
+# With --lod, the series are also condensed by month, week and day, and all of
+# those and the per-build series are split into chunks (series.day.0.json.gz,
+# series.build.2015-01.0.json.gz, ...), listed in the master file's 'lod'
+# index. The master file then only holds the month level, and the website
+# fetches the chunks of the visible range at the resolution it needs.
+#
+# The files are streamed through a file at a time, the master file's series
+# being spooled to disk (see GraphCondense.ColumnSpool) and the chunks written
+# as they fill, so memory use depends on the size of a file, not the history.
 
+import argparse
+import hashlib
 import os
 import sys
 import time
 import gzip
 import json
-import datetime
-import calendar
+import StringIO
 
-# Python 2 compat
-if sys.hexversion < 0x03000000:
-  def bytes(string, **kwargs):
-    return string
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(sys.argv[0]), "benchtester")))
+import GraphCondense
+import GraphJSON
 
-if len(sys.argv) != 3:
-  sys.stderr.write("Usage: %s <seriesname> <datadir>\n" % sys.argv[0])
-  sys.exit(1)
+parser = argparse.ArgumentParser(description='Merge the exported sub-series into the master series file')
+parser.add_argument('seriesname')
+parser.add_argument('datadir')
+parser.add_argument('--aggregate', action='append', default=[],
+                    choices=GraphCondense.gAggregates,
+                    help='Also give each day\'s value of this aggregate of the series, '
+                         'in the output\'s aggregates (can be given more than once)')
+parser.add_argument('--lod', action='store_true',
+                    help='Also write the series condensed by month, week and day, and per '
+                         'build, in chunks for the website to fetch as it zooms in')
+GraphJSON.add_arguments(parser)
+args = parser.parse_args()
 
-seriesname = sys.argv[1]
-outdir = sys.argv[2]
+seriesname = args.seriesname
+outdir = args.datadir
 os.listdir(outdir)
 
 files = list(filter(lambda x: x != seriesname + '.json.gz' and x.startswith(seriesname + "-") and x.endswith('.json.gz'), os.listdir(outdir)))
@@ -36,100 +59,202 @@ files.sort()
 
 print("Merging %u files: %s" % (len(files), files))
 
-totaldata = { 'builds' : [], 'series' : {}, 'series_info' : {}, 'allseries' : [] }
-
-# Hard-coded to condensed by day below
-totaldata['condensed'] = 60 * 60 * 24;
-
-# Returns the timestamp of this build's day @ midnight UTC
-def dayof(timestamp):
-  return int(calendar.timegm(datetime.datetime.utcfromtimestamp(timestamp).date().timetuple()))
-
-def condense_data(data):
-  cdata = {
-    'builds': [],
-    'series' : {}
-  }
-  cday = -1
-  ranges = []
-  start = 0
-  for i in range(len(data['builds'])):
-    day = dayof(data['builds'][i]['time'])
-    if day != cday:
-      if cday != -1: ranges.append((start, i - 1))
-      cday = day
-      start = i
-  ranges.append((start, len(data['builds']) - 1))
-
-  for point in ranges:
-    build = {}
-    build['firstrev'] = data['builds'][point[0]]['revision']
-    build['time'] = data['builds'][point[0]]['time']
-    if point[0] != point[1]:
-      build['time'] = dayof(build['time'])
-      build['count'] = point[1] - point[0] + 1
-      build['lastrev'] = data['builds'][point[1]]['revision']
-      build['timerange'] = [ data['builds'][point[0]]['time'], data['builds'][point[1]]['time'] ]
-
-    cdata['builds'].append(build)
-
-    for sname in data['series'].keys():
-      series = data['series'][sname][point[0]:point[1] + 1]
-      iseries = filter(lambda x: x is not None, series)
-      cdata['series'].setdefault(sname, [])
-      if len(iseries) == 0:
-        cdata['series'][sname].append(None)
-      else:
-        iseries.sort()
-        if len(iseries) % 2 == 1:
-          median = iseries[(len(iseries) - 1) / 2]
-        else:
-          median = iseries[len(iseries) / 2]
-        if iseries[0] == median:
-          cdata['series'][sname].append(median)
-        else:
-          cdata['series'][sname].append([iseries[0], median, iseries[-1]])
-  return cdata
+totaldata = { 'series_info' : {}, 'allseries' : [] }
+aggregates = sorted(set(args.aggregate))
 
-for fname in files:
-  print("Condensing %s" % (fname,))
-  f = gzip.open(os.path.join(outdir, fname), 'r')
-  fdata = json.loads(f.read())
+# The levels we condense to, the first of which goes in the master file
+levels = [ name for name, length in GraphCondense.gLevels ] if args.lod else [ 'day' ]
+totaldata['condensed'] = dict(GraphCondense.gLevels)[levels[0]]
+
+# How many builds, or condensed points, each --lod chunk holds
+gChunkSize = 250
+
+# Bump when changing GraphCondense or what's cached, to throw away old caches
+gCacheVersion = 4
+
+# The cache, as
+#   { 'version': gCacheVersion, 'aggregates': [ <--aggregate>, ... ],
+#     'levels': [ <level>, ... ], 'files': { <filename>: <entry>, ... },
+#     'generated': <timestamp of the output>,
+#     'digests': { <output filename>: <digest>, ... } }
+# with entries of
+#   { 'size': ..., 'mtime': ..., 'digest': <sha1 of the file>,
+#     'allseries': <its allseries entry, None if it has no builds>,
+#     'series_info': ...,
+#     'chunks': <its per-build chunks' lod index entries>,
+#     'outputs': <the per-build chunk files> }
+# The size and mtime let unchanged files skip even being hashed. What each file
+# condensed to, { <level>: <condense_data() result>, ... }, is cached in
+# series.merge-cache/<filename>, to be read back a file at a time.
+cachefile = os.path.join(outdir, seriesname + '.merge-cache.gz')
+cachedir = os.path.join(outdir, seriesname + '.merge-cache')
+if not os.path.isdir(cachedir):
+  os.mkdir(cachedir)
+cached = { 'files': {}, 'digests': {} }
+if os.path.exists(cachefile):
+  try:
+    f = gzip.open(cachefile, 'r')
+    data = json.loads(f.read())
+    f.close()
+    if data.get('version') == gCacheVersion and data.get('aggregates') == aggregates and \
+       data.get('levels') == levels:
+      cached = data
+    else:
+      # The outputs' digests still hold, and say which chunks to clean up
+      cached['digests'] = data.get('digests', {})
+  except (IOError, ValueError), e:
+    print("Ignoring unreadable cache %s: %s" % (cachefile, e))
+cache = cached['files']
+newcache = { 'version': gCacheVersion, 'aggregates': aggregates, 'levels': levels,
+             'files': {}, 'digests': {} }
+condensed = 0
+
+# Writes <dataname>.json.gz (and .bin.gz), leaving them be if unchanged since the
+# last merge, with the builds and series from spool if given. Returns the
+# filenames.
+def write_outputs(dataname, data, spool=None):
+  outputs = [ (dataname + '.json.gz', GraphJSON.write_json) ]
+  if args.binary:
+    outputs.append((dataname + '.bin.gz', GraphJSON.write_columns))
+  for fname, write in outputs:
+    options = {}
+    if spool:
+      # The JSON is streamed from the spool (its lists being as deep as the
+      # aggregates' series), the binary format needs the columns in memory
+      # (the master file's level is small with --lod)
+      encoded = write == GraphJSON.write_json
+      data = dict(data, **spool.data(encoded))
+      if encoded:
+        options['depth'] = 3
+    newcache['digests'][fname] = write(os.path.join(outdir, fname), data,
+                                       level=args.compress_level, precompress=args.precompress,
+                                       old_digest=cached['digests'].get(fname), **options)
+  return [ fname for fname, write in outputs ]
+
+# The lod index entry of a chunk, like the allseries ones
+def chunk_entry(dataname, chunk):
+  return { 'fromtime' : chunk['builds'][0]['time'],
+           'totime' : chunk['builds'][-1]['time'],
+           'dataname' : dataname }
+
+# Reads a gzipped JSON file
+def read_json(path):
+  f = gzip.open(path, 'r')
+  data = json.loads(f.read())
+  f.close()
+  return data
+
+# Condenses a file, or reads its cached results if it hasn't changed. Returns
+# its cache entry and what it condensed to.
+def condense_file(fname):
+  path = os.path.join(outdir, fname)
+  stat = os.stat(path)
+  entry = cache.get(fname)
+  if entry and not all(os.path.exists(os.path.join(outdir, x)) for x in entry['outputs']):
+    entry = None
+  if entry and entry['allseries'] and not os.path.exists(os.path.join(cachedir, fname)):
+    entry = None
+  if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+    return entry, entry['allseries'] and read_json(os.path.join(cachedir, fname))
+  f = open(path, 'rb')
+  raw = f.read()
   f.close()
-  if not len(fdata['builds']): continue
-  totaldata['allseries'].append({
+  digest = hashlib.sha1(raw).hexdigest()
+  if entry and entry['digest'] == digest:
+    entry = dict(entry, size=stat.st_size, mtime=stat.st_mtime)
+    return entry, entry['allseries'] and read_json(os.path.join(cachedir, fname))
+
+  global condensed
+  condensed += 1
+  print("Condensing %s" % (fname,))
+  fdata = json.loads(gzip.GzipFile(fileobj=StringIO.StringIO(raw)).read())
+  entry = { 'size': stat.st_size, 'mtime': stat.st_mtime, 'digest': digest,
+            'allseries': None, 'series_info': fdata['series_info'],
+            'chunks': [], 'outputs': [] }
+  cdata = None
+  if len(fdata['builds']):
+    dataname = fname.replace('.json.gz', '')
+    entry['allseries'] = {
       'fromtime' : fdata['builds'][0]['time'],
       'totime' : fdata['builds'][-1]['time'],
-      'dataname' : fname.replace('.json.gz', '')
-    })
-  cdata = condense_data(fdata)
-  for x in cdata['series'].keys():
-    totaldata['series'].setdefault(x, [])
-    # If this series just appeared, or was absent from some datafiles before this,
-    # make sure we pad out with nulls to keep the indexes lined up
-    totaldata['series'][x].extend([None for y in range(len(totaldata['builds']) - len(totaldata['series'][x]))])
-    totaldata['series'][x].extend(cdata['series'][x])
-  # Continue pad out series that dont exist in this file
-  for x in totaldata['series'].keys():
-    if x not in cdata['series']:
-      totaldata['series'][x].extend([None for y in range(len(cdata['builds'])) ])
-  totaldata['builds'].extend(cdata['builds'])
-  totaldata['series_info'].update(fdata['series_info'])
-
-  # Sanity check this, logic bugs here cause massively bogus data
-  for x in totaldata['series'].keys():
-    a = len(totaldata['builds'])
-    b = len(totaldata['series'][x])
-    if a != b:
-      sys.stderr.write("Error series %s does not match build count: %u builds vs %u datapoints" % (x, a, b))
-      sys.exit(1)
-
-totaldata['generated'] = time.time()
+      'dataname' : dataname
+    }
+    cdata = dict((level, GraphCondense.condense_data(fdata, aggregates, level))
+                 for level in levels)
+    GraphJSON.write_json(os.path.join(cachedir, fname), cdata, level=1)
+    if args.lod:
+      # This file's part of the per-build level, as series.build.<suffix>.<n>
+      prefix = '%s.build.%s.' % (seriesname, dataname[len(seriesname) + 1:])
+      for n, chunk in enumerate(GraphCondense.chunk_data(fdata, gChunkSize)):
+        entry['chunks'].append(chunk_entry(prefix + str(n), chunk))
+        entry['outputs'].extend(write_outputs(prefix + str(n), chunk))
+  return entry, cdata
+
+# The master file's level is spooled to disk, the --lod levels are written a
+# chunk at a time as they fill
+spool = GraphCondense.ColumnSpool(aggregates)
+chunkers = {}
+lod = []
+if args.lod:
+  def chunk_writer(level, chunks):
+    def write_chunk(chunk):
+      dataname = '%s.%s.%u' % (seriesname, level, len(chunks))
+      write_outputs(dataname, chunk)
+      chunks.append(chunk_entry(dataname, chunk))
+    return write_chunk
+  for level, length in GraphCondense.gLevels:
+    lod.append({ 'name' : level, 'condensed' : length, 'chunks' : [] })
+    chunkers[level] = GraphCondense.Chunker(gChunkSize, chunk_writer(level, lod[-1]['chunks']),
+                                            aggregates)
+  # The per-build level ('condensed' 0) is chunked by file
+  lod.append({ 'name' : 'build', 'condensed' : 0, 'chunks' : [] })
+
+for fname in files:
+  entry, cdata = condense_file(fname)
+  newcache['files'][fname] = entry
+  # The chunks of unchanged files weren't written again
+  for x in entry['outputs']:
+    newcache['digests'].setdefault(x, cached['digests'].get(x))
+  if not entry['allseries']: continue
+  totaldata['allseries'].append(entry['allseries'])
+  spool.extend(cdata[levels[0]])
+  for level in chunkers:
+    chunkers[level].extend(cdata[level])
+  if args.lod:
+    lod[-1]['chunks'].extend(entry['chunks'])
+  totaldata['series_info'].update(entry['series_info'])
+
+if args.lod:
+  print("Writing chunks")
+  for level in chunkers:
+    chunkers[level].finish()
+  totaldata['lod'] = lod
+
+# If no files changed, neither does the output, leave it alone
+if not condensed and sorted(cache.keys()) == files and 'generated' in cached:
+  print("No changes since the last merge")
+  totaldata['generated'] = cached['generated']
+else:
+  totaldata['generated'] = time.time()
+newcache['generated'] = totaldata['generated']
 
 print("Writing %s.json.gz" % (seriesname,))
-datafile = gzip.open(os.path.join(outdir, seriesname + '.json.gz'), 'w', 9)
-datafile.write(bytes(json.dumps(totaldata, indent=2), encoding="utf-8"))
-datafile.write(bytes('\n', encoding="utf-8"))
-datafile.close()
+try:
+  write_outputs(seriesname, totaldata, spool)
+finally:
+  spool.close()
+
+# Remove the chunks that are no longer written, e.g. of removed sub-series
+for fname in set(cached['digests']) - set(newcache['digests']):
+  for path in [ fname ] + [ fname[:-len('.gz')] + suffix
+                            for suffix, compressor in GraphJSON.gPrecompressors.values() ]:
+    if os.path.exists(os.path.join(outdir, path)):
+      os.remove(os.path.join(outdir, path))
+
+# Only keeps files that still exist
+for fname in os.listdir(cachedir):
+  if fname not in files:
+    os.remove(os.path.join(cachedir, fname))
+GraphJSON.write_json(cachefile, newcache, level=1)
 
 print("Done")
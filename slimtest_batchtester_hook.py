@@ -18,18 +18,19 @@ import os
 import subprocess
 import sqlite3
 import time
-import datetime
+
+import BenchDB
 
 execfile("slimtest_config.py")
 
-sql = None
+# Archived months are refused without being read, so there's no archive cache
+gShards = BenchDB.ShardRouter("db")
 
 def database_for_build(build):
   if build.series:
-    return os.path.join("db", "custom-%s-x.sqlite" % build.series)
+    return gShards.custom_shard(build.series)
 
-  date = datetime.date.fromtimestamp(build.build.get_buildtime())
-  return os.path.join("db", "areweslimyet-%04u-%02u.sqlite" % (date.year, date.month))
+  return gShards.shard_for_time(build.build.get_buildtime())
 
 def stat(msg, logfile=None):
   msg = "%s :: %s\n" % (time.ctime(), msg)
@@ -43,33 +44,42 @@ def cli_hook(parser):
 
 def should_test(build, args):
   dbname = database_for_build(build)
-  if os.path.exists("%s.xz" % (dbname,)):
-    # Database is archived, don't create a duplicate
-    build.note = "Test database for this build's month (%s) has been archived, refusing to test" % (dbname,)
+  archived = gShards.is_archived(dbname)
+  archived_note = "Test database for this build's month (%s) has been archived, refusing to test" % (dbname,)
+
+  # Database is archived, don't create a duplicate. Reading it would mean
+  # decompressing the whole month just to note whether the build was complete.
+  if archived:
+    build.note = archived_note
     return False
 
   # No builds for this db yet
-  if not os.path.exists("%s" % (dbname,)):
+  if not gShards.readable(dbname):
     return True
 
   try:
-    sql = sqlite3.connect(dbname, timeout=900)
-    sql.row_factory = sqlite3.Row
+    sql = gShards.checkout(dbname, read_only=True)
   except Exception, e:
     build.note = "Internal Error: Failed to open database for given month (%s)" % (dbname,)
     return False
 
+  # The connection is closed whatever happens, rather than pooled: the daemon
+  # only gets here when a batch comes in, so it would sit idle holding the
+  # month's database open, and util/archive_db.sh waits for that to go away
+  try:
+    sql.row_factory = sqlite3.Row
+    res = sql.execute(BenchDB.gQueries['build'], [build.revision])
+    row = res.fetchone()
+    have_tests = set()
+    if row:
+      res = sql.execute(BenchDB.gQueries['build_tests'], [row['id']])
+      have_tests = set(map(lambda x: x['name'], res.fetchall()))
+  finally:
+    gShards.checkin(sql, keep=False)
 
-  res = sql.execute("SELECT `id` FROM `benchtester_builds` WHERE `name` = ?", [build.revision])
-  row = res.fetchone()
-  if not row: return True
-
-  res = sql.execute("SELECT `name` FROM `benchtester_tests` WHERE `successful` = 1 AND `build_id` = ?", [row['id']])
-  have_tests = set(map(lambda x: x['name'], res.fetchall()))
-  sql.close()
-  for x in AreWeSlimYetTests:
-    if not x in have_tests:
-      return True
+  complete = all(x in have_tests for x in AreWeSlimYetTests)
+  if not complete:
+    return True
 
   build.note = "Build has complete test data"
   if build.force:
@@ -127,6 +137,7 @@ def run_tests(build, args):
       if not tester.run_test(testname, testinfo['type'], testinfo['vars']):
         raise Exception("SlimTest: Failed at test %s -- Errors: %s -- Warnings: %s\n" % (testname, tester.errors, tester.warnings))
   finally:
+    tester.close_db()
     subprocess.check_output([ "vncserver", "-kill", display ])
 
   if len(tester.errors):
@@ -29,7 +29,7 @@ util/queue_tinderbox_builds.py html/status/batch last_tinderbox.json mozilla-inb
 flock -n ~/mobile.lck tester_scripts/import.sh
 
 # Update all json exports
-for x in db/areweslimyet-*.sqlite db/custom-*.sqlite; do
+for x in $(python benchtester/BenchDB.py --dbdir db shards) db/custom-*.sqlite; do
   if [ -f "$x".xz ]; then
       echo ":: Skipping $x due to presence of .xz"
       continue
@@ -37,7 +37,7 @@ for x in db/areweslimyet-*.sqlite db/custom-*.sqlite; do
   s="$(basename "${x%.sqlite}")"
   s="${s#custom-}"
   if [ -e "$x" ]; then
-    ./create_graph_json.py "$x" "$s" html/data
+    ./create_graph_json.py --binary "$x" "$s" html/data
   fi
 done
 
@@ -50,11 +50,11 @@ for x in db/custom-*.sqlite; do
   s="$(basename "${x%.sqlite}")"
   s="${s#custom-}"
   if [ -e "$x" ]; then
-    ./merge_graph_json.py "${s%-x}" html/data
+    ./merge_graph_json.py --binary --lod "${s%-x}" html/data
   fi
 done
 
-./merge_graph_json.py areweslimyet html/data
+./merge_graph_json.py --binary --lod areweslimyet html/data
 
 # Sync with mirror
 # To turn off data sync add: --exclude=data
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+import mozfile
+
+from benchtester import BatchTester
+
+class BatchTesterTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    mozfile.remove(self.temp_dir)
+
+  def test_event_queue(self):
+    events = BatchTester.EventQueue()
+    self.assertEqual(events.wait(0), [])
+    events.put('builder')
+    events.put('test', 1, True)
+    self.assertEqual(events.wait(0), [('builder',), ('test', 1, True)])
+
+    # Wakes up as soon as an event comes from another thread
+    timer = threading.Timer(0.1, events.put, ['builder'])
+    timer.start()
+    start = time.time()
+    self.assertEqual(events.wait(10), [('builder',)])
+    self.assertLess(time.time() - start, 5)
+    timer.join()
+
+  def test_watch_dir(self):
+    events = BatchTester.EventQueue()
+    BatchTester.watch_dir(events, self.temp_dir)
+    with open(os.path.join(self.temp_dir, 'batch'), 'w') as f:
+      f.write('{}')
+    self.assertIn(('dir', self.temp_dir), events.wait(10))
+
+  def test_watch_dir_polling(self):
+    # Without inotify, a thread checks the directory
+    events = BatchTester.EventQueue()
+    with mock.patch.object(BatchTester.ctypes, 'CDLL', side_effect=OSError), \
+         mock.patch.object(BatchTester, 'gDirPollInterval', 0.01):
+      BatchTester.watch_dir(events, self.temp_dir)
+      with open(os.path.join(self.temp_dir, 'batch'), 'w') as f:
+        f.write('{}')
+      self.assertIn(('dir', self.temp_dir), events.wait(10))
+      os.remove(os.path.join(self.temp_dir, 'batch'))
+
+  def test_can_prepare(self):
+    tester = BatchTester.BatchTest({'processes': 2, 'prepare_jobs': 3}, out=None)
+    building = tester.builds['building']
+    prepared = tester.builds['prepared']
+    # Up to --processes builds' worth, at the assumed size at first
+    self.assertTrue(tester.can_prepare())
+    building.append(mock.Mock())
+    self.assertTrue(tester.can_prepare())
+    building.append(mock.Mock())
+    self.assertFalse(tester.can_prepare())
+
+    # Then at the largest prepared build so far
+    tester.build_size = 100
+    prepared.append(mock.Mock(size=50))
+    building.pop()
+    self.assertFalse(tester.can_prepare())
+    tester.args['prepare_disk'] = 1
+    self.assertTrue(tester.can_prepare())
+    # No more than --prepare-jobs at once
+    building.extend([mock.Mock(), mock.Mock()])
+    self.assertFalse(tester.can_prepare())
+
+    # A build bigger than the budget still gets prepared on its own
+    del building[:], prepared[:]
+    tester.build_size = 2 * 1024 * 1024
+    self.assertTrue(tester.can_prepare())
+    building.append(mock.Mock())
+    self.assertFalse(tester.can_prepare())
+
+  def test_prepare_options(self):
+    with mock.patch('sys.stderr'):
+      for value in ('0', '-1'):
+        self.assertRaises(SystemExit, BatchTester.BatchTestCLI, ['--prepare-jobs', value])
+        self.assertRaises(SystemExit, BatchTester.BatchTestCLI, ['--prepare-disk', value])
+    tester = BatchTester.BatchTestCLI(['--prepare-jobs', '3'])
+    self.assertEqual(tester.args['prepare_jobs'], 3)
+    self.assertIsNone(tester.args['prepare_disk'])
+
+
+if __name__ == '__main__':
+  unittest.main()
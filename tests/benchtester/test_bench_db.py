@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+import os
+import sqlite3
+import subprocess
+import tempfile
+import time
+import unittest
+
+import mock
+import mozfile
+
+from benchtester import BenchDB
+from benchtester.BenchTester import BenchTester
+
+def make_results(value):
+  return [[{'label': 'TabsOpen',
+            'reports': {
+                'Main': {
+                    'explicit': {'val': value, 'unit': 0, 'kind': 1},
+                    'explicit/images': {'val': value / 10, 'unit': 0, 'kind': 1}
+                }
+            }}]]
+
+# Mid-month timestamps, so local time vs UTC doesn't matter
+def timestamp(year, month, day=15):
+  return int(time.mktime(datetime.date(year, month, day).timetuple()))
+
+class BenchDBTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.router = BenchDB.ShardRouter(self.temp_dir)
+
+  def tearDown(self):
+    mozfile.remove(self.temp_dir)
+
+  def add_build(self, buildname, buildtime, value, testname='Slimtest'):
+    tester = BenchTester()
+    tester.args['sqlitedb'] = self.router.shard_for_time(buildtime)
+    tester.buildname = buildname
+    tester.buildtime = str(buildtime)
+    tester.repo = 'mozilla-inbound'
+    self.assertTrue(tester.add_test_results(testname, make_results(value)))
+    tester.close_db()
+
+  def test_pack_reports(self):
+    entries = [(7, 2 ** 40, 0, 1), (3, -1, 3, 2), (1000, 0, 1, 0)]
+    packed = BenchDB.pack_reports(entries)
+    self.assertEqual(BenchDB.unpack_reports(*packed), sorted(entries))
+    self.assertEqual(BenchDB.unpack_reports(*BenchDB.pack_reports([])), [])
+
+  def test_node_tree(self):
+    tree = BenchDB.NodeTree('/')
+    tree.add('Main/explicit/a', 10, 'bytes')
+    tree.add('Main/explicit/b', 5, 'bytes')
+    tree.add('Main/explicit/b/c', None, 'bytes')
+    tree.add('Main/resident', 100, 'bytes')
+    tree.add('Main/count', 3, 'cnt')
+    self.assertEqual(tree.as_dict(), {
+        '_val': None, '_units': None,
+        'Main': {'_val': 118, '_units': 'mixed',
+                 'explicit': {'_val': 15, 'a': 10, 'b': {'_val': 5, 'c': None}},
+                 'resident': 100,
+                 'count': {'_val': 3, '_units': 'cnt'}}
+    })
+    self.assertEqual(BenchDB.NodeTree('/').as_dict(), {'_val': None, '_units': None})
+
+  def test_series_resolver(self):
+    resolver = BenchDB.SeriesResolver({
+        'Explicit': ['Iteration 5/TabsOpen/Main/explicit', 'Iteration 5/TabsOpen/explicit'],
+        'Images': 'Iteration 5/TabsOpen/Main/explicit/images',
+        'Heap': ['Iteration 5/TabsOpen/Main/heap', 'Iteration 5/TabsOpen/Main/resident'],
+        'Missing': 'Iteration 1/Start/Main/explicit'
+    }, '/')
+    resolver.add(5, 'TabsOpen', 'Main', 'explicit/images/a', 10, 'bytes')
+    resolver.add(5, 'TabsOpen', 'Main', 'explicit/images/b', 5, 'bytes')
+    resolver.add(5, 'TabsOpen', 'Main', 'explicit/other', None, 'bytes')
+    # A zero value doesn't count as present
+    resolver.add(5, 'TabsOpen', 'Main', 'heap', 0, 'bytes')
+    resolver.add(5, 'TabsOpen', 'Main', 'resident', 100, 'bytes')
+    resolver.add(5, 'TabsClosed', 'Main', 'explicit', 1, 'bytes')
+    self.assertEqual(resolver.values(),
+                     {'Explicit': 15, 'Images': 15, 'Heap': 100, 'Missing': None})
+
+    resolver.reset()
+    resolver.add(5, 'TabsOpen', 'Main', 'explicit', 20, 'bytes')
+    resolver.add(5, 'TabsOpen', 'Main', 'explicit/images', 3, 'bytes')
+    self.assertEqual(resolver.values(),
+                     {'Explicit': 20, 'Images': 3, 'Heap': None, 'Missing': None})
+
+  def test_shard_selection(self):
+    self.assertEqual(self.router.shard_for_time(timestamp(2015, 1)),
+                     os.path.join(self.temp_dir, 'areweslimyet-2015-01.sqlite'))
+    self.assertEqual(self.router.custom_shard('bug_123'),
+                     os.path.join(self.temp_dir, 'custom-bug_123-x.sqlite'))
+
+    for month in (3, 1, 2):
+      self.add_build('build%u' % month, timestamp(2015, month), 1000)
+    open(os.path.join(self.temp_dir, 'areweslimyet-2015-02.sqlite.xz'), 'w').close()
+
+    self.assertEqual([os.path.basename(x) for x in self.router.shards()],
+                     ['areweslimyet-2015-01.sqlite', 'areweslimyet-2015-03.sqlite'])
+    self.assertEqual([os.path.basename(x) for x in
+                      self.router.shards(timestamp(2015, 2), timestamp(2015, 4))],
+                     ['areweslimyet-2015-03.sqlite'])
+
+  def test_latest_test(self):
+    self.add_build('abc', timestamp(2015, 1), 1000)
+    self.add_build('abc', timestamp(2015, 1), 2000)
+    self.add_build('def', timestamp(2015, 2), 3000)
+
+    latest = self.router.latest_test('abc', 'Slimtest')
+    self.assertEqual(latest['shard'], self.router.shard_for_time(timestamp(2015, 1)))
+    self.assertEqual(latest['test_id'], 2)
+    self.assertEqual(self.router.latest_test('def', 'Slimtest', timestamp(2015, 2))['test_id'], 1)
+    self.assertIsNone(self.router.latest_test('def', 'Slimtest', timestamp(2015, 1)))
+    self.assertIsNone(self.router.latest_test('abc', 'Other'))
+
+  def test_series(self):
+    expected = []
+    for month in range(1, 6):
+      for day in (10, 20):
+        buildtime = timestamp(2015, month, day)
+        self.add_build('b%u-%u' % (month, day), buildtime, month * 1000 + day)
+        expected.append((buildtime, 'b%u-%u' % (month, day), (month * 1000 + day) / 10))
+
+    series = list(self.router.series('Slimtest', 'Iteration 1/TabsOpen/Main/explicit/images'))
+    self.assertEqual(series, expected)
+
+    series = list(self.router.series('Slimtest', 'Iteration 1/TabsOpen/Main/explicit/images',
+                                     timestamp(2015, 2, 15), timestamp(2015, 4, 15)))
+    self.assertEqual(series, expected[3:7])
+
+    self.assertEqual(list(self.router.series('Slimtest', 'Iteration 1/Start/Main/explicit')), [])
+
+  def test_series_deduped(self):
+    # explicit/a changes every checkpoint, explicit/b and explicit/d never do,
+    # and explicit/c is missing from the last one
+    results = [[{'label': label,
+                 'reports': {'Main': dict(
+                     [('explicit/a', {'val': x, 'unit': 0, 'kind': 1}),
+                      ('explicit/b', {'val': 20, 'unit': 0, 'kind': 1}),
+                      ('explicit/d', {'val': 40, 'unit': 0, 'kind': 1})] +
+                     ([('explicit/c', {'val': 30, 'unit': 0, 'kind': 1})] if x < 2 else []))}}
+                for x, label in enumerate(['Start', 'TabsOpen', 'TabsClosed'])]]
+    tester = BenchTester()
+    tester.args['sqlitedb'] = self.router.shard_for_time(timestamp(2015, 1))
+    tester.args['dedup_values'] = True
+    tester.buildname = 'abc'
+    tester.buildtime = str(timestamp(2015, 1))
+    tester.repo = 'mozilla-inbound'
+    self.assertTrue(tester.add_test_results('Slimtest', results))
+    tester.close_db()
+
+    for datapoint, value in [('TabsClosed/Main/explicit/a', 2),
+                             ('TabsClosed/Main/explicit/b', 20),
+                             ('TabsOpen/Main/explicit/d', 40),
+                             ('TabsOpen/Main/explicit/c', 30),
+                             ('TabsClosed/Main/explicit/c', None)]:
+      series = list(self.router.series('Slimtest', 'Iteration 1/' + datapoint))
+      self.assertEqual([x[2] for x in series], [value])
+
+    sql = sqlite3.connect(tester.args['sqlitedb'])
+    self.assertEqual(sql.execute('''SELECT COUNT(*) FROM benchtester_packed_data
+                                    WHERE base_checkpoint_id IS NOT NULL''').fetchone()[0], 2)
+    sql.close()
+
+  def test_connection_pool(self):
+    pool = BenchDB.ConnectionPool(idle_timeout=60)
+    path = os.path.join(self.temp_dir, 'pool.sqlite')
+
+    with pool.connection(path) as sql:
+      sql.row_factory = sqlite3.Row
+      sql.execute("CREATE TABLE t (x)")
+      sql.execute("INSERT INTO t VALUES (1)")
+      first = sql
+    pool.cache(path)['checked'] = True
+
+    # The same connection comes back, minus our uncommitted insert and
+    # row_factory
+    with pool.connection(path) as sql:
+      self.assertIs(sql, first)
+      self.assertIsNone(sql.row_factory)
+      self.assertEqual(sql.execute("SELECT COUNT(*) FROM t").fetchone()[0], 0)
+      # In use, so we get another
+      with pool.connection(path) as other:
+        self.assertIsNot(other, first)
+    self.assertTrue(pool.cache(path)['checked'])
+
+    # Replacing the file invalidates both the connection and the cache
+    os.rename(path, path + '.old')
+    open(path, 'w').close()
+    with pool.connection(path) as sql:
+      self.assertIsNot(sql, first)
+    self.assertEqual(pool.cache(path), {})
+
+    # Unless told not to keep it
+    sql = pool.checkout(path)
+    pool.checkin(sql, keep=False)
+    self.assertRaises(sqlite3.ProgrammingError, sql.execute, "SELECT 1")
+    with pool.connection(path) as other:
+      self.assertIsNot(other, sql)
+
+    # Idle connections expire
+    pool.idle_timeout = 0
+    with pool.connection(path) as sql:
+      pass
+    with pool.connection(path) as other:
+      self.assertIsNot(other, sql)
+
+  def test_tester_reuses_connection(self):
+    self.add_build('abc', timestamp(2015, 1), 1000)
+    tester = BenchTester()
+    tester.args['sqlitedb'] = self.router.shard_for_time(timestamp(2015, 1))
+    tester.buildname = 'def'
+    tester.buildtime = str(timestamp(2015, 1))
+    tester.repo = 'mozilla-inbound'
+    # The schema was checked by the last tester
+    with mock.patch.object(tester, 'verify_db') as verify:
+      self.assertTrue(tester.add_test_results('Slimtest', make_results(2000)))
+      self.assertFalse(verify.called)
+    tester.close_db()
+    self.assertEqual(self.router.latest_test('def', 'Slimtest')['test_id'], 2)
+
+  def test_query_plans(self):
+    self.add_build('abc', timestamp(2015, 1), 1000)
+    sql = sqlite3.connect(self.router.shard_for_time(timestamp(2015, 1)))
+    self.assertEqual(BenchDB.check_query_plans(sql), [])
+    sql.close()
+
+  def test_index_upgrade(self):
+    shard = self.router.shard_for_time(timestamp(2015, 1))
+    self.add_build('abc', timestamp(2015, 1), 1000)
+
+    # Put back the original index set
+    sql = sqlite3.connect(shard)
+    for name, definition in BenchDB.gIndexes:
+      sql.execute("DROP INDEX %s" % (name,))
+    sql.execute("CREATE INDEX test_lookup ON benchtester_tests ( name, build_id DESC )")
+    sql.execute("PRAGMA user_version = 0")
+    sql.commit()
+    self.assertNotEqual(BenchDB.check_query_plans(sql), [])
+    sql.close()
+    BenchDB.gPool.forget(shard)
+
+    # Opening it for writing upgrades it
+    self.add_build('def', timestamp(2015, 1), 2000)
+    sql = sqlite3.connect(shard)
+    self.assertEqual(sql.execute("PRAGMA user_version").fetchone()[0], BenchDB.gIndexVersion)
+    self.assertEqual([x[2] for x in sql.execute("PRAGMA index_info(test_lookup)")],
+                     ['build_id', 'name', 'successful', 'time'])
+    self.assertEqual(BenchDB.check_query_plans(sql), [])
+    sql.close()
+    self.assertEqual(self.router.latest_test('abc', 'Slimtest')['test_id'], 1)
+
+  def test_archive_cache(self):
+    for month in (1, 2):
+      self.add_build('build%u' % month, timestamp(2015, month), month * 1000)
+    # Like archive_db.sh, wait for everyone to close the database first
+    BenchDB.gPool.close_idle()
+    archived = self.router.shard_for_time(timestamp(2015, 1))
+    subprocess.check_call(['xz', '-f', archived])
+
+    # Without a cache archives are skipped
+    self.assertEqual(len(self.router.shards()), 1)
+    self.assertIsNone(self.router.latest_test('build1', 'Slimtest'))
+
+    cachedir = os.path.join(self.temp_dir, 'archive-cache')
+    router = BenchDB.ShardRouter(self.temp_dir,
+                                 archive_cache=BenchDB.ArchiveCache(cachedir, max_bytes=1))
+    self.assertEqual(len(router.shards()), 2)
+    self.assertEqual(router.latest_test('build1', 'Slimtest')['test_id'], 1)
+    self.assertEqual([x[2] for x in router.series('Slimtest', 'Iteration 1/TabsOpen/Main/explicit')],
+                     [1000, 2000])
+    self.assertEqual(os.listdir(cachedir), ['areweslimyet-2015-01.sqlite'])
+
+    # The copy is read-only, and has its indexes back
+    with router.connection(archived) as sql:
+      self.assertRaises(sqlite3.OperationalError, sql.execute, "DELETE FROM benchtester_tests")
+      indexes = [x[0] for x in sql.execute("SELECT name FROM sqlite_master WHERE type = 'index'")]
+      self.assertIn('test_lookup', indexes)
+
+    # Archiving another month evicts the first copy, as we're over our (tiny)
+    # size limit
+    BenchDB.gPool.close_idle()
+    subprocess.check_call(['xz', '-f', self.router.shard_for_time(timestamp(2015, 2))])
+    self.assertEqual(router.latest_test('build2', 'Slimtest')['test_id'], 1)
+    self.assertEqual(os.listdir(cachedir), ['areweslimyet-2015-02.sqlite'])
+
+
+if __name__ == '__main__':
+  unittest.main()
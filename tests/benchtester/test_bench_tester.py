@@ -4,11 +4,363 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import os
+import sqlite3
+import subprocess
 import sys
+import tempfile
 import unittest
 
+import mock
+import mozfile
+
+from benchtester import BenchDB
+from benchtester import BenchTester as BenchTesterModule
 from benchtester.BenchTester import BenchTester
 
+# Two iterations of two checkpoints, the second with an extra process
+TEST_RESULTS = [
+    [
+        {'label': 'Start',
+         'reports': {
+             'Main': {
+                 'explicit/a': {'val': 10, 'unit': 0, 'kind': 1},
+                 'explicit/b': {'val': 20, 'unit': 0, 'kind': 1},
+                 'resident': {'val': 100, 'unit': 0, 'kind': 2}
+             }
+         }},
+        {'label': 'TabsOpen',
+         'reports': {
+             'Main': {
+                 'explicit/a': {'val': 11, 'unit': 0, 'kind': 1},
+                 'explicit/c': {'val': 30, 'unit': 0, 'kind': 1},
+                 'resident': {'val': 110, 'unit': 0, 'kind': 2}
+             },
+             'Web Content (123)': {
+                 'explicit/a': {'val': 5, 'unit': 0, 'kind': 1},
+                 'resident': {'val': 50, 'unit': 0, 'kind': 2}
+             }
+         }}
+    ],
+    [
+        {'label': 'Start',
+         'reports': {
+             'Main': {
+                 'explicit/a': {'val': 12, 'unit': 0, 'kind': 1},
+                 'resident': {'val': 120, 'unit': 0, 'kind': 2}
+             }
+         }}
+    ]
+]
+
+# Two iterations of three checkpoints, where only explicit/a changes, and
+# explicit/c is missing from TabsClosed
+def dedup_results():
+  results = []
+  for iteration in range(2):
+    checkpoints = []
+    for x, label in enumerate(['Start', 'TabsOpen', 'TabsClosed']):
+      reports = {
+          'explicit/a': {'val': iteration * 100 + x, 'unit': 0, 'kind': 1},
+          'explicit/b': {'val': 20, 'unit': 0, 'kind': 1},
+          'explicit/c': {'val': 30, 'unit': 0, 'kind': 1},
+          'resident': {'val': 1000, 'unit': 0, 'kind': 2}
+      }
+      if label == 'TabsClosed':
+        del reports['explicit/c']
+      checkpoints.append({'label': label, 'reports': {'Main': reports}})
+    results.append(checkpoints)
+  return results
+
+def expected_rows(results):
+  rows = []
+  for x, iteration in enumerate(results):
+    for checkpoint in iteration:
+      mapping = BenchTester.map_process_names(checkpoint['reports'])
+      for proc, reports in checkpoint['reports'].items():
+        for name, dp in reports.items():
+          rows.append((name, checkpoint['label'], mapping[proc], x + 1,
+                       dp['val'], dp['unit'], dp['kind']))
+  return sorted(rows)
+
+def read_rows(db, test_id, row_factory=None):
+  sql = sqlite3.connect(db)
+  sql.row_factory = row_factory
+  rows = BenchDB.DataReader(sql).read_test(test_id)
+  rows = sorted(tuple(r) for r in rows)
+  sql.close()
+  return rows
+
+class BenchTesterDBTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.db = os.path.join(self.temp_dir, 'test.sqlite')
+
+  def tearDown(self):
+    mozfile.remove(self.temp_dir)
+
+  def open_tester(self, buildname='abcdef', buildtime='1422727955'):
+    tester = BenchTester()
+    tester.args['sqlitedb'] = self.db
+    tester.buildname = buildname
+    tester.buildtime = buildtime
+    tester.repo = 'mozilla-inbound'
+    self.assertTrue(tester._open_db())
+    return tester
+
+  def test_insert_results(self):
+    tester = self.open_tester()
+    self.assertTrue(tester.add_test_results('Slimtest', TEST_RESULTS))
+    self.assertEqual(read_rows(self.db, 1), expected_rows(TEST_RESULTS))
+
+  def test_insert_results_v1(self):
+    # Version 1 databases keep getting a row per datapoint
+    sql = sqlite3.connect(self.db)
+    for schema in BenchTesterModule.gTableSchemas:
+      sql.execute(schema)
+    sql.execute("INSERT INTO benchtester_version (version) VALUES (1)")
+    sql.commit()
+    sql.close()
+
+    tester = self.open_tester()
+    self.assertEqual(tester.db_version, 1)
+    self.assertTrue(tester.add_test_results('Slimtest', TEST_RESULTS))
+    self.assertEqual(read_rows(self.db, 1), expected_rows(TEST_RESULTS))
+
+    sql = sqlite3.connect(self.db)
+    self.assertEqual(sql.execute("SELECT COUNT(*) FROM benchtester_data").fetchone()[0],
+                     len(expected_rows(TEST_RESULTS)))
+    self.assertEqual(sql.execute("SELECT COUNT(*) FROM benchtester_packed_data").fetchone()[0], 0)
+    sql.close()
+
+  def test_insert_results_packed(self):
+    tester = self.open_tester()
+    self.assertEqual(tester.db_version, 3)
+    self.assertTrue(tester.add_test_results('Slimtest', TEST_RESULTS))
+
+    # One row per test/checkpoint/process/iteration
+    sql = sqlite3.connect(self.db)
+    self.assertEqual(sql.execute("SELECT COUNT(*) FROM benchtester_data").fetchone()[0], 0)
+    self.assertEqual(sql.execute("SELECT COUNT(*) FROM benchtester_packed_data").fetchone()[0], 4)
+    sql.close()
+
+  def test_upgrade_v2(self):
+    # Version 2 databases are upgraded in place, keeping their data
+    sql = sqlite3.connect(self.db)
+    sql.execute('''CREATE TABLE benchtester_packed_data
+                   (test_id, checkpoint_id, proc_id, iteration,
+                    datapoint_ids, `values`, units, kinds)''')
+    for schema in BenchTesterModule.gTableSchemas:
+      sql.execute(schema)
+    sql.execute("INSERT INTO benchtester_version (version) VALUES (2)")
+    sql.commit()
+    sql.close()
+
+    tester = self.open_tester()
+    self.assertEqual(tester.db_version, 3)
+    self.assertTrue(tester.add_test_results('Slimtest', TEST_RESULTS))
+    tester.args['dedup_values'] = True
+    self.assertTrue(tester.add_test_results('Slimtest', dedup_results()))
+    self.assertEqual(read_rows(self.db, 1), expected_rows(TEST_RESULTS))
+    self.assertEqual(read_rows(self.db, 2), expected_rows(dedup_results()))
+
+  def test_dedup_values(self):
+    tester = self.open_tester()
+    tester.args['dedup_values'] = True
+    self.assertTrue(tester.add_test_results('Slimtest', dedup_results()))
+    self.assertEqual(read_rows(self.db, 1), expected_rows(dedup_results()))
+    # create_graph_json.py reads with sqlite3.Row
+    self.assertEqual(read_rows(self.db, 1, sqlite3.Row), expected_rows(dedup_results()))
+
+    # Only the first row is stored in full, the others just hold the changes
+    # (including explicit/c going away and coming back)
+    sql = sqlite3.connect(self.db)
+    rows = sql.execute('''SELECT datapoint_ids, `values`, units, kinds, base_checkpoint_id
+                          FROM benchtester_packed_data ORDER BY rowid''').fetchall()
+    sql.close()
+    self.assertEqual([len(BenchDB.unpack_reports(*row[:4])) for row in rows],
+                     [4, 1, 2, 2, 1, 2])
+    self.assertEqual([row[4] is None for row in rows], [True] + [False] * 5)
+
+    # The same test without dedup stores everything
+    tester.args['dedup_values'] = False
+    self.assertTrue(tester.add_test_results('Slimtest', dedup_results()))
+    self.assertEqual(read_rows(self.db, 2), expected_rows(dedup_results()))
+
+  def test_dedup_values_streaming(self):
+    # A failed checkpoint mustn't leave later rows referring to it
+    tester = self.open_tester()
+    tester.args['dedup_values'] = True
+    results = dedup_results()
+    test_id = tester.begin_test('Slimtest')
+    self.assertTrue(tester.add_checkpoint(test_id, 1, results[0][0]))
+    self.assertFalse(tester.add_checkpoint(test_id, 1, {'label': 'Broken',
+                                                        'reports': {'Main': None}}))
+    for x, iteration in enumerate(results):
+      for checkpoint in iteration[1 if x == 0 else 0:]:
+        self.assertTrue(tester.add_checkpoint(test_id, x + 1, checkpoint))
+    self.assertTrue(tester.end_test(test_id, True))
+    self.assertEqual(read_rows(self.db, test_id), expected_rows(results))
+
+  def test_read_tests(self):
+    tester = self.open_tester()
+    self.assertTrue(tester.add_test_results('Slimtest', TEST_RESULTS))
+    tester.args['dedup_values'] = True
+    self.assertTrue(tester.add_test_results('Slimtest', dedup_results()))
+    tester.close_db()
+
+    sql = sqlite3.connect(self.db)
+    sql.execute("UPDATE benchtester_tests SET time = id * 100")
+    sql.commit()
+    reader = BenchDB.DataReader(sql)
+    expected = [(1, expected_rows(TEST_RESULTS)), (2, expected_rows(dedup_results()))]
+    for block_size in (1, 200):
+      with mock.patch.object(BenchDB, 'gReadBlockSize', block_size):
+        tests = reader.read_tests([2, None, 1, 99, 2])
+        self.assertEqual([(test_id, sorted(tuple(r) for r in rows)) for test_id, rows in tests],
+                         expected)
+
+    # Both tests are of the same build, the second is the latest. Without
+    # window functions this falls back to a GROUP BY.
+    self.assertEqual(reader.latest_tests(), {(1, 'Slimtest'): (2, 200)})
+    with mock.patch.object(BenchDB, 'gLatestTestsQuery', 'SELECT no_such_column'):
+      self.assertEqual(reader.latest_tests(), {(1, 'Slimtest'): (2, 200)})
+    sql.close()
+
+  def test_change_log(self):
+    def changes(since=0):
+      sql = sqlite3.connect(self.db)
+      rows = sql.execute(BenchDB.gQueries['changed_builds'], [since]).fetchall()
+      sql.close()
+      return [row[0] for row in rows]
+
+    tester = self.open_tester()
+    self.assertTrue(tester.add_test_results('Slimtest', TEST_RESULTS))
+    tester.close_db()
+    self.assertEqual(set(changes()), set(['abcdef']))
+    last = len(changes())
+
+    tester = self.open_tester(buildname='123456')
+    self.assertTrue(tester.add_test_results('Slimtest', TEST_RESULTS))
+    tester.close_db()
+    self.assertEqual(set(changes(last)), set(['123456']))
+    last = len(changes())
+
+    # Hand edits are logged too
+    sql = sqlite3.connect(self.db)
+    sql.execute("DELETE FROM benchtester_tests WHERE build_id = 1")
+    sql.execute("UPDATE benchtester_builds SET name = 'fedcba' WHERE name = '123456'")
+    sql.commit()
+    sql.close()
+    self.assertEqual(set(changes(last)), set(['abcdef', '123456', 'fedcba']))
+
+  def test_insert_results_process_mode(self):
+    tester = self.open_tester()
+    tester.args['ingest_mode'] = 'process'
+    self.assertTrue(tester.add_test_results('Slimtest', TEST_RESULTS))
+    self.assertEqual(read_rows(self.db, 1), expected_rows(TEST_RESULTS))
+
+  def test_streaming_ingest(self):
+    tester = self.open_tester()
+    test_id = tester.begin_test('Slimtest')
+    self.assertEqual(test_id, 1)
+    for x, iteration in enumerate(TEST_RESULTS):
+      for checkpoint in iteration:
+        self.assertTrue(tester.add_checkpoint(test_id, x + 1, checkpoint))
+
+        # Each checkpoint is visible as soon as it's added, but the test isn't
+        # successful yet
+        sql = sqlite3.connect(self.db)
+        self.assertEqual(sql.execute("SELECT successful FROM benchtester_tests").fetchone()[0], 0)
+        sql.close()
+
+    self.assertTrue(tester.end_test(test_id, True))
+    self.assertEqual(read_rows(self.db, test_id), expected_rows(TEST_RESULTS))
+    sql = sqlite3.connect(self.db)
+    self.assertEqual(sql.execute("SELECT successful FROM benchtester_tests").fetchone()[0], 1)
+    sql.close()
+
+  def test_atomic_ingest_rollback(self):
+    # A failure part way through must not leave a partial test behind
+    broken = [TEST_RESULTS[0] + [{'label': 'Broken', 'reports': None}]]
+    tester = self.open_tester()
+    self.assertFalse(tester.add_test_results('Slimtest', broken))
+
+    sql = sqlite3.connect(self.db)
+    self.assertEqual(sql.execute("SELECT COUNT(*) FROM benchtester_tests").fetchone()[0], 0)
+    self.assertEqual(sql.execute("SELECT COUNT(*) FROM benchtester_data").fetchone()[0], 0)
+    self.assertEqual(sql.execute("PRAGMA journal_mode").fetchone()[0], 'wal')
+    sql.close()
+
+    # The tester can still add results afterwards
+    self.assertTrue(tester.add_test_results('Slimtest', TEST_RESULTS))
+    self.assertEqual(read_rows(self.db, 1), expected_rows(TEST_RESULTS))
+
+  def test_id_cache_shared_db(self):
+    # Two testers writing into one database must not hand out the same ids
+    a = self.open_tester('aaaaaa')
+    b = self.open_tester('bbbbbb')
+    self.assertTrue(a.add_test_results('Slimtest', TEST_RESULTS[:1]))
+    self.assertTrue(b.add_test_results('Slimtest', TEST_RESULTS))
+    self.assertTrue(a.add_test_results('Slimtest', TEST_RESULTS[1:]))
+    self.assertEqual(read_rows(self.db, 1), expected_rows(TEST_RESULTS[:1]))
+    self.assertEqual(read_rows(self.db, 2), expected_rows(TEST_RESULTS))
+
+    sql = sqlite3.connect(self.db)
+    names = [r[0] for r in sql.execute("SELECT name FROM benchtester_datapoints")]
+    sql.close()
+    self.assertEqual(sorted(names), ['explicit/a', 'explicit/b', 'explicit/c', 'resident'])
+
+  def test_reopen_checks_schema(self):
+    # A new process, with nothing cached, only reads the schema of an up to
+    # date database
+    tester = self.open_tester()
+    self.assertTrue(tester.add_test_results('Slimtest', TEST_RESULTS))
+    tester.close_db()
+    BenchDB.gPool.forget(self.db)
+    with mock.patch.object(BenchDB, 'create_indexes') as create_indexes:
+      tester = self.open_tester()
+      self.assertFalse(create_indexes.called)
+    tester.close_db()
+
+    # Anything missing is put back
+    sql = sqlite3.connect(self.db)
+    sql.execute("DROP INDEX test_lookup")
+    sql.execute("DROP TRIGGER benchtester_changes_test_insert")
+    sql.close()
+    BenchDB.gPool.forget(self.db)
+    tester = self.open_tester()
+    self.assertTrue(tester.add_test_results('Slimtest', TEST_RESULTS))
+    tester.close_db()
+    sql = sqlite3.connect(self.db)
+    self.assertTrue(BenchTester.schema_current(sql.cursor()))
+    sql.close()
+
+  def test_trim_db(self):
+    # util/trim_db.sh keeps the datapoint names packed rows refer to
+    tester = self.open_tester()
+    self.assertTrue(tester.add_test_results('Slimtest', TEST_RESULTS))
+    tester.args['dedup_values'] = True
+    self.assertTrue(tester.add_test_results('Slimtest', dedup_results()))
+    tester.close_db()
+
+    sql = sqlite3.connect(self.db)
+    sql.execute("INSERT INTO benchtester_datapoints (name) VALUES ('unused')")
+    sql.execute("DELETE FROM benchtester_tests WHERE id = 2")
+    sql.commit()
+    sql.close()
+
+    script = os.path.join(os.path.dirname(__file__), '..', '..', 'util', 'trim_db.sh')
+    subprocess.check_output([script, self.db], stderr=subprocess.STDOUT)
+    self.assertEqual(read_rows(self.db, 1), expected_rows(TEST_RESULTS))
+    sql = sqlite3.connect(self.db)
+    names = [r[0] for r in sql.execute("SELECT name FROM benchtester_datapoints")]
+    tests = [r[0] for r in sql.execute("SELECT DISTINCT test_id FROM benchtester_packed_data")]
+    sql.close()
+    self.assertEqual(sorted(names), ['explicit/a', 'explicit/b', 'explicit/c', 'resident'])
+    self.assertEqual(tests, [1])
+
 class BenchTesterTest(unittest.TestCase):
 
   def test_process_name_mapping(self):
@@ -161,10 +161,13 @@ class BuildGetterTest(mhttpd.MozHttpdBaseTest):
     self.assertTrue(os.path.exists(binary))
     self.assertEqual(ftp_build.get_revision(), "a7d50e410ced2f0335bab09c7cc65ff2d2733b97")
     self.assertEqual(ftp_build.get_buildtime(), 1422654729)
+    # The extracted build and its archive
+    self.assertGreater(ftp_build.get_size(), os.path.getsize(binary))
 
     ftp_build.cleanup()
 
     self.assertFalse(os.path.exists(binary))
+    self.assertEqual(ftp_build.get_size(), 0)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import gzip
+import json
+import os
+import random
+import unittest
+
+import mock
+
+from benchtester import GraphCondense
+from benchtester import GraphJSON
+
+DAY = GraphCondense.gDay
+
+TEST_DATA = {
+    'builds': [{'revision': 'a', 'time': DAY + 10},
+               {'revision': 'b', 'time': DAY + 20},
+               {'revision': 'c', 'time': DAY + 30},
+               {'revision': 'd', 'time': 3 * DAY + 5},
+               {'revision': 'e', 'time': 4 * DAY}],
+    'series': {'Explicit': [30, None, 10, 5, None],
+               'Same': [7, 7, 7, None, None],
+               'Float': [1.5, 0.5, 2.5, None, 1.0]}
+}
+
+
+class GraphCondenseTest(unittest.TestCase):
+
+  def condense(self, data, aggregates=(), level='day'):
+    result = GraphCondense.condense_data(data, aggregates, level)
+    if GraphCondense.numpy:
+      with mock.patch.object(GraphCondense, 'numpy', None):
+        self.assertEqual(GraphCondense.condense_data(data, aggregates, level), result)
+    return result
+
+  def test_condense_data(self):
+    cdata = self.condense(TEST_DATA)
+    self.assertEqual(cdata['builds'], [
+        {'firstrev': 'a', 'lastrev': 'c', 'time': DAY, 'count': 3,
+         'timerange': [DAY + 10, DAY + 30]},
+        {'firstrev': 'd', 'time': 3 * DAY + 5},
+        {'firstrev': 'e', 'time': 4 * DAY}])
+    self.assertEqual(cdata['series'], {'Explicit': [[10, 30, 30], 5, None],
+                                       'Same': [7, None, None],
+                                       'Float': [[0.5, 1.5, 2.5], None, 1.0]})
+    self.assertNotIn('aggregates', cdata)
+    self.assertEqual(self.condense({'builds': [], 'series': {}}), {'builds': [], 'series': {}})
+
+  def test_aggregates(self):
+    cdata = self.condense(TEST_DATA, GraphCondense.gAggregates)
+    self.assertEqual(cdata['aggregates'], {
+        'mean': {'Explicit': [20.0, 5.0, None], 'Same': [7.0, None, None],
+                 'Float': [1.5, None, 1.0]},
+        'p10': {'Explicit': [10, 5, None], 'Same': [7, None, None], 'Float': [0.5, None, 1.0]},
+        'p90': {'Explicit': [10, 5, None], 'Same': [7, None, None], 'Float': [1.5, None, 1.0]}})
+    self.assertRaises(ValueError, GraphCondense.condense_data, TEST_DATA, ['p50'])
+
+  def test_levels(self):
+    # 1970-01-05 was a Monday, 1970-02-01 a Sunday
+    data = {'builds': [{'revision': 'a', 'time': 4 * DAY - 1},
+                       {'revision': 'b', 'time': 4 * DAY},
+                       {'revision': 'c', 'time': 31 * DAY - 1},
+                       {'revision': 'd', 'time': 31 * DAY + 1}],
+            'series': {'Explicit': [1, 2, 3, 4]}}
+    cdata = self.condense(data, level='week')
+    self.assertEqual([build['time'] for build in cdata['builds']], [4 * DAY - 1, 4 * DAY, 25 * DAY])
+    self.assertEqual(cdata['series']['Explicit'], [1, 2, [3, 4, 4]])
+    cdata = self.condense(data, level='month')
+    self.assertEqual([build['time'] for build in cdata['builds']], [0, 31 * DAY + 1])
+    self.assertEqual(cdata['builds'][0]['timerange'], [4 * DAY - 1, 31 * DAY - 1])
+    self.assertRaises(ValueError, GraphCondense.condense_data, data, level='year')
+
+  def test_chunk_data(self):
+    cdata = self.condense(TEST_DATA, ['mean'])
+    chunks = GraphCondense.chunk_data(cdata, 2)
+    self.assertEqual([len(chunk['builds']) for chunk in chunks], [2, 1])
+    self.assertEqual(chunks[1]['builds'], cdata['builds'][2:])
+    self.assertEqual(chunks[1]['series']['Float'], [1.0])
+    self.assertEqual(chunks[0]['aggregates']['mean']['Explicit'], [20.0, 5.0])
+    self.assertEqual(GraphCondense.chunk_data(TEST_DATA, 5), [TEST_DATA])
+
+  def test_extend_data(self):
+    total = GraphCondense.empty_data(['mean'])
+    GraphCondense.extend_data(total, {'builds': [1], 'series': {'a': [1]},
+                                      'aggregates': {'mean': {'a': [1.0]}}})
+    GraphCondense.extend_data(total, {'builds': [2, 3], 'series': {'b': [2, 3]}})
+    self.assertEqual(total, {'builds': [1, 2, 3],
+                             'series': {'a': [1, None, None], 'b': [None, 2, 3]},
+                             'aggregates': {'mean': {'a': [1.0, None, None]}}})
+
+  def test_merge(self):
+    # Joined up a file at a time, the same as all at once
+    files = [{'builds': [1, 2, 3], 'series': {'a': [1, 2, 3]}},
+             {'builds': [], 'series': {}},
+             {'builds': [4, 5], 'series': {'b': [4, 5]}},
+             {'builds': [6], 'series': {'a': [6]}}]
+    total = GraphCondense.empty_data()
+    chunks = []
+    chunker = GraphCondense.Chunker(2, chunks.append)
+    spool = GraphCondense.ColumnSpool()
+    try:
+      for data in files:
+        GraphCondense.extend_data(total, data)
+        chunker.extend(data)
+        spool.extend(data)
+      chunker.finish()
+      self.assertEqual(spool.data(encoded=False), total)
+      path = os.path.join(spool.dir, 'out.json.gz')
+      GraphJSON.write_json(path, spool.data(), depth=3)
+      self.assertEqual(json.load(gzip.open(path)), total)
+    finally:
+      spool.close()
+    self.assertFalse(os.path.exists(spool.dir))
+    # Except that series first appearing later are missing from earlier chunks
+    expected = GraphCondense.chunk_data(total, 2)
+    del expected[0]['series']['b']
+    self.assertEqual(chunks, expected)
+
+  def test_random(self):
+    # The NumPy and pure Python versions agree
+    rand = random.Random(1)
+    times = sorted(rand.randint(0, 30 * DAY) for x in range(500))
+    data = {'builds': [{'revision': str(i), 'time': t} for i, t in enumerate(times)],
+            'series': {}}
+    for name in ('a', 'b', 'c'):
+      data['series'][name] = [rand.choice([None, rand.randint(0, 2 ** 40)]) for t in times]
+    for level, length in GraphCondense.gLevels:
+      self.condense(data, GraphCondense.gAggregates, level)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import gzip
+import json
+import os
+import struct
+import tempfile
+import unittest
+import zlib
+
+import mock
+import mozfile
+
+from benchtester import GraphJSON
+
+TEST_DATA = {
+    'builds': [{'revision': 'abc', 'time': 1, 'test_ids': [1, None]},
+               {'revision': u'd\xe9f', 'time': 2, 'test_ids': [2, 3]}],
+    'series': {'Explicit': [100, None], 'Empty': []},
+    'generated': 12.5,
+    'nodes': {'Main': {'_val': 5, 'explicit': {'_val': None, 'a': 1}}},
+    'ints': {1: 'a'}
+}
+
+# As merge_graph_json.py writes it, condensed by day
+CONDENSED_DATA = {
+    'builds': [{'firstrev': 'abc', 'time': 86400, 'count': 2, 'lastrev': 'def',
+                'timerange': [86500, 90000]},
+               {'firstrev': u'd\xe9f', 'time': 172800}],
+    'series': {'Explicit': [[1, 2, 2 ** 40], 1000], 'Empty': [None, None], 'Mixed': [0.5, 'x']},
+    'condensed': 86400,
+    'allseries': []
+}
+
+def zlib_compressor():
+  compressor = zlib.compressobj()
+  return (compressor.compress, compressor.flush)
+
+class GraphJSONTest(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.temp_dir, 'series.json.gz')
+
+  def tearDown(self):
+    mozfile.remove(self.temp_dir)
+
+  def read(self, path):
+    f = gzip.open(path)
+    data = f.read()
+    f.close()
+    return data
+
+  def test_write_json(self):
+    for depth in (0, 1, 2, 5):
+      GraphJSON.write_json(self.path, TEST_DATA, level=1, depth=depth)
+      data = self.read(self.path)
+      self.assertEqual(json.loads(data), json.loads(json.dumps(TEST_DATA)))
+      self.assertNotIn(' ', data)
+      self.assertTrue(data.endswith('\n'))
+    self.assertEqual(os.listdir(self.temp_dir), ['series.json.gz'])
+
+  def test_small_blocks(self):
+    with mock.patch.object(GraphJSON, 'gBlockSize', 1):
+      GraphJSON.write_json(self.path, TEST_DATA)
+    self.assertEqual(json.loads(self.read(self.path)), json.loads(json.dumps(TEST_DATA)))
+
+  def test_precompress(self):
+    with mock.patch.dict(GraphJSON.gPrecompressors, {'zlib': ('.z', zlib_compressor)}):
+      GraphJSON.write_json(self.path, TEST_DATA, precompress='zlib')
+    sibling = os.path.join(self.temp_dir, 'series.json.z')
+    self.assertEqual(zlib.decompress(open(sibling, 'rb').read()), self.read(self.path))
+
+  def test_failed_write(self):
+    GraphJSON.write_json(self.path, TEST_DATA)
+    # The old file is left alone
+    self.assertRaises(TypeError, GraphJSON.write_json, self.path, {'a': [object()]})
+    self.assertEqual(json.loads(self.read(self.path)), json.loads(json.dumps(TEST_DATA)))
+    self.assertEqual(os.listdir(self.temp_dir), ['series.json.gz'])
+
+  def test_unchanged(self):
+    digest = GraphJSON.write_json(self.path, TEST_DATA)
+    inode = os.stat(self.path).st_ino
+    # Same content, the file isn't replaced
+    self.assertEqual(GraphJSON.write_json(self.path, TEST_DATA, old_digest=digest), digest)
+    self.assertEqual(os.stat(self.path).st_ino, inode)
+    self.assertEqual(os.listdir(self.temp_dir), ['series.json.gz'])
+    # Different content is written out
+    new_digest = GraphJSON.write_json(self.path, {'a': 1}, old_digest=digest)
+    self.assertNotEqual(new_digest, digest)
+    self.assertEqual(json.loads(self.read(self.path)), {'a': 1})
+    # As is a missing file, or a missing precompressed copy
+    os.remove(self.path)
+    GraphJSON.write_json(self.path, {'a': 1}, old_digest=new_digest)
+    self.assertEqual(json.loads(self.read(self.path)), {'a': 1})
+    with mock.patch.dict(GraphJSON.gPrecompressors, {'zlib': ('.z', zlib_compressor)}):
+      GraphJSON.write_json(self.path, {'a': 1}, precompress='zlib', old_digest=new_digest)
+    self.assertTrue(os.path.exists(os.path.join(self.temp_dir, 'series.json.z')))
+
+  def test_unchanged_large(self):
+    # Past gHoldSize the output is written out, and thrown away if unchanged
+    with mock.patch.object(GraphJSON, 'gBlockSize', 1), \
+         mock.patch.object(GraphJSON, 'gHoldSize', 1):
+      digest = GraphJSON.write_json(self.path, TEST_DATA)
+      inode = os.stat(self.path).st_ino
+      self.assertEqual(GraphJSON.write_json(self.path, TEST_DATA, old_digest=digest), digest)
+      self.assertEqual(os.stat(self.path).st_ino, inode)
+      self.assertEqual(os.listdir(self.temp_dir), ['series.json.gz'])
+      GraphJSON.write_json(self.path, {'a': 1}, old_digest=digest)
+    self.assertEqual(json.loads(self.read(self.path)), {'a': 1})
+
+  def test_encoded_list(self):
+    data = {'series': {'a': GraphJSON.EncodedList(iter(['1,', 'null', ',2']))}}
+    GraphJSON.write_json(self.path, data)
+    self.assertEqual(self.read(self.path), '{"series":{"a":[1,null,2]}}\n')
+
+  def test_hash_index(self):
+    index_path = os.path.join(self.temp_dir, 'series.hashes.json')
+    hashes = GraphJSON.HashIndex(index_path)
+    self.assertIsNone(hashes.get('a.json.gz'))
+    hashes['a.json.gz'] = GraphJSON.write_json(self.path, TEST_DATA)
+    hashes.save()
+    self.assertEqual(GraphJSON.HashIndex(index_path).get('a.json.gz'), hashes.get('a.json.gz'))
+    # A damaged index is ignored
+    with open(index_path, 'w') as f:
+      f.write('{')
+    self.assertIsNone(GraphJSON.HashIndex(index_path).get('a.json.gz'))
+
+  def test_write_columns(self):
+    path = os.path.join(self.temp_dir, 'series.bin.gz')
+    # As create_graph_json.py writes it
+    series_data = {'builds': TEST_DATA['builds'], 'series': {'Explicit': [100, None]},
+                   'generated': 12.5}
+    for data in (series_data, CONDENSED_DATA):
+      digest = GraphJSON.write_columns(path, data)
+      self.assertEqual(json.loads(json.dumps(GraphJSON.read_columns(path))),
+                       json.loads(json.dumps(data)))
+      self.assertEqual(GraphJSON.write_columns(path, data, old_digest=digest), digest)
+
+    # The columns are 8 byte aligned for the website's typed arrays
+    raw = self.read(path)
+    header_length = struct.unpack('<I', raw[8:12])[0]
+    self.assertEqual((12 + header_length) % 8, 0)
+    header = json.loads(raw[12:12 + header_length])
+    self.assertEqual(header['builds']['time']['column']['type'], 'Int32')
+    self.assertTrue(header['builds']['count']['optional'])
+    self.assertEqual(len(header['series']['Explicit']['columns']), 3)
+    self.assertIn('values', header['series']['Mixed'])
+    for encoding in header['builds'].values() + header['series'].values():
+      for column in encoding.get('columns', [encoding.get('column')]):
+        if column:
+          self.assertEqual(column['offset'] % 8, 0)
+
+    self.assertRaises(ValueError, GraphJSON.write_columns, path,
+                      {'builds': [{}], 'series': {'Explicit': []}})
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Bulk loads raw test results into the per-month databases, e.g. to rebuild a
+# month after a schema change or corruption.
+#
+# Each file (optionally gzipped) is a JSON object describing one test:
+#   { "buildname": "abcdef123456", "buildtime": 1422727955,
+#     "testname": "Slimtest-TalosTabs-Roxy",
+#     "repo": "mozilla-inbound",      # optional, default mozilla-inbound
+#     "testtime": 1422730000,         # optional, default now
+#     "successful": true,             # optional, default true
+#     "results": [ ... ] }
+# where results is the iteration -> checkpoint -> reports structure the memory
+# test leaves in testvars['results'].
+#
+# Every month's database is loaded in a single transaction, with the names
+# interned once per file and the data written in large batches. Months are
+# loaded in parallel with --jobs.
+
+import argparse
+import gzip
+import json
+import multiprocessing
+import os
+import re
+import sqlite3
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(sys.argv[0]), '..', 'benchtester'))
+import BenchDB
+import BenchTester
+
+def open_file(filename):
+  if filename.endswith('.gz'):
+    return gzip.open(filename)
+  return open(filename)
+
+def read_file(filename):
+  infile = open_file(filename)
+  try:
+    return json.load(infile)
+  finally:
+    infile.close()
+
+# The top level fields route_file() needs, picked out of the file without
+# parsing the results, which are most of it. Nothing under results has these
+# keys with a plain string or number value -- the only such keys there are the
+# checkpoints' 'label' and the reports' 'val', 'unit' and 'kind'.
+gHeaderField = re.compile(r'"(buildname|buildtime|testname)"\s*:\s*'
+                          r'("(?:[^"\\]|\\.)*"|-?[0-9][0-9.eE+-]*)')
+gResultsField = re.compile(r'"results"\s*:\s*\[')
+
+def read_header(filename):
+  infile = open_file(filename)
+  try:
+    text = infile.read()
+  finally:
+    infile.close()
+  header = {}
+  for match in gHeaderField.finditer(text):
+    header.setdefault(match.group(1), json.loads(match.group(2)))
+  if gResultsField.search(text):
+    header['results'] = True
+  return header
+
+# The database a file belongs in, or an error string. Files that turn out not
+# to be valid JSON are skipped by load_shard().
+def route_file(args):
+  filename, dbdir, series = args
+  try:
+    data = read_header(filename)
+    for key in [ 'buildname', 'buildtime', 'testname', 'results' ]:
+      if key not in data:
+        return (filename, None, "missing '%s'" % (key,))
+  except Exception, e:
+    return (filename, None, "unreadable: %s" % (e,))
+  shards = BenchDB.ShardRouter(dbdir)
+  if series:
+    return (filename, shards.custom_shard(series), None)
+  return (filename, shards.shard_for_time(data['buildtime']), None)
+
+# Loads files into shard, returning (shard, files loaded, datapoints, seconds,
+# error, [(file, error)] of the files skipped as unreadable)
+def load_shard(args):
+  shard, files, batch_size = args
+  starttime = time.time()
+  skipped = []
+  if BenchDB.ShardRouter.is_archived(shard):
+    return (shard, 0, 0, 0, "database is archived", skipped)
+
+  tester = BenchTester.BenchTester()
+  tester.args['sqlitedb'] = shard
+  db_exists = os.path.exists(shard)
+  sql = BenchTester.connect_db(shard)
+  cur = sql.cursor()
+  datapoints = 0
+  try:
+    db_version = tester.verify_db(cur, db_exists)
+    if db_version is None:
+      return (shard, 0, 0, 0, "incompatible database version", skipped)
+    sql.commit()
+
+    cur.execute("BEGIN IMMEDIATE")
+    caches = {}
+    for table in [ 'checkpoints', 'procs', 'datapoints' ]:
+      caches[table] = BenchTester.IdCache('benchtester_' + table)
+      caches[table].refresh(cur)
+    repos = dict(cur.execute("SELECT `name`, `id` FROM `benchtester_repos`").fetchall())
+
+    batch = []
+    def flush():
+      if db_version >= 3:
+        cur.executemany("INSERT INTO `benchtester_packed_data` "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, NULL, NULL)", batch)
+      else:
+        cur.executemany("INSERT INTO `benchtester_data` "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", batch)
+      del batch[:]
+
+    for filename in files:
+      try:
+        data = read_file(filename)
+      except Exception, e:
+        skipped.append((filename, "unreadable: %s" % (e,)))
+        continue
+
+      # Build and test rows
+      repo = data.get('repo', 'mozilla-inbound')
+      if repo not in repos:
+        cur.execute("INSERT INTO `benchtester_repos` (`name`) VALUES (?)", [ repo ])
+        repos[repo] = cur.lastrowid
+      row = cur.execute("SELECT `id`, `time` FROM `benchtester_builds` WHERE `name` = ?",
+                        [ data['buildname'] ]).fetchone()
+      if not row:
+        cur.execute("INSERT INTO `benchtester_builds` (`name`, `time`, `repo_id`) "
+                    "VALUES (?, ?, ?)",
+                    [ data['buildname'], int(data['buildtime']), repos[repo] ])
+        build_id = cur.lastrowid
+      else:
+        build_id = row[0]
+        if row[1] != int(data['buildtime']):
+          cur.execute("UPDATE `benchtester_builds` SET `time` = ? WHERE `id` = ?",
+                      [ int(data['buildtime']), build_id ])
+      cur.execute("INSERT INTO `benchtester_tests` (`name`, `time`, `build_id`, `successful`) "
+                  "VALUES (?, ?, ?, ?)",
+                  [ data['testname'], int(data.get('testtime', time.time())), build_id,
+                    1 if data.get('successful', True) else 0 ])
+      test_id = cur.lastrowid
+
+      # Intern all of the file's names up front
+      reports = []
+      for x, iteration in enumerate(data['results']):
+        for checkpoint in iteration:
+          mapping = BenchTester.BenchTester.map_process_names(checkpoint['reports'])
+          for process_name, values in checkpoint['reports'].iteritems():
+            reports.append((x + 1, checkpoint['label'], mapping[process_name], values))
+      caches['checkpoints'].intern(cur, set(r[1] for r in reports))
+      caches['procs'].intern(cur, set(r[2] for r in reports))
+      caches['datapoints'].intern(cur, set(name for r in reports for name in r[3]))
+
+      checkpoints = caches['checkpoints']
+      procs = caches['procs']
+      names = caches['datapoints']
+      for iternum, label, process_name, values in reports:
+        entries = [ (names[name], dp['val'], dp['unit'], dp['kind'])
+                    for name, dp in values.iteritems() if dp ]
+        datapoints += len(entries)
+        if db_version >= 3:
+          batch.append((test_id, checkpoints[label], procs[process_name], iternum) +
+                       tuple(sqlite3.Binary(x) for x in BenchDB.pack_reports(entries)))
+        else:
+          batch.extend((test_id, e[0], checkpoints[label], procs[process_name], iternum) +
+                       e[1:] for e in entries)
+        if len(batch) >= batch_size:
+          flush()
+    flush()
+    sql.commit()
+  except Exception, e:
+    sql.rollback()
+    return (shard, 0, 0, time.time() - starttime, "%s: %s" % (type(e).__name__, e), skipped)
+  finally:
+    sql.close()
+  return (shard, len(files) - len(skipped), datapoints, time.time() - starttime, None, skipped)
+
+def rate(datapoints, seconds):
+  return datapoints / seconds if seconds > 0 else 0
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Bulk load raw test results into the results databases')
+  parser.add_argument('--dbdir', default='db',
+                      help='Directory holding the monthly databases')
+  parser.add_argument('--series',
+                      help='Load everything into this custom series\' database instead')
+  parser.add_argument('--jobs', '-j', type=int, default=1,
+                      help='Number of databases to load in parallel')
+  parser.add_argument('--batch-size', type=int, default=5000,
+                      help='Rows per batched insert')
+  parser.add_argument('files', nargs='+')
+  args = parser.parse_args()
+
+  starttime = time.time()
+  pool = multiprocessing.Pool(args.jobs)
+
+  failed = False
+  shards = {}
+  for filename, shard, error in pool.imap(route_file, [ (f, args.dbdir, args.series)
+                                                        for f in args.files ]):
+    if error:
+      print("!! Skipping %s: %s" % (filename, error))
+      failed = True
+    else:
+      shards.setdefault(shard, []).append(filename)
+  print("[%.02fs] %u files for %u databases" % (time.time() - starttime,
+                                               sum(len(x) for x in shards.values()),
+                                               len(shards)))
+
+  total = 0
+  for shard, files, datapoints, seconds, error, skipped in pool.imap_unordered(
+      load_shard, [ (shard, files, args.batch_size) for shard, files in sorted(shards.items()) ]):
+    for filename, reason in skipped:
+      print("!! Skipping %s: %s" % (filename, reason))
+      failed = True
+    if error:
+      print("!! Failed to load %s, rolled back: %s" % (shard, error))
+      failed = True
+    else:
+      total += datapoints
+      print("[%.02fs] Loaded %u tests, %u datapoints into %s in %.02fs (%u rows/sec)" %
+            (time.time() - starttime, files, datapoints, shard, seconds,
+             rate(datapoints, seconds)))
+  pool.close()
+  pool.join()
+
+  elapsed = time.time() - starttime
+  print("[%.02fs] Loaded %u datapoints overall (%u rows/sec)" %
+        (elapsed, total, rate(total, elapsed)))
+  sys.exit(1 if failed else 0)
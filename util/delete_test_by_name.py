@@ -13,6 +13,9 @@ import sys
 import os
 import sqlite3
 
+sys.path.append(os.path.join(os.path.dirname(sys.argv[0]), '..', 'benchtester'))
+import BenchDB
+
 if len(sys.argv) != 3:
   sys.stderr.write("Usage: %s <database> <testname>\n" % (sys.argv[0],));
   sys.exit(1);
@@ -24,6 +27,8 @@ if not os.path.exists(sys.argv[1]):
 sql = sqlite3.connect(sys.argv[1], timeout=900)
 sql.row_factory = sqlite3.Row
 cur = sql.cursor()
+# Version 2 and up databases keep their data packed, a row per checkpoint
+version = BenchDB.db_version(cur)
 
 cur.execute('''SELECT * FROM `benchtester_tests` WHERE `name` = ?''', [ sys.argv[2] ])
 
@@ -32,9 +37,14 @@ for test in cur.fetchall():
   testid = int(test['id'])
   cur.execute('DELETE FROM `benchtester_data` WHERE `test_id` = ?', [ testid ])
   deleted = cur.rowcount
+  if version >= 2:
+    # Version 3 rows may only hold the changes from a base row, but that is
+    # always a row of the same test, so it goes with it
+    cur.execute('DELETE FROM `benchtester_packed_data` WHERE `test_id` = ?', [ testid ])
+    deleted += cur.rowcount
   totalrows += deleted + 1
   cur.execute('DELETE FROM `benchtester_tests` WHERE `id` = ?', [ testid ])
   sql.commit()
-  print("Deleted test %u with %u datapoints" % ( testid, deleted ))
+  print("Deleted test %u with %u data rows" % ( testid, deleted ))
 
 print("Deleted %u total rows" % totalrows)
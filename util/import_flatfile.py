@@ -22,7 +22,9 @@ import sys
 import re
 import pprint
 import time
-import datetime
+
+sys.path.append(os.path.join(os.path.dirname(sys.argv[0]), '..', 'benchtester'))
+import BenchDB
 
 def err(msg):
     sys.stderr.write(msg + '\n')
@@ -64,12 +66,11 @@ if metadata['mode'] not in [ 'insert', 'replace' ]:
 
 print("Got %u datavalues, inserting" % len(data))
 
-filedate = datetime.datetime.utcfromtimestamp(int(metadata['buildtime'])).date()
-dbname = "areweslimyet-%04u-%02u.sqlite" % (filedate.year, filedate.month)
-dbpath = os.path.join(dbdir, dbname)
+shards = BenchDB.ShardRouter(dbdir)
+dbpath = shards.shard_for_time(metadata['buildtime'])
 print("Using database %s" % (dbpath,))
 
-if os.path.exists(dbpath + '.xz'):
+if shards.is_archived(dbpath):
     err("Database appears to be archived, cannot import")
 if not os.path.exists(dbpath):
     err("Database does not exist yet! Exiting for sanity")
@@ -78,6 +79,14 @@ sql = sqlite3.connect(dbpath)
 
 cur = sql.cursor()
 
+# The rows below are in the original unversioned format. Version 1 databases
+# lay out benchtester_data differently, and version 2 and up don't read it at
+# all, so the import would fail or vanish from the exports.
+version = BenchDB.db_version(cur)
+if version is not None:
+    err("%s is a version %s database, this script can only import into "
+        "unversioned ones" % (dbpath, version))
+
 #
 # Insert build
 #
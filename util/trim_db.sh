@@ -26,13 +26,20 @@ time sqlite3 "$db" 'DELETE FROM benchtester_data WHERE test_id IN
                      LEFT JOIN benchtester_tests t ON t.id = d.test_id
                      WHERE t.id IS NULL
                     ); SELECT total_changes()'
+# Version 2 and up databases keep their data packed
+if [ -n "$(sqlite3 "$db" "SELECT name FROM sqlite_master WHERE name = 'benchtester_packed_data'")" ]; then
+  time sqlite3 "$db" 'DELETE FROM benchtester_packed_data WHERE test_id IN
+                      (
+                       SELECT DISTINCT d.test_id FROM benchtester_packed_data d
+                       LEFT JOIN benchtester_tests t ON t.id = d.test_id
+                       WHERE t.id IS NULL
+                      ); SELECT total_changes()'
+fi
 
+# Packed rows name their datapoints inside compressed blobs, which BenchDB.py
+# unpacks to check against
 echo ":: Removing unreferenced datapoints"
-time sqlite3 "$db" 'DELETE FROM benchtester_datapoints WHERE id IN (
-                      SELECT DISTINCT id FROM benchtester_datapoints p
-                      LEFT JOIN benchtester_data d ON d.datapoint_id = p.id
-                      WHERE d.datapoint_id IS NULL
-                    ); SELECT total_changes()'
+time python "$(dirname "$0")"/../benchtester/BenchDB.py trim-datapoints "$db"
 
 echo ":: Removing unused builds"
 time sqlite3 "$db" 'DELETE FROM benchtester_builds WHERE id IN (
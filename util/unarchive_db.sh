@@ -38,12 +38,7 @@ xz -vdc "$dbxz" > "$db"
 > "$dbxz"
 
 echo "Re-adding indexes"
-echo ":: Adding test_lookup"
-sqlite3 "$db" 'CREATE INDEX IF NOT EXISTS test_lookup ON benchtester_tests ( name, build_id DESC )'
-echo ":: Adding data_for_test"
-# If the first fails try the index for the older format
-sqlite3 "$db" 'CREATE INDEX IF NOT EXISTS data_for_test ON benchtester_data ( test_id DESC, datapoint_id )' \
- || sqlite3 "$db" 'CREATE INDEX IF NOT EXISTS data_for_test ON benchtester_data ( test_id DESC )'
+python "$(dirname "$0")"/../benchtester/BenchDB.py indexes "$db"
 
 # Now we can get rid of dummy .xz
 rm -v "$dbxz"
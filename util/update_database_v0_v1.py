@@ -21,6 +21,7 @@ sys.path.append(os.path.join('.', 'benchtester'))
 # We need gTableSchemas to create the new database
 try:
   import BenchTester
+  import BenchDB
 except:
   sys.stderr.write("Couldn't find benchtester in current directory. Run me from the root!\n");
   sys.exit(1);
@@ -85,19 +86,17 @@ try:
 except sqlite3.OperationalError:
   db_version = 0
 
-if db_version == BenchTester.gVersion:
-  print("Database is up to date, version = %s" % db_version)
-  sys.exit(1)
-elif db_version != 0 or BenchTester.gVersion != 1:
-  print("This script currently only handles 0 => 1")
+if db_version >= 1:
+  print("Database is already version %s" % db_version)
   sys.exit(1)
 else:
-  print("Upgrading db version from %s to %s" % (db_version, BenchTester.gVersion))
+  print("Upgrading db version from %s to %s" % (db_version, 1))
 
 starttime = time.time()
 
-# Set the DB version
-cur.execute('INSERT INTO benchtester_version(version) VALUES ( ? )', (BenchTester.gVersion, ))
+# Set the DB version. Further upgrades are handled by
+# update_database_v1_v2.py
+cur.execute('INSERT INTO benchtester_version(version) VALUES ( ? )', (1, ))
 
 # Add the benchtester_checkpoints
 cur.execute('SELECT DISTINCT meta FROM old.benchtester_data')
@@ -187,6 +186,10 @@ cur.executemany('INSERT INTO benchtester_data(test_id,datapoint_id,checkpoint_id
 
 print("[%.02fs] Inserted benchtester_data" % (time.time() - starttime))
 
+BenchDB.create_indexes(cur)
+
+print("[%.02fs] Created indexes" % (time.time() - starttime))
+
 sql.commit()
 
 print("[%.02fs] Committed everything" % (time.time() - starttime))
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+
+# Converts a v1 database (a benchtester_data row per datapoint) to the v2
+# format (a packed benchtester_packed_data row per test/checkpoint/process/
+# iteration).
+
+import os
+import sqlite3
+import sys
+import time
+
+sys.path.append(os.path.join('.', 'benchtester'))
+
+# We need gTableSchemas to create the new database
+try:
+  import BenchTester
+  import BenchDB
+except:
+  sys.stderr.write("Couldn't find benchtester in current directory. Run me from the root!\n");
+  sys.exit(1);
+
+if len(sys.argv) != 2:
+  sys.stderr.write("Usage: %s <database>\n" % (sys.argv[0],));
+  sys.stderr.write("  will create a new database named <database>.new in the\n");
+  sys.stderr.write("  v2 format.\n");
+  sys.exit(1);
+
+if not os.path.exists(sys.argv[1]):
+  sys.stderr.write("Database '%s' does not exist" % (sys.argv[1],))
+  sys.exit(1)
+
+newdb = sys.argv[1] + '.new'
+if os.path.exists(newdb):
+  sys.stderr.write("%s exists, refusing to overwrite\n" % (newdb,))
+  sys.exit(1)
+
+print("Creating %s..." % (newdb,))
+sql = sqlite3.connect(newdb, timeout=900)
+cur = sql.cursor()
+for schema in BenchTester.gTableSchemas:
+  cur.execute(schema)
+
+# This will speed things up significantly at the expense of ~1GiB memory usage
+cur.execute('''PRAGMA cache_size = -1000000''')
+cur.execute('''PRAGMA temp_store = 2''')
+# The new database is empty if we don't reach COMMIT, so we don't particularly
+# care if we corrupt it. This also significantly speeds up the operation.
+cur.execute('''PRAGMA journal_mode = OFF''')
+cur.execute('''PRAGMA synchronous = OFF''')
+
+# Open old db
+print("Opening %s..." % (sys.argv[1],))
+cur.execute('''ATTACH DATABASE ? AS old''', [ sys.argv[1] ])
+
+cur.execute('SELECT MAX(version) FROM old.benchtester_version')
+db_version = cur.fetchone()[0]
+if db_version != 1:
+  print("This script only handles 1 => 2, database is version %s" % (db_version,))
+  sys.exit(1)
+
+starttime = time.time()
+
+cur.execute('INSERT INTO benchtester_version(version) VALUES ( ? )', (2, ))
+
+# Everything but the data moves over as-is, ids included
+for table in [ 'benchtester_repos', 'benchtester_builds', 'benchtester_tests',
+               'benchtester_datapoints', 'benchtester_procs',
+               'benchtester_checkpoints' ]:
+  cur.execute('INSERT INTO %s SELECT * FROM old.%s' % (table, table))
+  print("[%.02fs] Copied %s" % ((time.time() - starttime), table))
+
+test_ids = [ row[0] for row in cur.execute('SELECT id FROM benchtester_tests') ]
+
+# Pack each test's data, one test at a time to keep memory usage sane
+packedrows = 0
+datarows = 0
+for i, test_id in enumerate(test_ids):
+  groups = {}
+  for row in cur.execute('SELECT checkpoint_id, proc_id, iteration, '
+                         '       datapoint_id, value, units, kind '
+                         'FROM old.benchtester_data WHERE test_id = ?',
+                         [ test_id ]):
+    groups.setdefault(row[:3], []).append(row[3:])
+    datarows += 1
+
+  cur.executemany('INSERT INTO benchtester_packed_data '
+                  '(test_id, checkpoint_id, proc_id, iteration, '
+                  ' datapoint_ids, `values`, units, kinds) '
+                  'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                  ( (test_id,) + key +
+                    tuple(sqlite3.Binary(x) for x in BenchDB.pack_reports(entries))
+                    for key, entries in groups.iteritems() ))
+  packedrows += len(groups)
+  print("[%.02fs] %u/%u tests" % ((time.time() - starttime), i + 1, len(test_ids)))
+
+# Faster to build the indexes once everything is in
+BenchDB.create_indexes(cur)
+print("[%.02fs] Created indexes" % (time.time() - starttime))
+
+sql.commit()
+
+print("[%.02fs] Packed %u data rows into %u rows" %
+      ((time.time() - starttime), datarows, packedrows))